@@ -0,0 +1,58 @@
+"""
+Benchmark: encoding of a big Yandex response for the client, passed through as is vs parsed and serialized again.
+
+Not a part of unit tests, timings depend on the machine. Run from the repository root:
+    python3 benchmarks/json_passthrough.py
+"""
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable = C0413, W0212
+from yandex_transport_core import YandexTransportCore, RawJSON, ClientConnection
+
+# Number of times each variant is executed
+ROUNDS = 20
+
+
+def make_body():
+    """
+    Make a body similar to a big getLine response.
+    :return: JSON string
+    """
+    return json.dumps({'data': {'features': [{'id': str(i), 'name': 'Stop ' + str(i),
+                                              'coordinates': [[37.5 + i / 1000, 55.7 + i / 1000]] * 10,
+                                              'properties': {'type': 'bus', 'threads': ['a', 'b', 'c']}}
+                                             for i in range(2000)]}})
+
+
+def run_benchmark(body, passthrough):
+    """
+    Make API result from the body and encode it for the client, ROUNDS times.
+    :param body: JSON string
+    :param passthrough: JSON passthrough mode of the core
+    :return: time per round, in secs
+    """
+    query = {'url': 'https://yandex.ru/maps/api/masstransit/getLine?id=1', 'method': "maps/api/masstransit/getLine"}
+    conn = ClientConnection(None, ('127.0.0.1', 0))
+    core = YandexTransportCore()
+    core.json_passthrough = passthrough
+    start_time = time.perf_counter()
+    for _ in range(ROUNDS):
+        entry = core._make_api_result(query, body)
+        conn.encode({'id': '1', 'method': entry['method'], 'error': 0, 'message': 'OK',
+                     'expect_more_data': True, 'data': entry['data']})
+    return (time.perf_counter() - start_time) / ROUNDS
+
+
+if __name__ == '__main__':
+    response_body = make_body()
+    print("JSON backend: " + RawJSON.BACKEND)
+    for json_passthrough in (False, True):
+        round_time = run_benchmark(response_body, json_passthrough)
+        print("JSON " + ("passthrough" if json_passthrough else "parsed     ") + ": " +
+              str(round(round_time * 1000, 2)) + " ms per " + str(len(response_body) // 1024) + " KB response")
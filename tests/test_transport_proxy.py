@@ -7,7 +7,20 @@ NOTE: These are Unit Tests, they should test function behaviour based on input d
       Integration Tests/Continuous Monitoring tests.
 """
 
+import json
+import time
+import socket
+import selectors
+import struct
+import os
+import gzip
+import zlib
+import threading
 import pytest
+from transport_proxy import Application
+from selenium.common.exceptions import WebDriverException
+from yandex_transport_core import YandexTransportCore, RawJSON, ResponseCache, ClientConnection, NetworkLogWriter
+from yandex_transport_core import RateLimiter, ExecutorThread, WatchThread
 
 # ---------------------------------------------      warm-up        -------------------------------------------------- #
 
@@ -16,3 +29,1137 @@ def test_initial():
     Most basic test to ensure pytest DEFINITELY works
     """
     assert True == True
+
+# ---------------------------------------------      helpers        -------------------------------------------------- #
+
+
+class FakeConnection:
+    """
+    Fake client connection, stores everything "sent" to it.
+    """
+    def __init__(self, addr=('127.0.0.1', 0)):
+        self.addr = addr
+        self.sent = []
+
+    def send_message(self, message, can_block=True):
+        """Store sent message"""
+        data = bytes(json.dumps(message) + '\n' + '\0', 'utf-8')
+        self.sent.append(json.loads(json.dumps(message)))
+        return data
+
+    def messages(self):
+        """Get list of messages sent to this connection"""
+        return self.sent
+
+
+class FakeCore:
+    """
+    Fake YandexTransportCore, returns saved data instead of going to Yandex.
+    """
+    def __init__(self):
+        self.urls = []
+        self.recycle_reason = None
+        self.running = False
+        self.warm_up_url = None
+        self.profile_template_dir = None
+        self.browser_needed = True
+
+    def iter_info(self, query_type, url):
+        """Return fake getStopInfo result"""
+        self.urls.append(url)
+        yield {'url': url, 'method': 'getStopInfo', 'error': 'OK', 'data': {'stop': url}}, \
+            YandexTransportCore.RESULT_OK
+
+    def needs_browser(self, query_type, url):
+        """Return saved answer"""
+        return self.browser_needed
+
+    def start_webdriver(self):
+        """Pretend to start the browser"""
+        self.running = True
+
+    def stop_webdriver(self):
+        """Pretend to stop the browser"""
+        self.running = False
+
+    def warm_up(self, url):
+        """Remember warm-up URL"""
+        self.warm_up_url = url
+
+    def get_recycle_reason(self):
+        """Return saved recycle reason"""
+        return self.recycle_reason
+
+
+def make_application(workers=1):
+    """
+    Create an Application with fake executor workers (not started).
+    """
+    app = Application()
+    app.log.verbose = 0
+    app.executor_threads = [ExecutorThread(app, worker_id, FakeCore()) for worker_id in range(0, workers)]
+    return app
+
+# ---------------------------------------------   executor workers   ------------------------------------------------- #
+
+def test_workers_route_responses_to_own_connections():
+    """
+    Each worker picks its own query from the shared Query Queue, and responses go to the right connection.
+    """
+    app = make_application(workers=2)
+    conn_a = FakeConnection()
+    conn_b = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=a?https://stop/a', ('127.0.0.1', 1), conn_a)
+    app.process_get_stop_info('getStopInfo?id=b?https://stop/b', ('127.0.0.1', 2), conn_b)
+
+    app.executor_threads[0].perform_query_extraction_and_execution()
+    app.executor_threads[1].perform_query_extraction_and_execution()
+
+    assert app.executor_threads[0].core.urls == ['https://stop/a']
+    assert app.executor_threads[1].core.urls == ['https://stop/b']
+    assert conn_a.messages()[-1]['id'] == 'a'
+    assert conn_a.messages()[-2]['data'] == {'stop': 'https://stop/a'}
+    assert conn_b.messages()[-1]['id'] == 'b'
+    assert not app.query_queue
+
+
+def test_get_current_queue_reports_workers():
+    """
+    Queries being executed are reported first, together with the worker executing them.
+    """
+    app = make_application(workers=2)
+    conn = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=1?https://stop/1', ('127.0.0.1', 1), conn)
+    app.process_get_stop_info('getStopInfo?id=2?https://stop/2', ('127.0.0.1', 1), conn)
+    app.executor_threads[1].current_query = app.query_queue.popleft()
+
+    queue = json.loads(app.get_current_queue())
+    assert queue == [{'type': 'getStopInfo', 'id': '1', 'query': 'https://stop/1',
+                      'status': 'executing', 'worker': 1},
+                     {'type': 'getStopInfo', 'id': '2', 'query': 'https://stop/2',
+                      'status': 'queued', 'worker': None}]
+
+# ---------------------------------------------   response cache    -------------------------------------------------- #
+
+def test_response_cache_canonical_url():
+    """
+    Same URL with reordered parameters should map to the same cache entry.
+    """
+    assert ResponseCache.canonical_url('https://Yandex.ru/maps/?z=17&mode=stop#anchor') == \
+           ResponseCache.canonical_url('https://yandex.ru/maps/?mode=stop&z=17')
+
+
+def test_response_cache_ttl():
+    """
+    Cached entries should expire after TTL of the query type, uncacheable types are never stored.
+    """
+    cache = ResponseCache()
+    cache.ttl['getStopInfo'] = 0.05
+    cache.put('getStopInfo', 'https://stop/1', [{'method': 'getStopInfo'}], 10)
+    cache.put('getEcho', 'hello', [{'method': 'getEcho'}], 10)
+    assert cache.get('getStopInfo', 'https://stop/1') == [{'method': 'getStopInfo'}]
+    assert cache.get('getEcho', 'hello') is None
+    time.sleep(0.1)
+    assert cache.get('getStopInfo', 'https://stop/1') is None
+    assert cache.get_stats() == {'entries': 0, 'size': 0, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_response_cache_lru_eviction():
+    """
+    Least recently used entries should be evicted when there are too many entries or bytes.
+    """
+    cache = ResponseCache(max_entries=2, max_bytes=100)
+    cache.put('getLine', 'https://line/1', ['1'], 10)
+    cache.put('getLine', 'https://line/2', ['2'], 10)
+    cache.get('getLine', 'https://line/1')
+    cache.put('getLine', 'https://line/3', ['3'], 10)
+    assert cache.get('getLine', 'https://line/2') is None
+    assert cache.get('getLine', 'https://line/1') == ['1']
+
+    cache.put('getLine', 'https://line/4', ['4'], 90)
+    assert cache.get('getLine', 'https://line/3') is None
+    assert cache.get('getLine', 'https://line/4') == ['4']
+    assert cache.get_stats()['size'] == 100
+
+
+def test_cached_response_skips_query_queue():
+    """
+    Second identical query should be answered from the cache right away, with its own ID.
+    """
+    app = make_application()
+    conn = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=1?https://stop/1', ('127.0.0.1', 1), conn)
+    app.executor_threads[0].perform_query_extraction_and_execution()
+
+    app.process_get_stop_info('getStopInfo?id=2?https://stop/1', ('127.0.0.1', 1), conn)
+    assert not app.query_queue
+    assert app.executor_threads[0].core.urls == ['https://stop/1']
+    messages = conn.messages()
+    assert messages[-3] == {'id': '2', 'response': 'OK', 'queue_position': 0, 'cached': True}
+    assert messages[-2]['id'] == '2'
+    assert messages[-2]['data'] == {'stop': 'https://stop/1'}
+    assert messages[-1]['id'] == '2'
+    assert messages[-1]['expect_more_data'] is False
+
+# ---------------------------------------------  query coalescing   -------------------------------------------------- #
+
+def test_identical_queries_are_coalesced():
+    """
+    Identical queries from different clients should be executed once, results should go to everyone with own IDs.
+    """
+    app = make_application()
+    app.cache.max_entries = 0
+    conn_a = FakeConnection()
+    conn_b = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=a?https://stop/1', ('127.0.0.1', 1), conn_a)
+    app.process_get_stop_info('getStopInfo?id=x?https://stop/2', ('127.0.0.1', 1), conn_a)
+    app.process_get_stop_info('getStopInfo?id=b?https://stop/1', ('127.0.0.1', 2), conn_b)
+    assert len(app.query_queue) == 2
+    assert conn_b.messages()[-1] == {'id': 'b', 'response': 'OK', 'queue_position': 0, 'coalesced': True}
+
+    app.executor_threads[0].perform_query_extraction_and_execution()
+    assert app.executor_threads[0].core.urls == ['https://stop/1']
+    assert conn_a.messages()[-1]['id'] == 'a'
+    assert conn_b.messages()[-1]['id'] == 'b'
+    assert conn_b.messages()[-2]['data'] == {'stop': 'https://stop/1'}
+
+    # Query is done, next identical query should go to the Query Queue again
+    app.process_get_stop_info('getStopInfo?id=c?https://stop/1', ('127.0.0.1', 2), conn_b)
+    assert len(app.query_queue) == 2
+    assert 'coalesced' not in conn_b.messages()[-1]
+
+
+class FailingCore(FakeCore):
+    """
+    Fake YandexTransportCore, the browser fails in the middle of the query.
+    """
+    def iter_info(self, query_type, url):
+        """Raise WebDriverException after the first result"""
+        yield from super().iter_info(query_type, url)
+        raise WebDriverException('Browser crashed')
+
+
+def test_browser_failure_is_reported_to_coalesced_clients():
+    """
+    If the browser fails during the query, everyone waiting for it should get the final error message,
+    and the worker should go on serving.
+    """
+    app = make_application()
+    app.cache.max_entries = 0
+    app.executor_threads[0].core = FailingCore()
+    conn_a = FakeConnection()
+    conn_b = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=a?https://stop/1', ('127.0.0.1', 1), conn_a)
+    app.process_get_stop_info('getStopInfo?id=b?https://stop/1', ('127.0.0.1', 2), conn_b)
+    app.executor_threads[0].perform_query_extraction_and_execution()
+    for conn, query_id in ((conn_a, 'a'), (conn_b, 'b')):
+        assert conn.messages()[-1]['id'] == query_id
+        assert conn.messages()[-1]['error'] == app.RESULT_GET_ERROR
+        assert conn.messages()[-1]['expect_more_data'] is False
+    assert app.executor_threads[0].current_query is None
+    assert not app.pending_queries
+
+    # Next identical query should go to the Query Queue again
+    app.process_get_stop_info('getStopInfo?id=c?https://stop/1', ('127.0.0.1', 2), conn_b)
+    assert len(app.query_queue) == 1
+    assert 'coalesced' not in conn_b.messages()[-1]
+
+
+def test_echo_is_not_coalesced():
+    """
+    getEcho queries should always be executed separately.
+    """
+    app = make_application()
+    conn = FakeConnection()
+    app.process_echo('getEcho?id=1?hello', ('127.0.0.1', 1), conn)
+    app.process_echo('getEcho?id=2?hello', ('127.0.0.1', 1), conn)
+    assert len(app.query_queue) == 2
+
+# ---------------------------------------------   network loop     --------------------------------------------------- #
+
+def test_network_loop_reads_queries_and_closes_connections():
+    """
+    Queries from client connections should be processed by the network loop, closed connections removed.
+    """
+    app = make_application()
+    app.open_selector()
+    server_side, client_side = socket.socketpair()
+    conn = ClientConnection(server_side, ('127.0.0.1', 1))
+    app.register_connection(conn)
+
+    client_side.sendall(b'getEcho?id=1?hello\ngetCurrent')
+    app.read_connection(conn)
+    client_side.sendall(b'Queue\n')
+    app.read_connection(conn)
+    assert len(app.query_queue) == 1
+    assert next(iter(app.query_queue))['conn'] is conn
+    responses = client_side.recv(4096).decode('utf-8').split('\n\0')
+    assert json.loads(responses[0]) == {'id': '1', 'response': 'OK', 'queue_position': 0}
+
+    client_side.close()
+    app.read_connection(conn)
+    assert not app.connections
+    app.close_selector()
+
+
+def test_query_split_across_reads():
+    """
+    Text protocol queries should be assembled from several pieces of received data.
+    """
+    conn = ClientConnection(None, ('127.0.0.1', 1))
+    conn.feed(b'getStopInfo?id=1?https://st')
+    assert conn.next_query() is None
+    conn.feed(b'op/1\r\ngetEcho?id=2?hi\n\ngetLi')
+    assert conn.next_query() == 'getStopInfo?id=1?https://stop/1'
+    assert conn.next_query() == 'getEcho?id=2?hi'
+    assert conn.next_query() == ''
+    assert conn.next_query() is None
+    assert conn.in_buffer == b'getLi'
+    assert not conn.feed(b'x' * (ClientConnection.MAX_QUERY_SIZE + 10))
+
+
+def test_protocol_v2_negotiation():
+    """
+    After "setProtocol" query both queries and responses should be length-prefixed frames.
+    """
+    app = make_application()
+    app.open_selector()
+    server_side, client_side = socket.socketpair()
+    conn = ClientConnection(server_side, ('127.0.0.1', 1))
+    app.register_connection(conn)
+
+    query = b'getEcho?id=1?hello'
+    client_side.sendall(b'setProtocol?version=2&encoding=json\n' + struct.pack('>I', len(query)) + query)
+    app.read_connection(conn)
+    assert len(app.query_queue) == 1
+
+    data = client_side.recv(4096)
+    response, _, data = data.partition(b'\n\0')
+    assert json.loads(response.decode('utf-8')) == {'response': 'OK', 'protocol': 2, 'encoding': 'json'}
+    length, = struct.unpack('>I', data[:4])
+    assert length == len(data) - 4
+    assert json.loads(data[4:].decode('utf-8')) == {'id': '1', 'response': 'OK', 'queue_position': 0}
+
+    client_side.close()
+    app.read_connection(conn)
+    app.close_selector()
+
+
+def read_frames(sock, data, count):
+    """
+    Read protocol version 2 frames from the socket, data is what is already received.
+    :return: list of (compressed, payload)
+    """
+    frames = []
+    sock.settimeout(5)
+    while True:
+        while len(data) >= 4:
+            header, = struct.unpack('>I', data[:4])
+            length = header & ClientConnection.FRAME_COMPRESSED - 1
+            if len(data) < 4 + length:
+                break
+            frames.append((bool(header & ClientConnection.FRAME_COMPRESSED), data[4:4 + length]))
+            data = data[4 + length:]
+        if len(frames) >= count:
+            return frames
+        data += sock.recv(65536)
+
+
+def test_protocol_v2_compression():
+    """
+    Responses above the threshold should be compressed, as parts of one zlib stream, small ones should not.
+    """
+    app = make_application()
+    app.open_selector()
+    server_side, client_side = socket.socketpair()
+    conn = ClientConnection(server_side, ('127.0.0.1', 1))
+    app.register_connection(conn)
+
+    client_side.sendall(b'setProtocol?version=1&compression=zlib\n')
+    app.read_connection(conn)
+    assert json.loads(client_side.recv(4096)[:-2])['message'] == 'Compression requires protocol version 2'
+
+    text = ' '.join('Stop ' + str(i) for i in range(500))
+    queries = [b'setProtocol?version=2&compression=zlib&threshold=500&stream=1\n']
+    for query_id in ('1', '2'):
+        query = b'getEcho?id=' + query_id.encode('utf-8') + b'?' + text.encode('utf-8')
+        queries.append(struct.pack('>I', len(query)) + query)
+    client_side.sendall(b''.join(queries))
+    while len(app.query_queue) < 2:
+        app.read_connection(conn)
+    for _ in range(2):
+        app.executor_threads[0].perform_query_extraction_and_execution()
+
+    response, _, data = client_side.recv(65536).partition(b'\n\0')
+    assert json.loads(response) == {'response': 'OK', 'protocol': 2, 'encoding': 'json', 'compression': 'zlib',
+                                    'threshold': 500, 'level': 6, 'stream': True}
+    frames = read_frames(client_side, data, 4)
+    assert [compressed for compressed, _ in frames] == [False, False, True, True]
+    assert json.loads(frames[0][1])['response'] == 'OK'
+    decompressor = zlib.decompressobj()
+    assert json.loads(decompressor.decompress(frames[2][1]))['data'] == text
+    assert json.loads(decompressor.decompress(frames[3][1]))['id'] == '2'
+    # Second response is almost the same as the first one, it's mostly references to it
+    assert len(frames[3][1]) < len(frames[2][1]) / 10
+
+    client_side.close()
+    app.read_connection(conn)
+    app.close_selector()
+
+
+def test_slow_client_does_not_block_sender():
+    """
+    Sending to a client which does not read should fill its outbound buffer, not block the sender.
+    Overflow policy decides what happens next.
+    """
+    app = make_application()
+    app.open_selector()
+    server_side, client_side = socket.socketpair()
+    server_side.setblocking(False)
+    conn = ClientConnection(server_side, ('127.0.0.1', 1))
+    conn.max_out_buffer_size = 64 * 1024
+    conn.overflow_policy = ClientConnection.OVERFLOW_DROP
+    app.register_connection(conn)
+
+    message = {'data': 'x' * 16 * 1024}
+    sizes = [app.send_message(message, conn.addr, conn) for _ in range(0, 100)]
+    assert 0 < conn.out_buffer_size <= conn.max_out_buffer_size
+    assert sizes[-1] == 0
+    assert conn in app.pending_output
+
+    # Client reads everything, network loop sends the rest of the buffer
+    client_side.setblocking(False)
+    received = 0
+    while True:
+        try:
+            received += len(client_side.recv(1024 * 1024))
+        except BlockingIOError:
+            if not conn.has_output():
+                break
+            app.write_connection(conn)
+    assert received == sum(sizes)
+
+    conn.overflow_policy = ClientConnection.OVERFLOW_DISCONNECT
+    for _ in range(0, 100):
+        app.send_message(message, conn.addr, conn)
+    assert conn.should_close
+    app.process_pending_output()
+    assert not app.connections
+    client_side.close()
+    app.close_selector()
+
+# ---------------------------------------------    network log     --------------------------------------------------- #
+
+def test_network_log_writer(tmp_path):
+    """
+    Network log writer should write all records in background, rotate and compress the log.
+    """
+    log_file = str(tmp_path / 'network.log')
+    writer = NetworkLogWriter(log_file, max_size=100)
+    writer.start()
+    assert writer.write(b'x' * 60)
+    assert writer.write(b'y' * 60)
+    writer.stop()
+
+    rotated = [name for name in os.listdir(str(tmp_path)) if name.endswith('.gz')]
+    assert len(rotated) == 1
+    with gzip.open(str(tmp_path / rotated[0]), 'rb') as f:
+        assert f.read() == b'60\n' + b'x' * 60 + b'\n\n' + b'60\n' + b'y' * 60 + b'\n\n'
+    assert not os.path.exists(log_file)
+
+
+def test_network_log_writer_rotates_old_log(tmp_path):
+    """
+    Log file older than max_age should be rotated even if it's small, and kept as is if compression is off.
+    """
+    log_file = str(tmp_path / 'network.log')
+    writer = NetworkLogWriter(log_file, max_age=0.5, compress=False)
+    writer.write_batch([b'old'])
+    writer.rotate_if_needed()
+    assert os.path.exists(log_file)
+    writer.file_opened_time -= 1
+    writer.rotate_if_needed()
+    assert writer.file is None
+    writer.write_batch([b'new'])
+    writer.file.close()
+
+    rotated = [name for name in os.listdir(str(tmp_path)) if name != 'network.log']
+    assert len(rotated) == 1
+    assert not rotated[0].endswith('.gz')
+    with open(str(tmp_path / rotated[0]), 'rb') as f:
+        assert f.read() == b'3\nold\n\n'
+    with open(log_file, 'rb') as f:
+        assert f.read() == b'3\nnew\n\n'
+
+
+def test_network_log_writer_rotates_twice_in_same_second(tmp_path):
+    """
+    Second rotation within the same second should not overwrite the compressed file of the first one.
+    """
+    log_file = str(tmp_path / 'network.log')
+    writer = NetworkLogWriter(log_file, max_size=1)
+    writer.write_batch([b'first'])
+    writer.rotate_if_needed()
+    writer.write_batch([b'second'])
+    writer.rotate_if_needed()
+
+    rotated = sorted(name for name in os.listdir(str(tmp_path)))
+    assert len(rotated) == 2
+    assert all(name.endswith('.gz') for name in rotated)
+    contents = set()
+    for name in rotated:
+        with gzip.open(str(tmp_path / name), 'rb') as f:
+            contents.add(f.read())
+    assert contents == {b'5\nfirst\n\n', b'6\nsecond\n\n'}
+
+
+def test_network_log_writer_keeps_running_on_disk_errors(tmp_path):
+    """
+    Failure to write the log file should be logged and the batch dropped, without stopping the writer.
+    """
+    log_file = str(tmp_path / 'missing' / 'network.log')
+    writer = NetworkLogWriter(log_file)
+    writer.write_batch([b'lost', b'lost'])
+    assert writer.file is None
+    assert writer.dropped == 2
+
+    os.mkdir(str(tmp_path / 'missing'))
+    writer.write_batch([b'kept'])
+    writer.file.close()
+    with open(log_file, 'rb') as f:
+        assert f.read() == b'4\nkept\n\n'
+
+
+def test_network_log_writer_drops_when_full(tmp_path):
+    """
+    Writing to the full queue should drop the record instead of blocking.
+    """
+    writer = NetworkLogWriter(str(tmp_path / 'network.log'), queue_size=1)
+    assert writer.write(b'1')
+    assert not writer.write(b'2')
+    assert writer.dropped == 1
+
+# ---------------------------------------------  fair scheduling    -------------------------------------------------- #
+
+def test_clients_are_served_in_turn():
+    """
+    A client with a lot of queries should not starve other clients, queue positions should reflect that.
+    """
+    app = make_application()
+    conn_a = FakeConnection(('127.0.0.1', 1))
+    conn_b = FakeConnection(('127.0.0.1', 2))
+    for i in range(0, 3):
+        app.process_echo('getEcho?id=a' + str(i) + '?hello', conn_a.addr, conn_a)
+    app.process_echo('getEcho?id=b0?hello', conn_b.addr, conn_b)
+    app.process_echo('getEcho?id=b1&priority=5?hello', conn_b.addr, conn_b)
+
+    assert conn_b.messages()[-2]['queue_position'] == 1
+    assert conn_b.messages()[-1]['queue_position'] == 1
+    assert [entry['id'] for entry in json.loads(app.get_current_queue())] == ['a0', 'b1', 'a1', 'b0', 'a2']
+    assert [app.query_queue.popleft()['id'] for _ in range(0, 5)] == ['a0', 'b1', 'a1', 'b0', 'a2']
+    assert not app.query_queue
+
+
+def test_tenant_key_shares_sub_queue():
+    """
+    Queries from different connections with the same tenant key should share one sub-queue.
+    """
+    app = make_application()
+    conn_a = FakeConnection(('127.0.0.1', 1))
+    conn_b = FakeConnection(('127.0.0.1', 2))
+    conn_c = FakeConnection(('127.0.0.1', 3))
+    app.process_echo('getEcho?id=a&tenant=dashboard?hello', conn_a.addr, conn_a)
+    app.process_echo('getEcho?id=b&tenant=dashboard?hello', conn_b.addr, conn_b)
+    app.process_echo('getEcho?id=c?hello', conn_c.addr, conn_c)
+    assert [entry['id'] for entry in json.loads(app.get_current_queue())] == ['a', 'c', 'b']
+    assert conn_a.messages()[-1]['id'] == 'a'
+
+# ------------------------------------------  cancellation and deadlines  -------------------------------------------- #
+
+def test_cancel_query():
+    """
+    Cancelled query should be removed from the Query Queue, coalesced query should stay for other clients.
+    """
+    app = make_application()
+    conn_a = FakeConnection(('127.0.0.1', 1))
+    conn_b = FakeConnection(('127.0.0.1', 2))
+    app.process_get_stop_info('getStopInfo?id=a?https://stop/1', conn_a.addr, conn_a)
+    app.process_get_stop_info('getStopInfo?id=b?https://stop/1', conn_b.addr, conn_b)
+    app.process_echo('getEcho?id=e?hello', conn_a.addr, conn_a)
+
+    app.process_cancel_query('cancelQuery?id=e', conn_a)
+    assert conn_a.messages()[-1] == {'id': 'e', 'response': 'OK', 'message': 'Query cancelled'}
+    app.process_cancel_query('cancelQuery?id=b', conn_a)
+    assert conn_a.messages()[-1]['response'] == 'ERROR'
+    app.process_cancel_query('cancelQuery?id=a', conn_a)
+    assert len(app.query_queue) == 1
+
+    app.executor_threads[0].perform_query_extraction_and_execution()
+    assert conn_b.messages()[-1]['id'] == 'b'
+    # Nothing is sent to the cancelled client
+    assert conn_a.messages()[-1] == {'id': 'a', 'response': 'OK', 'message': 'Query cancelled'}
+
+
+def test_closed_connection_queries_are_purged():
+    """
+    Queries of closed connection should be removed from the Query Queue.
+    """
+    app = make_application()
+    app.open_selector()
+    server_side, client_side = socket.socketpair()
+    conn = ClientConnection(server_side, ('127.0.0.1', 1))
+    app.register_connection(conn)
+    client_side.sendall(b'getEcho?id=1?hello\ngetStopInfo?id=2?https://stop/1\n')
+    app.read_connection(conn)
+    assert len(app.query_queue) == 2
+
+    client_side.close()
+    app.read_connection(conn)
+    assert not app.query_queue
+    assert not app.pending_queries
+    app.close_selector()
+
+
+def test_query_deadline():
+    """
+    Queries past their deadline should be dropped with an error, without being executed.
+    """
+    app = make_application()
+    conn = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=1&deadline=0.05?https://stop/1', conn.addr, conn)
+    app.process_get_stop_info('getStopInfo?id=2&deadline=60?https://stop/2', conn.addr, conn)
+    time.sleep(0.1)
+
+    app.expire_queries()
+    assert len(app.query_queue) == 1
+    assert conn.messages()[-1] == {'id': '1', 'method': 'getStopInfo', 'error': Application.RESULT_DEADLINE_EXPIRED,
+                                   'message': 'Query deadline expired', 'expect_more_data': False}
+
+    app.executor_threads[0].perform_query_extraction_and_execution()
+    assert app.executor_threads[0].core.urls == ['https://stop/2']
+
+# ---------------------------------------------   worker wakeup    --------------------------------------------------- #
+
+class RecordingCondition(threading.Condition):
+    """
+    Condition which remembers notifications, and when a thread starts waiting on it.
+    """
+    def __init__(self, lock):
+        super().__init__(lock)
+        self.notified = []
+        self.waiting = threading.Event()
+
+    def wait(self, timeout=None):
+        """Remember the wait"""
+        self.waiting.set()
+        return super().wait(timeout)
+
+    def notify(self, n=1):
+        """Remember the notification"""
+        self.notified.append('notify')
+        super().notify(n)
+
+    def notify_all(self):
+        """Remember the notification"""
+        self.notified.append('notify_all')
+        super().notify_all()
+
+
+def test_idle_worker_wakes_up_and_stops_immediately():
+    """
+    Idle worker should wait for the queue condition with no timeout, new query and stopping the server
+    should notify it, so it wakes up right away instead of polling.
+    """
+    app = make_application()
+    app.queue_condition = RecordingCondition(app.queue_lock)
+    executor = app.executor_threads[0]
+    executor.start()
+    assert app.queue_condition.waiting.wait(5)
+
+    conn = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=1?https://stop/1', conn.addr, conn)
+    assert app.queue_condition.notified == ['notify']
+    # Worker waits with no timeout, only the notification could have woken it up
+    assert wait_for_messages(conn, 3)[-1]['id'] == '1'
+
+    app.stop()
+    assert 'notify_all' in app.queue_condition.notified
+    executor.join(5)
+    assert not executor.is_alive()
+
+# ---------------------------------------------  startup, status    -------------------------------------------------- #
+
+class SlowStartCore(FakeCore):
+    """
+    Fake core which takes some time to start the browser.
+    """
+    def start_webdriver(self):
+        """Pretend to start the browser slowly"""
+        time.sleep(0.3)
+        self.running = True
+
+
+def test_queries_are_held_until_worker_is_ready():
+    """
+    Queries received while browsers are starting should wait in the queue, getStatus should report readiness.
+    """
+    app = make_application()
+    app.listen_time = 0.01
+    executor = ExecutorThread(app, 0, SlowStartCore())
+    app.executor_threads = [executor]
+    executor.start()
+
+    conn = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=1?https://stop/1', conn.addr, conn)
+    app.process_query('getStatus', conn)
+    status = conn.messages()[-1]
+    assert status['ready'] is False
+    assert status['queue_size'] == 1
+    assert status['workers'] == [{'worker': 0, 'ready': False, 'startup_time': None, 'ready_time': None,
+                                  'first_query_time': None}]
+
+    executor.join(0.5)
+    assert conn.messages()[-1]['id'] == '1'
+    app.process_query('getStatus', conn)
+    status = conn.messages()[-1]
+    assert status['ready'] is True
+    assert status['workers'][0]['startup_time'] >= 0.3
+    assert status['workers'][0]['first_query_time'] is not None
+    assert status['ready_time'] == status['workers'][0]['ready_time']
+
+    app.stop()
+    executor.join(5)
+
+# ---------------------------------------------  browser recycling  -------------------------------------------------- #
+
+def test_browser_is_recycled_with_standby():
+    """
+    Standby browser should be started and warmed up in background, then swapped in between queries.
+    """
+    app = make_application()
+    app.create_core = FakeCore
+    executor = app.executor_threads[0]
+    old_core = executor.core
+    old_core.running = True
+    conn = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=1?https://stop/1', conn.addr, conn)
+    executor.perform_query_extraction_and_execution()
+
+    old_core.recycle_reason = '1000 network queries'
+    executor.check_recycling()
+    executor.standby_thread.join(5)
+    # Old browser still serves queries until the swap
+    assert executor.core is old_core
+    executor.check_recycling()
+    assert executor.core is not old_core
+    assert executor.core.running
+    assert executor.core.warm_up_url == 'https://stop/1'
+    for thread in executor.stopping_threads:
+        thread.join(5)
+    assert not old_core.running
+
+
+class FailingStartCore(FakeCore):
+    """
+    Fake YandexTransportCore, fails to start the browser a few times.
+    """
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.stopped = 0
+
+    def start_webdriver(self):
+        """Fail to start the browser, until there are no more failures left"""
+        if self.failures > 0:
+            self.failures -= 1
+            raise WebDriverException("Chrome failed to start")
+        self.running = True
+
+    def stop_webdriver(self):
+        """Count clean-ups"""
+        self.stopped += 1
+        self.running = False
+
+
+def test_worker_retries_to_start_browser():
+    """
+    Worker which failed to start the browser should be reported not ready and try again, then serve queries.
+    """
+    app = make_application()
+    app.recycle_retry_interval = 0.05
+    core = FailingStartCore(failures=2)
+    executor = ExecutorThread(app, 0, core)
+    app.executor_threads = [executor]
+    conn = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=1?https://stop/1', conn.addr, conn)
+    executor.start()
+
+    deadline = time.time() + 5
+    while not executor.ready and time.time() < deadline:
+        time.sleep(0.01)
+    assert executor.ready
+    assert not executor.failed
+    assert core.stopped == 2
+    assert wait_for_messages(conn, 3)[-1]['id'] == '1'
+    assert app.check_threads()
+
+    app.stop()
+    executor.join(5)
+
+
+def test_dead_worker_does_not_stop_server():
+    """
+    Dead worker should be marked as failed and skipped, the server should stop only without any executor worker.
+    """
+    app = make_application(workers=2)
+    dead_executor, executor = app.executor_threads
+    app.is_running = False
+    dead_executor.start()
+    dead_executor.join(5)
+    app.is_running = True
+    executor.start()
+
+    assert app.check_threads()
+    assert dead_executor.failed
+    assert not executor.failed
+
+    app.stop()
+    executor.join(5)
+    assert not app.check_threads()
+
+
+class SlowStopCore(FakeCore):
+    """
+    Fake YandexTransportCore, takes a while to stop the browser.
+    """
+    def stop_webdriver(self):
+        """Pretend to stop the browser slowly"""
+        time.sleep(0.2)
+        self.running = False
+
+
+def test_replaced_browser_is_stopped_before_worker_exits():
+    """
+    Worker should wait for replaced browsers to stop before it exits.
+    """
+    app = make_application()
+    app.create_core = FakeCore
+    executor = app.executor_threads[0]
+    old_core = SlowStopCore()
+    old_core.running = True
+    old_core.recycle_reason = '1000 network queries'
+    executor.core = old_core
+    executor.check_recycling()
+    executor.standby_thread.join(5)
+    executor.check_recycling()
+    assert executor.core is not old_core
+
+    executor.start()
+    app.stop()
+    executor.join(5)
+    assert not old_core.running
+    assert not executor.stopping_threads
+
+# ---------------------------------------------   rate limiting    --------------------------------------------------- #
+
+def test_rate_limiter_burst_and_rate():
+    """
+    Burst of queries should go without delay, then one query per 1/rate secs.
+    """
+    limiter = RateLimiter(rate=10, burst=2)
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 0
+    wait_time = limiter.try_acquire()
+    assert 0 < wait_time <= 0.1
+    time.sleep(wait_time)
+    assert limiter.try_acquire() == 0
+
+
+def test_rate_limiter_backoff():
+    """
+    Backoff should start after several failures in a row and grow exponentially, success should reset it.
+    """
+    limiter = RateLimiter()
+    assert limiter.report(False) == 0
+    assert limiter.report(False) == 0
+    assert limiter.report(False) == limiter.BACKOFF_BASE
+    assert limiter.report(False) == limiter.BACKOFF_BASE * 2
+    assert limiter.try_acquire() > limiter.BACKOFF_BASE
+    assert limiter.report(True) == 0
+    assert limiter.failures == 0
+
+
+def test_rate_limiter_backoff_reset_on_success():
+    """
+    Success should lift the backoff right away, and the next failures should start counting from zero.
+    """
+    limiter = RateLimiter()
+    for _ in range(limiter.BACKOFF_THRESHOLD):
+        limiter.report(False)
+    assert limiter.try_acquire() > 0
+    assert limiter.report(True) == 0
+    assert limiter.try_acquire() == 0
+    for _ in range(limiter.BACKOFF_THRESHOLD - 1):
+        assert limiter.report(False) == 0
+    assert limiter.try_acquire() == 0
+    assert limiter.report(False) == limiter.BACKOFF_BASE
+
+
+def test_navigation_limit_applies_only_to_page_loads():
+    """
+    Queries made without the browser (direct fetch mode) should not wait for the navigation limiter,
+    queries loading the page should, giving the query token back meanwhile. Warming up takes a navigation token.
+    """
+    app = make_application()
+    app.rate_limiter = RateLimiter(rate=100, burst=2)
+    app.navigation_limiter = RateLimiter(rate=0.5, burst=1)
+    executor = app.executor_threads[0]
+    executor.core.browser_needed = False
+    conn = FakeConnection()
+    for i in range(0, 3):
+        app.process_get_stop_info('getStopInfo?id=' + str(i) + '?https://stop/' + str(i), conn.addr, conn)
+    assert executor.perform_query_extraction_and_execution() == 0
+    assert executor.perform_query_extraction_and_execution() == 0
+    assert app.navigation_limiter.tokens == 1
+
+    executor.core.browser_needed = True
+    time.sleep(0.02)
+    assert executor.perform_query_extraction_and_execution() == 0
+    app.process_get_stop_info('getStopInfo?id=3?https://stop/3', conn.addr, conn)
+    assert executor.perform_query_extraction_and_execution() > 1
+    assert executor.core.urls == ['https://stop/0', 'https://stop/1', 'https://stop/2']
+    assert app.rate_limiter.tokens >= 1
+
+    app.create_core = FakeCore
+    executor.last_url = 'https://stop/2'
+    executor.start_standby()
+    assert executor.standby_core.warm_up_url is None
+
+
+def test_rate_limit_applies_only_to_yandex_queries():
+    """
+    Queries going to Yandex wait for the rate limiter in the Query Queue, other queries are executed right away.
+    """
+    app = make_application()
+    app.rate_limiter = RateLimiter(rate=0.5, burst=1)
+    conn = FakeConnection()
+    app.process_get_stop_info('getStopInfo?id=1?https://stop/1', conn.addr, conn)
+    app.process_get_stop_info('getStopInfo?id=2?https://stop/2', conn.addr, conn)
+
+    executor = app.executor_threads[0]
+    assert executor.perform_query_extraction_and_execution() == 0
+    assert executor.perform_query_extraction_and_execution() > 1
+    assert executor.core.urls == ['https://stop/1']
+    assert len(app.query_queue) == 1
+
+    app.query_queue.remove(next(iter(app.query_queue)))
+    app.process_echo('getEcho?id=3?hello', conn.addr, conn)
+    assert executor.perform_query_extraction_and_execution() == 0
+    assert conn.messages()[-1]['id'] == '3'
+    assert executor.perform_query_extraction_and_execution() is None
+
+# ---------------------------------------------      watches       --------------------------------------------------- #
+
+class FakeWatchCore:
+    """
+    Fake YandexTransportCore for watches, each poll returns the next saved batch of vehicles info.
+    """
+    def __init__(self, updates):
+        self.updates = list(updates)
+        self.url = None
+        self.stopped = False
+        self.profile_template_dir = None
+
+    def start_webdriver(self):
+        """Browser is not needed"""
+
+    def watch_vehicles_info(self, url):
+        """Remember watched URL"""
+        self.url = url
+        return YandexTransportCore.RESULT_OK
+
+    def get_watch_updates(self):
+        """Return next batch of updates"""
+        if self.updates:
+            return self.updates.pop(0), YandexTransportCore.RESULT_OK
+        return [], YandexTransportCore.RESULT_OK
+
+    def stop_watch(self):
+        """Remember the watch is stopped"""
+        self.stopped = True
+
+
+def wait_for_messages(conn, count):
+    """
+    Wait until the connection receives this many messages.
+    """
+    started = time.monotonic()
+    while len(conn.messages()) < count and time.monotonic() - started < 5:
+        time.sleep(0.01)
+    return conn.messages()
+
+
+def test_watch_streams_new_responses():
+    """
+    Watch should send each new vehicles info as a separate message, and end with the final one when cancelled.
+    Normal queries should not be blocked meanwhile.
+    """
+    app = make_application()
+    app.watch_poll_interval = 0.01
+    update = {'url': 'https://api/getVehiclesInfoWithRegion', 'method': 'getVehiclesInfoWithRegion', 'error': 'OK'}
+    core = FakeWatchCore([[dict(update, data={'n': 1})], [], [dict(update, data={'n': 2})]])
+    watch_thread = WatchThread(app, 0, core)
+    app.watch_threads = [watch_thread]
+    watch_thread.start()
+
+    conn = FakeConnection()
+    app.process_query('watchVehiclesInfo?id=w?https://stop/1', conn)
+    assert conn.messages()[0] == {'id': 'w', 'response': 'OK', 'message': 'Watch started'}
+    messages = wait_for_messages(conn, 3)
+    assert [message['data'] for message in messages[1:3]] == [{'n': 1}, {'n': 2}]
+    assert all(message['expect_more_data'] for message in messages[1:3])
+    assert core.url == 'https://stop/1'
+
+    # Second watch is refused, the only watch worker is busy; normal queries still go to the Query Queue
+    other = FakeConnection(('127.0.0.1', 2))
+    app.process_query('watchVehiclesInfo?id=x?https://stop/2', other)
+    assert other.messages()[-1]['response'] == 'ERROR'
+    app.process_query('getStopInfo?id=s?https://stop/1', other)
+    assert len(app.query_queue) == 1
+
+    app.process_query('cancelWatch?id=w', conn)
+    messages = wait_for_messages(conn, 5)
+    assert {'id': 'w', 'response': 'OK', 'message': 'Watch cancelled'} in messages
+    assert messages[-1]['expect_more_data'] is False
+    assert messages[-1]['message'] == 'Watch cancelled'
+
+    app.stop()
+    watch_thread.join(5)
+    assert not watch_thread.is_alive()
+    assert core.stopped
+
+# ---------------------------------------------  streaming results   ------------------------------------------------- #
+
+class StreamingCore(FakeCore):
+    """
+    Fake YandexTransportCore, gives away getAllInfo results one by one, the rest only when released.
+    """
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def iter_info(self, query_type, url):
+        """Return fake getAllInfo results"""
+        self.urls.append(url)
+        yield {'url': url, 'method': 'getRouteInfo', 'error': 'OK', 'data': {'route': 1}}, \
+            YandexTransportCore.RESULT_OK
+        self.release.wait(5)
+        yield {'url': url, 'method': 'getLine', 'error': 'Failed to parse JSON'}, YandexTransportCore.RESULT_OK
+        yield {'url': url, 'method': 'getStopInfo', 'error': 'OK', 'data': {'stop': 1}}, \
+            YandexTransportCore.RESULT_OK
+
+
+def test_results_are_streamed():
+    """
+    Results should be sent as soon as they are extracted, the end is marked by a message with
+    "expect_more_data": False.
+    """
+    app = make_application()
+    core = StreamingCore()
+    app.executor_threads[0].core = core
+    conn = FakeConnection()
+    app.process_get_all_info('getAllInfo?id=1?https://stop/1', conn.addr, conn)
+    worker = threading.Thread(target=app.executor_threads[0].perform_query_extraction_and_execution)
+    worker.start()
+
+    # Acknowledgement and the first result, while the core is still working
+    messages = wait_for_messages(conn, 2)
+    assert worker.is_alive()
+    assert [message.get('method') for message in messages[1:]] == ['getRouteInfo']
+    assert messages[1]['expect_more_data'] is True
+
+    core.release.set()
+    worker.join(5)
+    messages = conn.messages()[1:]
+    assert [(message['method'], message['error'], message['expect_more_data']) for message in messages] == \
+        [('getRouteInfo', app.RESULT_OK, True),
+         ('getLine', app.RESULT_NO_DATA, True),
+         ('getStopInfo', app.RESULT_OK, True),
+         ('getAllInfo', app.RESULT_OK, False)]
+    assert 'data' not in messages[-1]
+    assert app.cache.get('getAllInfo', 'https://stop/1')[-1]['expect_more_data'] is False
+
+
+def test_subscriber_arriving_mid_stream():
+    """
+    Identical query arriving while results are being sent should get all of them, including ones sent before,
+    without executing the query again.
+    """
+    app = make_application()
+    app.cache.max_entries = 0
+    core = StreamingCore()
+    app.executor_threads[0].core = core
+    conn_a = FakeConnection(('127.0.0.1', 1))
+    conn_b = FakeConnection(('127.0.0.1', 2))
+    app.process_get_all_info('getAllInfo?id=a?https://stop/1', conn_a.addr, conn_a)
+    worker = threading.Thread(target=app.executor_threads[0].perform_query_extraction_and_execution)
+    worker.start()
+    wait_for_messages(conn_a, 2)
+
+    app.process_get_all_info('getAllInfo?id=b?https://stop/1', conn_b.addr, conn_b)
+    assert conn_b.messages()[0]['coalesced'] is True
+    core.release.set()
+    worker.join(5)
+
+    assert core.urls == ['https://stop/1']
+    for conn, query_id in ((conn_a, 'a'), (conn_b, 'b')):
+        messages = conn.messages()[1:]
+        assert [(message['id'], message['method']) for message in messages] == \
+            [(query_id, 'getRouteInfo'), (query_id, 'getLine'), (query_id, 'getStopInfo'), (query_id, 'getAllInfo')]
+    assert not app.pending_queries
+
+
+def test_final_results_are_cached_before_detach():
+    """
+    Identical query arriving right after the results are sent should hit the cache, not execute the query again.
+    """
+    app = make_application()
+    core = StreamingCore()
+    core.release.set()
+    app.executor_threads[0].core = core
+    conn = FakeConnection()
+    app.process_get_all_info('getAllInfo?id=1?https://stop/1', conn.addr, conn)
+    app.executor_threads[0].perform_query_extraction_and_execution()
+    assert not app.pending_queries
+    app.process_get_all_info('getAllInfo?id=2?https://stop/1', conn.addr, conn)
+    assert not app.query_queue
+    assert core.urls == ['https://stop/1']
+    assert conn.messages()[-1]['id'] == '2'
+    assert conn.messages()[-1]['expect_more_data'] is False
+
+# ---------------------------------------------  JSON passthrough    ------------------------------------------------- #
+
+def test_json_passthrough_does_not_parse(monkeypatch):
+    """
+    Big Yandex response passed through should never be parsed, neither by the core nor by the encoder,
+    and the client should get the same data. Timings are in benchmarks/json_passthrough.py.
+    """
+    body = json.dumps({'data': {'features': [{'id': str(i), 'name': 'Stop ' + str(i)} for i in range(100)]}})
+    query = {'url': 'https://yandex.ru/maps/api/masstransit/getLine?id=1', 'method': "maps/api/masstransit/getLine"}
+    conn = ClientConnection(None, ('127.0.0.1', 0))
+    core = YandexTransportCore()
+    core.json_passthrough = True
+
+    def fail_to_parse(*args, **kwargs):
+        raise AssertionError("JSON should not be parsed")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(json, 'loads', fail_to_parse)
+        patch.setattr(RawJSON, 'loads', staticmethod(fail_to_parse))
+        entry = core._make_api_result(query, body)
+        data = conn.encode({'id': '1', 'method': entry['method'], 'error': 0, 'message': 'OK',
+                            'expect_more_data': True, 'data': entry['data']})
+
+    assert isinstance(entry['data'], RawJSON)
+    assert data.endswith(b'\n\0')
+    assert json.loads(data[:-2])['data'] == json.loads(body)
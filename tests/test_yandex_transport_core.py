@@ -12,7 +12,16 @@ import random
 import selenium
 import time
 import json
-from yandex_transport_core import YandexTransportCore
+import gzip
+import threading
+import subprocess
+import types
+import os
+import http.server
+import socketserver
+from collections import OrderedDict
+from collections import defaultdict
+from yandex_transport_core import YandexTransportCore, RawJSON
 
 # STOP URL's
 # Probably replace this to "ConstructURL" in the future to increase randomness.
@@ -89,7 +98,7 @@ def test_get_chromium_networking_data():
     print("Stop name:", url['url'])
     core.driver.get(url['url'])
     # Getting Chromium Network Data
-    data = json.loads(core.get_chromium_networking_data())
+    data = core.get_chromium_networking_data()
     found_input_url = False
     for entry in data:
         if entry['name'] == url['url']:
@@ -120,3 +129,643 @@ def test_get_yandex_json():
     method = "maps/api/masstransit/getRouteInfo"
     result, error = core._get_yandex_json(url, method)
     assert (result is None) and (error == YandexTransportCore.RESULT_GET_ERROR)
+
+# --------------------------------------------- _wait_for_api_queries ------------------------------------------------ #
+class FakeDriver:
+    """
+    Fake webdriver, each call returns networking data entries which appeared since the previous call,
+    simulating API queries made by the page over time.
+    """
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.calls = 0
+        self.script_args = None
+
+    def execute_script(self, script, *args):
+        """Return new networking data for the current moment of the timeline"""
+        self.script_args = args
+        data = self.timeline[self.calls] if self.calls < len(self.timeline) else []
+        self.calls += 1
+        return data
+
+
+def test_wait_for_api_queries_returns_when_all_methods_found():
+    """
+    Waiting should stop as soon as requested method appears, not after the full timeout.
+    """
+    url = 'https://yandex.ru/maps/stop'
+    page = {'name': url}
+    stop_info = {'name': 'https://yandex.ru/maps/api/masstransit/getStopInfo?id=1'}
+    core = YandexTransportCore()
+    core.wait_poll_interval = 0.01
+    core.driver = FakeDriver([[page], [], [stop_info]])
+
+    start_time = time.time()
+    api_method = ("maps/api/masstransit/getStopInfo",)
+    capture = {"url_reached": False, "queries": []}
+    data = core._wait_for_api_queries(
+        lambda: core._find_api_queries(core.get_chromium_networking_data(api_method), url, api_method, capture),
+        api_method)
+    assert time.time() - start_time < 1
+    assert core.driver.calls == 3
+    assert data == [{'url': stop_info['name'], 'method': "maps/api/masstransit/getStopInfo"}]
+    # Filtering by API methods should be done in the browser
+    assert core.driver.script_args == (["maps/api/masstransit/getStopInfo"], core.resource_timing_buffer_size)
+
+
+def test_wait_for_api_queries_settles_for_several_methods():
+    """
+    If several methods are requested and not all of them appear, waiting should stop after settle time.
+    """
+    url = 'https://yandex.ru/maps/stop'
+    page = {'name': url}
+    line = {'name': 'https://yandex.ru/maps/api/masstransit/getLine?id=1'}
+    core = YandexTransportCore()
+    core.wait_poll_interval = 0.01
+    core.wait_settle_time = 0.1
+    core.wait_timeout = 10
+    core.driver = FakeDriver([[page], [line]])
+
+    start_time = time.time()
+    api_method = ("maps/api/masstransit/getLine", "maps/api/masstransit/getStopInfo")
+    capture = {"url_reached": False, "queries": []}
+    data = core._wait_for_api_queries(
+        lambda: core._find_api_queries(core.get_chromium_networking_data(api_method), url, api_method, capture),
+        api_method)
+    assert time.time() - start_time < 1
+    assert data == [{'url': line['name'], 'method': "maps/api/masstransit/getLine"}]
+
+
+def test_wait_for_api_queries_timeout():
+    """
+    Waiting should stop after timeout if requested method never appears.
+    """
+    url = 'https://yandex.ru/maps/stop'
+    core = YandexTransportCore()
+    core.wait_poll_interval = 0.01
+    core.wait_timeout = 0.1
+    core.driver = FakeDriver([[{'name': url}]])
+
+    api_method = ("maps/api/masstransit/getStopInfo",)
+    capture = {"url_reached": False, "queries": []}
+    data = core._wait_for_api_queries(
+        lambda: core._find_api_queries(core.get_chromium_networking_data(api_method), url, api_method, capture),
+        api_method)
+    assert data == []
+
+
+class FakeFetchDriver(FakeDriver):
+    """
+    Fake webdriver which also "fetches" API responses from inside the page.
+    """
+    def __init__(self, timeline, bodies):
+        super().__init__(timeline)
+        self.bodies = bodies
+        self.visited = []
+
+    def get(self, url):
+        """Remember visited URL"""
+        self.visited.append(url)
+
+    def set_script_timeout(self, timeout):
+        """Script timeout is not used here"""
+
+    def execute_async_script(self, script, urls):
+        """Return saved API responses"""
+        return [{'url': url, 'status': 200, 'body': self.bodies[url]} for url in urls]
+
+
+def test_get_yandex_json_fetches_responses_in_page():
+    """
+    API responses should be fetched from inside the page, without navigating to each of them.
+    """
+    url = 'https://yandex.ru/maps/stop'
+    line_url = 'https://yandex.ru/maps/api/masstransit/getLine?id=1'
+    stop_url = 'https://yandex.ru/maps/api/masstransit/getStopInfo?id=1'
+    core = YandexTransportCore()
+    core.wait_poll_interval = 0.01
+    core.driver = FakeFetchDriver([[{'name': url}, {'name': line_url}, {'name': stop_url}]],
+                                  {line_url: '{"line": 1}', stop_url: 'not json'})
+
+    result, error = core._get_yandex_json(url, ("maps/api/masstransit/getLine", "maps/api/masstransit/getStopInfo"))
+    assert error == YandexTransportCore.RESULT_OK
+    assert core.driver.visited == [url]
+    assert result == [{'url': line_url, 'method': 'getLine', 'error': 'OK', 'data': {'line': 1}},
+                      {'url': stop_url, 'method': 'getStopInfo', 'error': 'Failed to parse JSON'}]
+
+def test_iter_yandex_json_streams_results():
+    """
+    Each result should be given away as soon as it's fetched, while the page is still making other API queries.
+    Responses fetched from inside the page appear in its networking data, they should not be found again.
+    """
+    url = 'https://yandex.ru/maps/stop'
+    line_url = 'https://yandex.ru/maps/api/masstransit/getLine?id=1'
+    stop_url = 'https://yandex.ru/maps/api/masstransit/getStopInfo?id=1'
+    core = YandexTransportCore()
+    core.wait_poll_interval = 0.01
+    core.driver = FakeFetchDriver([[{'name': url}, {'name': line_url}], [{'name': line_url}], [], [{'name': stop_url}]],
+                                  {line_url: '{"line": 1}', stop_url: '{"stop": 1}'})
+
+    results = core._iter_yandex_json(url, ("maps/api/masstransit/getLine", "maps/api/masstransit/getStopInfo"))
+    result, error = next(results)
+    assert error == YandexTransportCore.RESULT_OK
+    assert result['method'] == 'getLine'
+    assert core.driver.calls == 1
+    assert list(results) == [({'url': stop_url, 'method': 'getStopInfo', 'error': 'OK', 'data': {'stop': 1}},
+                              YandexTransportCore.RESULT_OK)]
+    assert core.driver.calls == 4
+    assert core.driver.visited == [url]
+
+
+def test_get_watch_updates_returns_new_entries_only():
+    """
+    Watch should return only API responses which appeared since the last poll, without reloading the page.
+    """
+    url = 'https://yandex.ru/maps/stop'
+    page = {'name': url, 'entryType': 'navigation'}
+    first = {'name': 'https://yandex.ru/maps/api/masstransit/getVehiclesInfoWithRegion?id=1', 'entryType': 'resource'}
+    second = {'name': 'https://yandex.ru/maps/api/masstransit/getVehiclesInfoWithRegion?id=2', 'entryType': 'resource'}
+    core = YandexTransportCore()
+    # Responses fetched by the watch itself appear in networking data too
+    core.driver = FakeFetchDriver([[page], [first], [first], [second]],
+                                  {first['name']: '{"n": 1}', second['name']: '{"n": 2}'})
+
+    assert core.watch_vehicles_info(url) == YandexTransportCore.RESULT_OK
+    updates = [core.get_watch_updates() for _ in range(0, 4)]
+    assert all(error == YandexTransportCore.RESULT_OK for _, error in updates)
+    assert [[entry['data'] for entry in data] for data, _ in updates] == [[], [{'n': 1}], [], [{'n': 2}]]
+    # Each response is reported once, as the most specific method
+    assert updates[1][0][0]['method'] == 'getVehiclesInfoWithRegion'
+    assert core.driver.visited == [url]
+
+# ------------------------------------------- JSON passthrough ----------------------------------------------------- #
+def test_make_api_result_json_passthrough():
+    """
+    In JSON passthrough mode bodies should be checked and kept as they are, and spliced into messages as is.
+    """
+    query = {'url': 'https://yandex.ru/maps/api/masstransit/getLine?id=1', 'method': "maps/api/masstransit/getLine"}
+    core = YandexTransportCore()
+    core.json_passthrough = True
+
+    result = core._make_api_result(query, ' {"data": {"name": "А"}}\n')
+    assert result['error'] == 'OK'
+    assert result['data'] == RawJSON('{"data": {"name": "А"}}'.encode('utf-8'))
+    assert result['data'].parse() == {'data': {'name': 'А'}}
+    for body in ('', '<html>Error</html>', '{"data": {"name": "truncat', '{"data": "\0"}'):
+        assert core._make_api_result(query, body)['error'] == 'Failed to parse JSON'
+
+    message = {'id': '1', 'method': 'getLine', 'expect_more_data': False, 'data': result['data']}
+    assert json.loads(RawJSON.dumps(message)) == dict(message, data={'data': {'name': 'А'}})
+    assert RawJSON.resolve(message) == dict(message, data={'data': {'name': 'А'}})
+    message = {'id': '1', 'data': {'name': 'А'}}
+    assert RawJSON.dumps(message) == json.dumps(message).encode('utf-8')
+
+
+# ------------------------------------------- browser recycling ---------------------------------------------------- #
+class FakeServiceDriver:
+    """
+    Fake webdriver, its ChromeDriver service process is a real process, so its memory can be measured.
+    """
+    def __init__(self, pid):
+        self.service = types.SimpleNamespace(process=types.SimpleNamespace(pid=pid))
+
+
+def test_get_browser_rss_includes_child_processes():
+    """
+    Memory of the browser is memory of ChromeDriver and all its children (Chromium processes).
+    """
+    child = subprocess.Popen(['sleep', '10'])
+    try:
+        core = YandexTransportCore()
+        core.driver = FakeServiceDriver(child.pid)
+        child_rss = core.get_browser_rss()
+        core.driver = FakeServiceDriver(os.getpid())
+        own_rss = core.get_browser_rss()
+    finally:
+        child.kill()
+        child.wait()
+    assert child_rss > 0
+    assert own_rss > child_rss
+
+
+def test_get_recycle_reason():
+    """
+    Browser should be recycled after too many queries or when it's too old, never if limits are not set.
+    """
+    core = YandexTransportCore()
+    core.started_time = time.time()
+    core.network_queries_count = 10
+    assert core.get_recycle_reason() is None
+    core.recycle_queries = 10
+    assert core.get_recycle_reason() == '10 network queries'
+    core.recycle_queries = 0
+    core.recycle_age = 60
+    assert core.get_recycle_reason() is None
+    core.started_time -= 61
+    assert core.get_recycle_reason() == '61 secs old'
+
+
+def test_get_recycle_reason_checks_memory_rarely():
+    """
+    Memory of the browser should be checked at most once per rss_check_interval, the last result is used meanwhile.
+    """
+    core = YandexTransportCore()
+    core.recycle_rss = 100 * 1024 * 1024
+    rss_values = [10 * 1024 * 1024, 200 * 1024 * 1024]
+    core.get_browser_rss = lambda: rss_values.pop(0)
+    assert core.get_recycle_reason() is None
+    assert core.get_recycle_reason() is None
+    assert len(rss_values) == 1
+    core.rss_checked_time -= core.rss_check_interval
+    assert core.get_recycle_reason() == '200 MB of memory'
+    assert not rss_values
+
+# ------------------------------------------- resource blocking ---------------------------------------------------- #
+class FakeCdpDriver:
+    """
+    Fake webdriver, remembers DevTools commands.
+    """
+    def __init__(self):
+        self.commands = []
+
+    def execute_cdp_cmd(self, cmd, params):
+        """Remember the command"""
+        self.commands.append((cmd, params))
+        return {}
+
+
+def test_configure_page_loading_blocks_urls():
+    """
+    Blocked URL patterns should be passed to the browser, nothing should be blocked by default.
+    """
+    core = YandexTransportCore()
+    core.driver = FakeCdpDriver()
+    core._configure_page_loading()
+    assert [cmd for cmd, _ in core.driver.commands] == ['Page.addScriptToEvaluateOnNewDocument']
+
+    core.blocked_urls = YandexTransportCore.DEFAULT_BLOCKED_URLS
+    core.driver = FakeCdpDriver()
+    core._configure_page_loading()
+    assert ('Network.setBlockedURLs', {'urls': list(YandexTransportCore.DEFAULT_BLOCKED_URLS)}) in \
+           core.driver.commands
+
+# ------------------------------------------- browser profile ------------------------------------------------------ #
+def test_copy_profile(tmp_path):
+    """
+    Browser should get a copy of the seeded profile, without lock files of the browser that seeded it.
+    """
+    template = tmp_path / 'template'
+    (template / 'Default' / 'Cache').mkdir(parents=True)
+    (template / 'Default' / 'Cache' / 'data_0').write_text('cached script')
+    (template / 'SingletonLock').write_text('lock')
+    (template / YandexTransportCore.PROFILE_SEEDED_FILE).write_text('')
+
+    core = YandexTransportCore()
+    core.profile_template_dir = str(template)
+    assert core.is_profile_seeded()
+    core.profile_dir = core._copy_profile()
+    profile_dir = core.profile_dir
+    try:
+        assert core.profile_dir != str(template)
+        assert open(os.path.join(core.profile_dir, 'Default', 'Cache', 'data_0')).read() == 'cached script'
+        assert not os.path.exists(os.path.join(core.profile_dir, 'SingletonLock'))
+        assert not os.path.exists(os.path.join(core.profile_dir, YandexTransportCore.PROFILE_SEEDED_FILE))
+    finally:
+        core.stop_webdriver()
+    assert not os.path.exists(profile_dir)
+    assert (template / 'SingletonLock').exists()
+
+
+# ------------------------------------------ DevTools capture mode --------------------------------------------------- #
+class FakeDevToolsDriver:
+    """
+    Fake webdriver which has DevTools network events in its "performance" log.
+    """
+    def __init__(self, events, bodies):
+        self.log = [{'message': json.dumps({'message': event})} for event in events]
+        self.bodies = bodies
+
+    def get_log(self, log_type):
+        """Return and clear "performance" log"""
+        log, self.log = self.log, []
+        return log
+
+    def execute_cdp_cmd(self, cmd, params):
+        """Return saved response body"""
+        return {'body': self.bodies[params['requestId']], 'base64Encoded': False}
+
+
+def test_find_devtools_api_queries():
+    """
+    Only finished responses of requested API methods should be returned, with their bodies available from DevTools.
+    """
+    stop_url = 'https://yandex.ru/maps/api/masstransit/getStopInfo?id=1'
+    line_url = 'https://yandex.ru/maps/api/masstransit/getLine?id=1'
+    events = [{'method': 'Network.responseReceived', 'params': {'requestId': '1', 'response': {'url': stop_url}}},
+              {'method': 'Network.responseReceived', 'params': {'requestId': '2', 'response': {'url': line_url}}},
+              {'method': 'Network.responseReceived',
+               'params': {'requestId': '3', 'response': {'url': 'https://yandex.ru/tile.png'}}},
+              {'method': 'Network.loadingFinished', 'params': {'requestId': '1'}},
+              {'method': 'Network.loadingFinished', 'params': {'requestId': '3'}}]
+    core = YandexTransportCore()
+    core.driver = FakeDevToolsDriver(events, {'1': '{"stop": 1}'})
+    capture = {"responses": OrderedDict(), "finished": set()}
+    api_method = ("maps/api/masstransit/getStopInfo", "maps/api/masstransit/getLine")
+
+    last_query = core._find_devtools_api_queries(api_method, capture)
+    assert last_query == [{'url': stop_url, 'method': "maps/api/masstransit/getStopInfo", 'request_id': '1'}]
+    assert core._get_devtools_api_responses(last_query) == {stop_url: '{"stop": 1}'}
+
+
+# Stand-in for Yandex Maps page, it makes fake Masstransit API calls some time after being loaded.
+STAND_IN_PAGE = """<html><body>Stand-in<script>
+setTimeout(function() { fetch('/maps/api/masstransit/getStopInfo?id=stop_1'); }, 300);
+setTimeout(function() { fetch('/maps/api/masstransit/getLine?id=line_1'); }, 600);
+</script></body></html>"""
+
+# Stand-in page loading heavy resources like the real one does: map tiles, images, fonts, analytics.
+# Each of them is slow and big.
+STAND_IN_HEAVY_PAGE = """<html><head><style>
+@font-face { font-family: 'Stand-in'; src: url('/fonts/stand-in.woff2'); }
+body { font-family: 'Stand-in'; }
+</style></head><body>Stand-in
+<img src="/tiles/1.png"><img src="/tiles/2.png"><img src="/tiles/3.png"><img src="/tiles/4.png">
+<script>
+fetch('/analytics/hit');
+fetch('/tiles/vector?x=1').then(function() {
+  fetch('/maps/api/masstransit/getStopInfo?id=stop_1');
+}, function() {
+  fetch('/maps/api/masstransit/getStopInfo?id=stop_1');
+});
+</script></body></html>"""
+STAND_IN_HEAVY_DELAY = 0.5
+STAND_IN_HEAVY_SIZE = 512 * 1024
+STAND_IN_BLOCKED_URLS = ('*/tiles/*', '*/analytics/*', '*.woff2')
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Request handler of the stand-in server, serves the stand-in page and fake API responses.
+    """
+    # Keep-alive connections, like Yandex does
+    protocol_version = 'HTTP/1.1'
+    # Number of connections accepted
+    connections = 0
+    # Number of API requests received, by path, and Cookie headers they had
+    api_requests = defaultdict(int)
+    api_cookies = []
+    # CSRF token of the session, API requests with another one get a new token instead of data. None - not checked.
+    csrf_token = None
+    # Number of requests of heavy resources received, and bytes sent for them
+    heavy_requests = 0
+    heavy_bytes = 0
+    # Answer API requests with a broken gzip body
+    corrupt_gzip = False
+
+    def setup(self):
+        """Count connections"""
+        StandInHandler.connections += 1
+        super().setup()
+
+    def do_GET(self):
+        """Serve GET request"""
+        if self.path.startswith('/maps/api/masstransit/'):
+            StandInHandler.api_requests[self.path] += 1
+            StandInHandler.api_cookies.append(self.headers.get('Cookie'))
+            if StandInHandler.csrf_token is not None and \
+                    'csrfToken=' + StandInHandler.csrf_token not in self.path:
+                body = json.dumps({'csrfToken': StandInHandler.csrf_token}).encode('utf-8')
+            else:
+                body = json.dumps({'path': self.path}).encode('utf-8')
+            content_type = 'application/json'
+            if StandInHandler.corrupt_gzip:
+                body = gzip.compress(body)[:-8]
+        elif self.path.startswith('/maps/heavy'):
+            body = STAND_IN_HEAVY_PAGE.encode('utf-8')
+            content_type = 'text/html'
+        elif self.path.startswith(('/tiles/', '/fonts/', '/analytics/')):
+            time.sleep(STAND_IN_HEAVY_DELAY)
+            StandInHandler.heavy_requests += 1
+            StandInHandler.heavy_bytes += STAND_IN_HEAVY_SIZE
+            body = b'\0' * STAND_IN_HEAVY_SIZE
+            content_type = 'application/octet-stream'
+        else:
+            body = STAND_IN_PAGE.encode('utf-8')
+            content_type = 'text/html'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if StandInHandler.corrupt_gzip and content_type == 'application/json':
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep test output clean"""
+
+
+class StandInServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Local HTTP stand-in for Yandex Maps.
+    """
+    daemon_threads = True
+
+
+@pytest.fixture
+def stand_in_url():
+    """
+    Start local stand-in server, return URL of the stand-in page.
+    """
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    StandInHandler.connections = 0
+    StandInHandler.api_requests.clear()
+    StandInHandler.api_cookies = []
+    StandInHandler.csrf_token = None
+    StandInHandler.heavy_requests = 0
+    StandInHandler.heavy_bytes = 0
+    StandInHandler.corrupt_gzip = False
+    yield 'http://127.0.0.1:' + str(server.server_address[1]) + '/maps/stop'
+    server.shutdown()
+    server.server_close()
+
+
+class FakeSessionDriver:
+    """
+    Fake Selenium driver with session state of the browser
+    """
+    def get_cookies(self):
+        """Cookies of the page"""
+        return [{'name': 'yandexuid', 'value': '42'}, {'name': 'i', 'value': 'abc'}]
+
+    def execute_script(self, script, *args):
+        """navigator.userAgent"""
+        return 'Stand-in Agent'
+
+
+def test_get_yandex_json_direct(stand_in_url):
+    """
+    In direct fetch mode queries the page made should be repeated over one keep-alive HTTP connection
+    with the browser session, without the browser. Expired session means the page should be loaded again.
+    """
+    api_method = ("maps/api/masstransit/getStopInfo",)
+    api_url = stand_in_url.replace('/maps/stop', '/maps/api/masstransit/getStopInfo?ajax=1&csrfToken=token_1&id=1')
+    core = YandexTransportCore()
+    core.fetch_mode = YandexTransportCore.FETCH_MODE_DIRECT
+    core.driver = FakeSessionDriver()
+    core._harvest_session(stand_in_url, api_method, [{'url': api_url, 'method': api_method[0], 'request_id': '1'}])
+    assert core.direct.session['cookies'] == 'yandexuid=42; i=abc'
+    assert core.direct.session['csrf_token'] == 'token_1'
+    assert core.direct.session['user_agent'] == 'Stand-in Agent'
+
+    # Browser is not running, it should not be needed
+    core.driver = None
+    StandInHandler.csrf_token = 'token_1'
+    try:
+        for _ in range(3):
+            result, error = core._get_yandex_json(stand_in_url, api_method)
+            assert error == YandexTransportCore.RESULT_OK
+            assert result == [{'url': api_url, 'method': 'getStopInfo', 'error': 'OK',
+                               'data': {'path': '/maps/api/masstransit/getStopInfo?ajax=1&csrfToken=token_1&id=1'}}]
+        assert StandInHandler.connections == 1
+        assert StandInHandler.api_cookies == ['yandexuid=42; i=abc'] * 3
+
+        # Query of another page is not known yet
+        result, error = core._get_yandex_json(stand_in_url + '2', api_method)
+        assert error == YandexTransportCore.RESULT_WEBDRIVER_NOT_RUNNING
+
+        # Session expired, the page should be loaded in the browser again
+        StandInHandler.csrf_token = 'token_2'
+        result, error = core._get_yandex_json(stand_in_url, api_method)
+        assert error == YandexTransportCore.RESULT_WEBDRIVER_NOT_RUNNING
+        assert core.direct.session is None
+
+        # New session from another page, known queries should use its token
+        core.driver = FakeSessionDriver()
+        core._harvest_session(stand_in_url + '2', api_method,
+                              [{'url': api_url.replace('token_1', 'token_2'), 'method': api_method[0]}])
+        core.driver = None
+        result, error = core._get_yandex_json(stand_in_url, api_method)
+        assert error == YandexTransportCore.RESULT_OK
+        assert result[0]['data'] == {'path': '/maps/api/masstransit/getStopInfo?ajax=1&csrfToken=token_2&id=1'}
+
+        # Session is too old
+        core.direct.session['time'] -= core.direct.ttl + 1
+        result, error = core._get_yandex_json(stand_in_url, api_method)
+        assert error == YandexTransportCore.RESULT_WEBDRIVER_NOT_RUNNING
+    finally:
+        core.direct.close_http_connections()
+
+
+def test_get_yandex_json_direct_template(stand_in_url):
+    """
+    Pages never loaded should get direct queries from the template made by two other pages of the same kind,
+    with values of their own URL. Failed template should be forgotten.
+    """
+    api_method = ("maps/api/masstransit/getStopInfo",)
+    api_url = stand_in_url.replace('/maps/stop', '/maps/api/masstransit/getStopInfo?ajax=1&csrfToken=token_1&id=')
+    core = YandexTransportCore()
+    core.fetch_mode = YandexTransportCore.FETCH_MODE_DIRECT
+    core.driver = FakeSessionDriver()
+    core._harvest_session(stand_in_url + '?stopId=stop__111&z=17', api_method,
+                          [{'url': api_url + 'stop__111', 'method': api_method[0]}])
+    core.driver = None
+    StandInHandler.csrf_token = 'token_1'
+    try:
+        # One page is not enough to tell values of the page from constants
+        assert core.needs_browser('getStopInfo', stand_in_url + '?stopId=stop__333&z=17')
+        result, error = core._get_yandex_json(stand_in_url + '?stopId=stop__333&z=17', api_method)
+        assert error == YandexTransportCore.RESULT_WEBDRIVER_NOT_RUNNING
+
+        core.driver = FakeSessionDriver()
+        core._harvest_session(stand_in_url + '?stopId=stop__222&z=16', api_method,
+                              [{'url': api_url + 'stop__222', 'method': api_method[0]}])
+        core.driver = None
+        assert not core.needs_browser('getStopInfo', stand_in_url + '?stopId=stop__333&z=17')
+        queries_count = core.network_queries_count
+        result, error = core._get_yandex_json(stand_in_url + '?stopId=stop__333&z=17', api_method)
+        assert error == YandexTransportCore.RESULT_OK
+        assert result[0]['data'] == {'path': '/maps/api/masstransit/getStopInfo?ajax=1&csrfToken=token_1&id=stop__333'}
+        assert core.network_queries_count == queries_count + 1
+
+        # Pages of another kind
+        result, error = core._get_yandex_json(stand_in_url + '?stopId=stop__333', api_method)
+        assert error == YandexTransportCore.RESULT_WEBDRIVER_NOT_RUNNING
+
+        # Failed template should be verified again
+        core.direct.session['csrf_token'] = 'token_2'
+        result, error = core._get_yandex_json(stand_in_url + '?stopId=stop__444&z=17', api_method)
+        assert error == YandexTransportCore.RESULT_WEBDRIVER_NOT_RUNNING
+        assert not core.direct.templates
+    finally:
+        core.direct.close_http_connections()
+
+
+def test_get_yandex_json_direct_corrupt_gzip(stand_in_url):
+    """
+    Broken gzip body of a direct query should drop the session, so the page will be loaded again, not raise.
+    """
+    api_method = ("maps/api/masstransit/getStopInfo",)
+    api_url = stand_in_url.replace('/maps/stop', '/maps/api/masstransit/getStopInfo?ajax=1&id=1')
+    core = YandexTransportCore()
+    core.fetch_mode = YandexTransportCore.FETCH_MODE_DIRECT
+    core.driver = FakeSessionDriver()
+    core._harvest_session(stand_in_url, api_method, [{'url': api_url, 'method': api_method[0]}])
+    core.driver = None
+    StandInHandler.corrupt_gzip = True
+    try:
+        result, error = core._get_yandex_json(stand_in_url, api_method)
+        assert error == YandexTransportCore.RESULT_WEBDRIVER_NOT_RUNNING
+        assert core.direct.session is None
+        assert not core.direct.http_connections
+    finally:
+        core.direct.close_http_connections()
+
+
+def test_get_yandex_json_devtools_capture(stand_in_url):
+    """
+    In DevTools capture mode API responses should be taken from the page load itself, with no extra requests.
+    """
+    core = YandexTransportCore()
+    core.capture_mode = YandexTransportCore.CAPTURE_MODE_DEVTOOLS
+    core.start_webdriver()
+    try:
+        result, error = core._get_yandex_json(stand_in_url, ("maps/api/masstransit/getStopInfo",
+                                                             "maps/api/masstransit/getLine"))
+    finally:
+        core.stop_webdriver()
+
+    assert error == YandexTransportCore.RESULT_OK
+    assert [entry['method'] for entry in result] == ['getStopInfo', 'getLine']
+    assert result[0]['data'] == {'path': '/maps/api/masstransit/getStopInfo?id=stop_1'}
+    assert dict(StandInHandler.api_requests) == {'/maps/api/masstransit/getStopInfo?id=stop_1': 1,
+                                                 '/maps/api/masstransit/getLine?id=line_1': 1}
+
+
+def test_resource_blocking(stand_in_url):
+    """
+    Stand-in page with heavy resources should not request them with resource blocking,
+    API queries should still be found with heavy resources blocked.
+    """
+    heavy_url = stand_in_url.replace('/maps/stop', '/maps/heavy')
+    results = {}
+    for blocking in (False, True):
+        core = YandexTransportCore()
+        core.wait_settle_time = 0
+        core.blocked_urls = STAND_IN_BLOCKED_URLS if blocking else ()
+        core.block_images = blocking
+        core.start_webdriver()
+        StandInHandler.heavy_requests = 0
+        StandInHandler.heavy_bytes = 0
+        try:
+            result, error = core._get_yandex_json(heavy_url, ("maps/api/masstransit/getStopInfo",))
+        finally:
+            core.stop_webdriver()
+        assert error == YandexTransportCore.RESULT_OK
+        assert [entry['method'] for entry in result] == ['getStopInfo']
+        results[blocking] = (StandInHandler.heavy_requests, StandInHandler.heavy_bytes)
+
+    assert results[True] == (0, 0)
+    assert results[False][0] > 0
+    assert results[False][1] > 0
@@ -24,537 +24,445 @@ import time
 import sys
 import json
 import signal
-import socket
 import re
 import threading
-from collections import deque
-from collections import defaultdict
+from urllib.parse import parse_qsl
 import argparse
 import setproctitle
-from yandex_transport_core import YandexTransportCore, Logger
+from yandex_transport_core import YandexTransportCore, RawJSON, ResponseCache, QueryScheduler, RateLimiter, \
+    NetworkServer, ExecutorThread, WatchThread
 
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
-def chunks(arr, n):
+class Application(NetworkServer):
     """
-    Helper function to slice array into smaller size chunks.
-    Is used in "send_message".
-    :param arr: an array
-    :param n: size of a chunk
-    :return: array of n-sized chunks
-    """
-    for i in range(0, len(arr), n):
-        # Create an index range for l of n items:
-        yield arr[i:i+n]
-
-
-class ListenerThread(threading.Thread):
-    """
-    Listener thread class, will listen to incoming queries.
+    Main application class
     """
-    def __init__(self, conn, addr, app):
-        super().__init__()
-        self.app = app
-        self.conn = conn
-        self.addr = addr
-
-    def run(self):
-        self.app.log.info("Connection established : " + str(self.addr))
-
-        while self.app.is_running:
-            self.conn.settimeout(5)
-            try:
-                data = self.conn.recvfrom(4096)
-            except socket.timeout:
-                continue
-
-            if data != (b'', None):
-                string = data[0].decode("utf-8")
-                lines = string.splitlines()
-                for line in lines:
-                    query = line.strip()
-                    self.app.log.debug("Received : " + str(query))
-
-                    if query == 'getCurrentQueue':
-                        self.app.process_get_current_queue(self.conn)
-
-                    elif query.startswith('getStopInfo?'):
-                        self.app.process_get_stop_info(query, self.addr, self.conn)
-
-                    elif query.startswith('getVehiclesInfo?'):
-                        self.app.process_get_vehicles_info(query, self.addr, self.conn)
-
-                    elif query.startswith('getVehiclesInfoWithRegion?'):
-                        self.app.process_get_vehicles_info_with_region(query, self.addr, self.conn)
+    # Error codes
+    RESULT_OK = 0
+    RESULT_NO_DATA = 1
+    RESULT_GET_ERROR = 2
+    RESULT_NO_YANDEX_DATA = 3
+    RESULT_DEADLINE_EXPIRED = 4
 
-                    elif query.startswith('getRouteInfo?'):
-                        self.app.process_get_route_info(query, self.addr, self.conn)
+    # Identical queries of these types (same type and URL) are executed once, result is sent to all requesters
+    COALESCED_QUERIES = ('getStopInfo', 'getVehiclesInfo', 'getVehiclesInfoWithRegion', 'getRouteInfo',
+                         'getLine', 'getLayerRegions', 'getAllInfo')
 
-                    elif query.startswith('getLine?'):
-                        self.app.process_get_line(query, self.addr, self.conn)
+    # Queries of these types go to Yandex, they are limited by the rate limiter
+    UPSTREAM_QUERIES = COALESCED_QUERIES
 
-                    elif query.startswith('getLayerRegions?'):
-                        self.app.process_get_layer_regions(query, self.addr, self.conn)
+    def __init__(self):
+        super().__init__()
+        setproctitle.setproctitle('transport_proxy')
 
-                    elif query.startswith('getAllInfo?'):
-                        self.app.process_get_all_info(query, self.addr, self.conn)
+        # Average delay between queries to Yandex of each worker, in secs, may be fractional.
+        self.query_delay = 5
 
-                    elif query.startswith('getEcho?'):
-                        self.app.process_echo(query, self.addr, self.conn)
+        # Number of queries to Yandex which can be executed without delay after a quiet period.
+        self.query_burst = 1
+
+        # Average delay between page loads in the browser of each worker, in secs, None - same as query_delay.
+        # Queries made directly over HTTP (direct fetch mode) don't load pages, warming up standby browsers does.
+        self.navigation_delay = None
+
+        # Number of executor workers, each one runs its own Chromium instance.
+        self.workers = 1
+
+        # Maximum time to wait for Yandex API responses after the page is loaded, in secs.
+        self.wait_timeout = 30
+
+        # How to capture Yandex API responses: Performance API of the page, or DevTools network events
+        self.capture_mode = YandexTransportCore.CAPTURE_MODE_PERFORMANCE
+
+        # How to get bodies of Yandex API responses: fetch them from the page, navigate to each one,
+        # or query them directly over HTTP with the browser session
+        self.fetch_mode = YandexTransportCore.FETCH_MODE_FETCH
+        # Pass bodies of Yandex responses to clients as they are, without parsing and serializing them again
+        self.json_passthrough = True
+        # Direct fetch mode: how long the browser session is used before the page is loaded in the browser again
+        self.session_ttl = 600
+
+        # Resources the browser should not load: URL patterns, and images. Nothing is blocked by default.
+        self.blocked_urls = ()
+        self.block_images = False
+
+        # Browser profile template with seeded disk cache, every browser starts with a copy of it.
+        # None - browsers start in incognito mode, with empty cache.
+        self.profile_dir = None
+        # Page loaded to seed the profile, once, if it's not seeded yet
+        self.profile_seed_url = 'https://yandex.ru/maps/213/moscow/'
+        # Only one worker seeds the profile, others wait for it
+        self.profile_lock = threading.Lock()
+
+        # Executor threads (workers)
+        self.executor_threads = []
+
+        # Browsers of executor workers are recycled after this many queries to Yandex, when they use more than
+        # this many bytes of memory, or after this many secs, 0 - never. Standby browser is started before that.
+        self.recycle_queries = 1000
+        self.recycle_memory = 1536 * 1024 * 1024
+        self.recycle_age = 6 * 3600
+        # If a browser (standby one, or the first one of a worker) failed to start, wait this many secs before
+        # trying again
+        self.recycle_retry_interval = 60
+
+        # Number of watch workers, each one runs its own Chromium instance and serves one watch at a time.
+        self.watch_workers = 1
+        # How often watch workers look for new API responses, in secs.
+        self.watch_poll_interval = 1
+        # Watch threads (watch workers)
+        self.watch_threads = []
 
-                    else:
-                        self.app.process_unknown_query(self.conn)
-            else:
-                self.app.log.info("Connection terminated : " + str(self.addr))
-                break
+        # Queue lock
+        self.queue_lock = threading.Lock()
+        # Idle executor workers wait on this for new queries, or for the server to stop
+        self.queue_condition = threading.Condition(self.queue_lock)
+        # Workers which failed to start the browser wait on this before trying again, or for the server to stop
+        self.start_retry_condition = threading.Condition(self.queue_lock)
 
-        self.conn.shutdown(socket.SHUT_RDWR)
-        self.app.log.debug("Thread for connection ( " + str(self.addr) + " ) terminated")
-        del self.app.listeners[self.addr]
-# -------------------------------------------------------------------------------------------------------------------- #
+        # Last Query ID, will increment with each query added to the Queue
+        self.query_id = 0
 
+        # Cache of responses to get...Info queries
+        self.cache = ResponseCache()
 
-class ExecutorThread(threading.Thread):
-    """
-    Executor thread, single thread to pick and execute queries from Query Queue.
-    """
-    def __init__(self, app):
-        super().__init__()
-        self.app = app
+        # Rate limiter of queries to Yandex, shared by all workers, configured in run()
+        self.rate_limiter = RateLimiter()
+        # Rate limiter of page loads in the browser, shared by all workers, configured in run()
+        self.navigation_limiter = RateLimiter()
 
-        # Flag to check if exeturoe thread is running.
-        # In case it fails - program should terminate / Executor Thread should restart.
-        # Let's stick with "terminate" scenario for now
+        # Incoming queries are stored here, executor workers pick them one by one, serving clients in turn.
+        self.query_queue = QueryScheduler()
 
-        # Time to wait between queries
-        self.wait_time = self.app.query_delay
-        # Time to wait between watch updates
-        self.watch_wait_time = 5
+        # Queries which are waiting in the Query Queue or being executed, by (query type, canonical URL).
+        # New identical queries will subscribe to these instead of being added to the Query Queue.
+        # Protected by queue_lock.
+        self.pending_queries = {}
 
-    def send_message(self, message, addr, conn, log_tag=None):
+    def stop(self):
         """
-        Send a message to the server
-        :param message: message to send
-        :param addr: address (from socket bind/accept)
-        :param conn: connection
-        :param log_tag: tag which will append to log message
+        Tell the network loop and all executor workers to stop, they wake up right away.
+        Threads are joined in run(), after the network loop exits.
         :return: nothing
         """
-        if log_tag is not None:
-            log_tag_text = " (" + log_tag + ")"
-        else:
-            log_tag_text = ""
-        try:
-            send_msg = bytes(str(message) + '\n' + '\0', 'utf-8')
-
-            self.app.log.debug("Writing to " + self.app.network_log_file + " "
-                               "(" + str(len(send_msg)) + " bytes) ")
-            if self.app.network_log_enabled:
-                f = open(self.app.network_log_file, 'ab')
-                f.write(bytes(str(len(send_msg))+'\n', 'utf-8'))
-                f.write(send_msg)
-                f.write(bytes('\n\n', 'utf-8'))
-                f.close()
-
-            self.app.log.debug("Sending response " +
-                               "(" + str(len(send_msg)) + " bytes) "
-                               "to " + str(addr) + log_tag_text)
-
-            # It seems data needs to be sent in chunks, JSON objects with size of several kilobytes
-            # effectively break "sending in one piece" strategy.
-            buffer_size = 4096
-            for chunk in chunks(send_msg, buffer_size):
-                bytes_send = conn.send(chunk)
-                if bytes_send != len(chunk):
-                    self.app.log.error("Sent " + str(bytes_send) + "out of " + str(len(chunk)) + "bytes!")
-
-        except socket.error as e:
-            self.app.log.error("Failed to send data to " + str(addr))
-            self.app.log.error("Exception (send_message):" + str(e))
-
-    def execute_get_info(self, query):
-        """
-        Execute general get... query.
-        :param query: internal 'query' dictionary
-        :return: result as JSON
-        """
-        if query['type'] == 'getStopInfo':
-            data, error = self.app.core.get_stop_info(url=query['body'])
-        elif query['type'] == 'getRouteInfo':
-            data, error = self.app.core.get_route_info(url=query['body'])
-        elif query['type'] == 'getLine':
-            data, error = self.app.core.get_line(url=query['body'])
-        elif query['type'] == 'getVehiclesInfo':
-            data, error = self.app.core.get_vehicles_info(url=query['body'])
-        elif query['type'] == 'getVehiclesInfoWithRegion':
-            data, error = self.app.core.get_vehicles_info_with_region(url=query['body'])
-        elif query['type'] == 'getLayerRegions':
-            data, error = self.app.core.get_layer_regions(url=query['body'])
-        elif query['type'] == 'getAllInfo':
-            data, error = self.app.core.get_all_info(url=query['body'])
-        else:
-            return
-
-        payload = []
-        if error == YandexTransportCore.RESULT_OK:
-            for entry in data:
-                if 'data' in entry:
-                    result = {'id': query['id'],
-                              'method': entry['method'],
-                              'error': self.app.RESULT_OK,
-                              'message': 'OK',
-                              'expect_more_data': True,
-                              'data': entry['data']}
-                    payload.append(result)
-                else:
-                    result = {'id': query['id'],
-                              'method': entry['method'],
-                              'error': self.app.RESULT_NO_DATA,
-                              'message': 'No data',
-                              'expect_more_data': True,
-                              }
-                    payload.append(result)
-        elif error == YandexTransportCore.RESULT_GET_ERROR:
-            result = {'id': query['id'],
-                      'method': query['type'],
-                      'error': self.app.RESULT_GET_ERROR,
-                      'message': 'Error getting requested URL',
-                      'expect_more_data': False}
-            payload.append(result)
-
-        if payload:                                   # Same as "if len(payload) > 0:"
-            payload[-1]['expect_more_data'] = False
-        else:
-            result = {'id': query['id'],
-                      'method': query['type'],
-                      'error': self.app.RESULT_NO_YANDEX_DATA,
-                      'message': 'No Yandex Masstransit API data received for method ' + query['type'] +
-                                 ' from URL "' + query['body'] + '"',
-                      'expect_more_data': False}
-            payload.append(result)
-
-        for entry in payload:
-            self.send_message(json.dumps(entry), query['addr'], query['conn'], log_tag=entry['method'])
-
-    def execute_get_echo(self, query):
-        """
-        Execute "getEcho" command.
+        self.is_running = False
+        self.queue_lock.acquire()
+        self.queue_condition.notify_all()
+        self.start_retry_condition.notify_all()
+        for watch_thread in self.watch_threads:
+            watch_thread.condition.notify_all()
+        self.queue_lock.release()
+        self.wakeup()
+
+    def check_threads(self):
+        """
+        Check if worker threads are alive, dead ones are marked as failed and reported once.
+        Called by the network loop.
+        :return: True if at least one executor worker is alive
+        """
+        for thread in self.executor_threads + self.watch_threads:
+            if not thread.failed and not thread.is_alive():
+                thread.failed = True
+                self.log.error(type(thread).__name__ + " " + str(thread.worker_id) + " is dead.")
+        return any(thread.is_alive() for thread in self.executor_threads)
+
+    def create_core(self):
+        """
+        Create Yandex Transport API Core with settings of the application, the browser is not started.
+        :return: YandexTransportCore
+        """
+        core = YandexTransportCore()
+        core.wait_timeout = self.wait_timeout
+        core.capture_mode = self.capture_mode
+        core.fetch_mode = self.fetch_mode
+        core.direct.ttl = self.session_ttl
+        core.json_passthrough = self.json_passthrough
+        core.blocked_urls = self.blocked_urls
+        core.block_images = self.block_images
+        core.profile_template_dir = self.profile_dir
+        core.recycle_queries = self.recycle_queries
+        core.recycle_rss = self.recycle_memory
+        core.recycle_age = self.recycle_age
+        return core
+
+    def send_payload(self, payload, subscribers):
+        """
+        Send query results to all subscribers of the query, each subscriber gets results with its own query ID.
+        :param payload: list of result dictionaries
+        :param subscribers: list of {'id', 'addr', 'conn'}
+        :return: size of the payload (sent to a single subscriber), in bytes
+        """
+        payload_size = 0
+        for index, subscriber in enumerate(subscribers):
+            for entry in payload:
+                message_size = self.send_message(dict(entry, id=subscriber['id']),
+                                                 subscriber['addr'], subscriber['conn'], log_tag=entry['method'])
+                if index == 0:
+                    payload_size += message_size
+        return payload_size
+
+    def send_query_results(self, query, payload, final=False, cacheable=False):
+        """
+        Send query results to subscribers of the query which didn't get them yet, subscribers are tracked
+        by the number of results each one got, so clients subscribed while the query is executing get
+        everything sent before too. After the final results are sent to everyone the query is cached (if cacheable)
+        and stops accepting new subscribers, both at once, so same queries either subscribe or hit the cache.
         :param query: internal query structure
-        :return: None
+        :param payload: list of all result dictionaries of the query so far
+        :param final: True if the payload is complete
+        :param cacheable: True to cache the final payload
+        :return: nothing
         """
-        result = {'id': query['id'],
-                  'method': query['type'],
-                  'error': self.app.RESULT_OK,
-                  'message': 'OK',
-                  'expect_more_data': False,
-                  'data': query['body']}
-        result_json = json.dumps(result)
-        self.send_message(result_json, query['addr'], query['conn'], log_tag='getEcho')
+        # Size of each result as sent to the first subscriber which got it, in bytes
+        sizes = query.setdefault('sizes', [])
+        while True:
+            self.queue_lock.acquire()
+            subscribers = []
+            for subscriber in query['subscribers']:
+                sent = subscriber.get('sent', 0)
+                if sent < len(payload):
+                    subscribers.append((subscriber, sent))
+                    subscriber['sent'] = len(payload)
+            if not subscribers:
+                if final:
+                    if cacheable:
+                        size = sum(sizes) + sum(len(RawJSON.dumps(entry)) for entry in payload[len(sizes):])
+                        self.cache.put(query['type'], query['body'], payload, size)
+                    if self.pending_queries.get(query.get('key')) is query:
+                        del self.pending_queries[query['key']]
+                self.queue_lock.release()
+                return
+            self.queue_lock.release()
+
+            for subscriber, sent in subscribers:
+                for index in range(sent, len(payload)):
+                    entry = payload[index]
+                    message_size = self.send_message(dict(entry, id=subscriber['id']),
+                                                     subscriber['addr'], subscriber['conn'], log_tag=entry['method'])
+                    if index == len(sizes):
+                        sizes.append(message_size)
 
-    def execute_get_stop_info(self, query):
+    def detach_query(self, query):
         """
-        Execute get_stop_info query
+        Stop accepting new subscribers for the query, called once the query results are ready.
         :param query: internal query structure
-        :return: nothing
+        :return: list of subscribers of the query
         """
-        self.app.log.debug("Executing " + "getStopInfo" + " query:"
-                           " ID=" + str(query['id']) +
-                           " Body=" + str(query['body']))
-        self.execute_get_info(query)
+        self.queue_lock.acquire()
+        if self.pending_queries.get(query.get('key')) is query:
+            del self.pending_queries[query['key']]
+        subscribers = list(query['subscribers'])
+        self.queue_lock.release()
+        return subscribers
 
-    def execute_get_route_info(self, query):
+    def remove_subscribers(self, query, predicate):
         """
-        Execute get_route_info query
+        Remove subscribers matching the predicate from the query. If nobody is subscribed to the query anymore,
+        it is removed from the Query Queue. Queue lock should be acquired.
         :param query: internal query structure
-        :return: nothing
-        """
-        self.app.log.debug("Executing " + "getRouteInfo" + " query:"
-                           " ID=" + str(query['id']) +
-                           " URL=" + str(query['body']))
-        self.execute_get_info(query)
+        :param predicate: function(query, subscriber) returning True if the subscriber should be removed
+        :return: list of (query, subscriber) removed
+        """
+        removed = [(query, subscriber) for subscriber in query['subscribers'] if predicate(query, subscriber)]
+        if not removed:
+            return removed
+        query['subscribers'] = [subscriber for subscriber in query['subscribers']
+                                if not predicate(query, subscriber)]
+        if not query['subscribers']:
+            self.query_queue.remove(query)
+            if self.pending_queries.get(query.get('key')) is query:
+                del self.pending_queries[query['key']]
+        return removed
+
+    def cancel_queries(self, predicate):
+        """
+        Remove subscribers matching the predicate from all queued and executing queries.
+        Executing queries continue to run (the browser can't be stopped), but results are not sent to removed ones.
+        :param predicate: function(query, subscriber) returning True if the subscriber should be removed
+        :return: list of (query, subscriber) removed
+        """
+        removed = []
+        self.queue_lock.acquire()
+        queries = list(self.query_queue)
+        for executor_thread in self.executor_threads:
+            if executor_thread.current_query is not None:
+                queries.append(executor_thread.current_query)
+        for query in queries:
+            removed += self.remove_subscribers(query, predicate)
+        self.queue_lock.release()
+        return removed
 
-    def execute_get_line(self, query):
+    def cancel_watches(self, predicate):
         """
-        Execute get_line query
-        :param query: internal query structure
-        :return: nothing
+        Cancel watches matching the predicate. Watch workers send the final message and become idle.
+        :param predicate: function(watch) returning True if the watch should be cancelled
+        :return: list of watches cancelled
         """
-        self.app.log.debug("Executing " + "getLine" + " query:"
-                           " ID=" + str(query['id']) +
-                           " URL=" + str(query['body']))
-        self.execute_get_info(query)
+        removed = []
+        self.queue_lock.acquire()
+        for watch_thread in self.watch_threads:
+            if watch_thread.watch is not None and predicate(watch_thread.watch):
+                removed.append(watch_thread.watch)
+                watch_thread.set_watch(None)
+        self.queue_lock.release()
+        return removed
 
-    def execute_get_vehicles_info(self, query):
+    @staticmethod
+    def is_subscriber_expired(_query, subscriber):
         """
-        Execute get_vehicles_info query
-        :param query: internal query structure
-        :return: nothing
+        Check if deadline of the subscriber has passed.
+        :param _query: internal query structure
+        :param subscriber: subscriber of the query
+        :return: True if expired
         """
-        self.app.log.debug("Executing " + "getVehiclesInfo" + " query:"
-                           " ID=" + str(query['id']) +
-                           " URL=" + str(query['body']))
-        self.execute_get_info(query)
+        return subscriber['deadline'] is not None and subscriber['deadline'] <= time.time()
 
-    def execute_get_vehicles_info_with_region(self, query):
+    def expire_queries(self):
         """
-        Execute get_vehicles_info_with_region query
-        :param query: internal query structure
+        Remove queued queries which are past their deadlines, send errors to their clients.
         :return: nothing
         """
-        self.app.log.debug("Executing " + "getVehiclesInfoWithRegion" + " query:"
-                           " ID=" + str(query['id']) +
-                           " URL=" + str(query['body']))
-        self.execute_get_info(query)
+        self.queue_lock.acquire()
+        expired = []
+        for query in list(self.query_queue):
+            expired += self.remove_subscribers(query, self.is_subscriber_expired)
+        self.queue_lock.release()
+        self.send_deadline_expired(expired)
 
-    def execute_get_layer_regions(self, query):
+    def send_deadline_expired(self, expired):
         """
-        Execute get_layer_regions query
-        :param query: internal query structure
+        Send "deadline expired" errors.
+        :param expired: list of (query, subscriber)
         :return: nothing
         """
-        self.app.log.debug("Executing " + "getLayersRegion" + " query:"
-                           " ID=" + str(query['id']) +
-                           " URL=" + str(query['body']))
-        self.execute_get_info(query)
+        for query, subscriber in expired:
+            self.log.debug("Deadline expired : " + query['type'] + " , ID=" + str(subscriber['id']))
+            result = {'id': subscriber['id'],
+                      'method': query['type'],
+                      'error': self.RESULT_DEADLINE_EXPIRED,
+                      'message': 'Query deadline expired',
+                      'expect_more_data': False}
+            self.send_message(result, subscriber['addr'], subscriber['conn'], log_tag=query['type'])
 
-    def execute_get_all_info(self, query):
+    def process_loop_iteration(self):
         """
-        Execute get_all_info query
-        :param query: internal query structure
-        :return: nothing
+        Check worker threads and expire queued queries, called by the network loop.
+        :return: False if the server should stop
         """
-        self.app.log.debug("Executing " + "getAllInfo" + " query:" +
-                           " ID=" + str(query['id']) +
-                           " URL=" + str(query['body']))
-        self.execute_get_info(query)
+        # Dead workers are reported and skipped, the server is useless only without any executor worker
+        if not self.check_threads():
+            self.log.error("All executor threads are dead. Terminating the program.")
+            return False
+        self.expire_queries()
+        return True
 
-    def execute_query(self, query):
+    def connection_closed(self, conn):
         """
-        Execute query from the Query Queue
-        :param query: query inner structure {'id', 'type', 'body'}
-        :return: None
+        Remove queries and watches of the closed connection, nobody will receive their results.
+        :param conn: ClientConnection
+        :return: nothing
         """
-        if query['type'] == 'getEcho':
-            self.execute_get_echo(query)
-            return
-        if query['type'] == 'getStopInfo':
-            self.execute_get_stop_info(query)
-            return
-        if query['type'] == 'getRouteInfo':
-            self.execute_get_route_info(query)
-            return
-        if query['type'] == 'getLine':
-            self.execute_get_line(query)
-            return
-        if query['type'] == 'getVehiclesInfo':
-            self.execute_get_vehicles_info(query)
-            return
-        if query['type'] == 'getVehiclesInfoWithRegion':
-            self.execute_get_vehicles_info_with_region(query)
-            return
-        if query['type'] == 'getLayerRegions':
-            self.execute_get_layer_regions(query)
-            return
-        if query['type'] == 'getAllInfo':
-            self.execute_get_all_info(query)
-            return
+        removed = self.cancel_queries(lambda query, subscriber: subscriber['conn'] is conn)
+        if removed:
+            self.log.debug("Removed " + str(len(removed)) + " queries of connection ( " + str(conn.addr) + " )")
+        removed = self.cancel_watches(lambda watch: watch['conn'] is conn)
+        if removed:
+            self.log.debug("Cancelled " + str(len(removed)) + " watches of connection ( " + str(conn.addr) + " )")
 
-    def perform_query_extraction_and_execution(self):
+    def process_query(self, query, conn):
         """
-        Extract and execute query from Query Queue
-        :return: None
+        Process single query received from the client.
+        :param query: query string
+        :param conn: ClientConnection
+        :return: nothing
         """
-        # Default "discard" query
-        query = None
-
-        # Get the query from Query Queue
-        self.app.queue_lock.acquire()
-        query_len = len(self.app.query_queue)
-        if query_len > 0:
-            query = self.app.query_queue[0]
-        self.app.queue_lock.release()
-
-        # Executing the query
-        if query is not None:
-            self.execute_query(query)
-
-        # Removing executed query from the Query Queue
-        self.app.queue_lock.acquire()
-        if query_len > 0:
-            self.app.query_queue.popleft()
-        self.app.queue_lock.release()
-
-    def run(self):
-        self.app.log.debug("Executor thread started, wait time between queries is "+str(self.wait_time)+" secs.")
-        while self.app.is_running:
-            # Extracting and executing extraction and execution of query from Query Queue
-            self.perform_query_extraction_and_execution()
-
-            # Waiting for some time before next query is extracted and executed
-            for _ in range(0, self.wait_time):
-                if self.app.is_running:
-                    time.sleep(1)
-                else:
-                    break
-        self.app.log.debug("Executor thread stopped.")
-# -------------------------------------------------------------------------------------------------------------------- #
-
-
-class Application:
-    """
-    Main application class
-    """
-    # Error codes
-    RESULT_OK = 0
-    RESULT_NO_DATA = 1
-    RESULT_GET_ERROR = 2
-    RESULT_NO_YANDEX_DATA = 3
-
-    RESULT_SOCKET_BIND_FAILED = 1
-
-    def __init__(self):
-        setproctitle.setproctitle('transport_proxy')
-
-        self.is_running = True  # If set to false, the server will begin to terminate itself
-
-        # Listen address
-        self.host = '0.0.0.0'
-        # Listen port
-        self.port = 25555
+        addr = conn.addr
+        self.log.debug("Received : " + str(query))
 
-        # Delay between queries, in secs.
-        self.query_delay = 5
-
-        # Yandex Transport API Core
-        self.core = None
-
-        # Executor thread
-        self.executor_thread = None
+        if query == 'getCurrentQueue':
+            self.process_get_current_queue(conn)
 
-        # List of clients currently connected to the server
-        self.listeners = defaultdict()
+        elif query.startswith('setProtocol?'):
+            self.process_set_protocol(query, conn)
 
-        # Logger
-        self.log = Logger(Logger.INFO)
+        elif query.startswith('cancelQuery?'):
+            self.process_cancel_query(query, conn)
 
-        # Debug: Write EVERYTHING this thing sends via network to a file.
-        self.network_log_enabled = False
-        self.network_log_file = 'ytproxy-network.log'
+        elif query == 'getCacheStats':
+            self.process_get_cache_stats(conn)
 
-        # Queue lock
-        self.queue_lock = threading.Lock()
+        elif query == 'getStatus':
+            self.process_get_status(conn)
 
-        # Will turn on with "Watch" command, and prevent any further queries to be added to Queue
-        self.watch_lock = False
+        elif query.startswith('getEcho?'):
+            self.process_echo(query, addr, conn)
 
-        # Last Query ID, will increment with each query added to the Queue
-        self.query_id = 0
+        elif query.startswith('watchVehiclesInfo?'):
+            self.process_watch_vehicles_info(query, addr, conn)
 
-        # Server will run in single thread, the deque is to store incoming queries.
-        self.query_queue = deque()
+        elif query == 'cancelWatch' or query.startswith('cancelWatch?'):
+            self.process_cancel_watch(query, conn)
 
-    def sigterm_handler(self, _signal, _time):
-        """
-        SIGTERM handler, will simply pass to SIGINT handler.
-        :param _signal:
-        :param _time:
-        :return:
-        """
-        self.log.info("SIGTERM received! Terminating the program...")
-        self.sigterm_handler(_signal, _time)
+        else:
+            self.process_api_query(query, addr, conn)
 
-    def sigint_handler(self, _signal, _time):
-        """
-        SIGINT signal handler
-        :param _signal: signal
-        :param _time: time
-        :return: nothing
+    def process_api_query(self, query, addr, conn):
         """
-        self.log.info("SIGINT received! Terminating the program...")
-        self.watch_lock = False
-        self.is_running = False
-        self.log.info("Waiting for threads to terminate...")
-        copy_listeners = self.listeners.copy()
-        # pylint: disable = W0612
-        for key, listener in copy_listeners.items():
-            listener.join()
-        # pylint: enable = W0612
-        if self.executor_thread is not None:
-            self.executor_thread.join()
-
-    def listen(self):
-        """
-        Start listening to incoming connections. Each new accepted connection will create a new ListenerThread.
+        Process query going to Yandex API.
+        :param query: query string
+        :param addr: address of the client
+        :param conn: ClientConnection
         :return: nothing
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(5)
-        self.log.debug("Binding socket...")
-        try:
-            sock.bind((self.host, self.port))
-        except socket.error as e:
-            self.log.error("Exception (listen): " + str(e))
-            return self.RESULT_SOCKET_BIND_FAILED
-
-        self.log.info("Listening for incoming connections.")
-        self.log.info("Host: " + str(self.host) + " , Port: " + str(self.port))
-        sock.listen(1)
-
-        while self.is_running:
-            # Checking if Executor Thread is dead.
-            if not self.executor_thread.isAlive():
-                self.log.error("Executor thread is dead. Terminating the program.")
-                self.is_running = False
-                break
+        if query.startswith('getStopInfo?'):
+            self.process_get_stop_info(query, addr, conn)
 
-            try:
-                conn, addr = sock.accept()
-            except socket.timeout:
-                continue
+        elif query.startswith('getVehiclesInfo?'):
+            self.process_get_vehicles_info(query, addr, conn)
 
+        elif query.startswith('getVehiclesInfoWithRegion?'):
+            self.process_get_vehicles_info_with_region(query, addr, conn)
 
-            listener_thread = ListenerThread(conn, addr, self)
-            self.listeners[addr] = listener_thread
-            listener_thread.start()
+        elif query.startswith('getRouteInfo?'):
+            self.process_get_route_info(query, addr, conn)
 
-        sock.shutdown(socket.SHUT_RDWR)
+        elif query.startswith('getLine?'):
+            self.process_get_line(query, addr, conn)
 
-        return self.RESULT_OK
+        elif query.startswith('getLayerRegions?'):
+            self.process_get_layer_regions(query, addr, conn)
 
-    def get_current_connections(self):
-        """
-        Get current connections
-        :return: JSON containing list of current connections
-                 {"ip_address": "string", "port": "integer"}
-                   ip_address - IP address of the client
-                   port       - port of the client
-        """
-        data = []
-        # pylint: disable = W0612
-        for key, value in self.listeners.items():
-            entry = {"ip_address" : key[0], "port" : key[1]}
-            data.append(entry)
-        # pylint: enable = W0612
-        json_data = json.dumps(data)
+        elif query.startswith('getAllInfo?'):
+            self.process_get_all_info(query, addr, conn)
 
-        return json_data
+        else:
+            self.process_unknown_query(conn)
 
     def get_current_queue(self):
         """
-        Get current Query Queue.
+        Get current Query Queue. Queries currently executed by workers come first.
         :return: JSON containing list of elements in Query Queue
-                 {"type": "string", "id": "string", "query": "string"}
-                   type  - type of query (get_stop_info, get_vehicles_info etc.)
-                   id    - ID of query, string value, passed from the client.
-                   query - actual query string
+                 {"type": "string", "id": "string", "query": "string", "status": "string", "worker": "integer"}
+                   type   - type of query (get_stop_info, get_vehicles_info etc.)
+                   id     - ID of query, string value, passed from the client.
+                   query  - actual query string
+                   status - "executing" or "queued"
+                   worker - ID of the worker executing the query, null if the query is still queued
         """
         data = []
 
         self.queue_lock.acquire()
+        for executor_thread in self.executor_threads:
+            query = executor_thread.current_query
+            if query is not None:
+                entry = {'type': query['type'], 'id': query['id'], 'query': query['body'],
+                         'status': 'executing', 'worker': executor_thread.worker_id}
+                data.append(entry)
         for entry in self.query_queue:
-            entry = {'type': entry['type'], 'id': entry['id'], 'query': entry['body']}
+            entry = {'type': entry['type'], 'id': entry['id'], 'query': entry['body'],
+                     'status': 'queued', 'worker': None}
             data.append(entry)
         self.queue_lock.release()
 
@@ -562,22 +470,6 @@ class Application:
 
         return json_data
 
-    def handle_watch_lock(self, conn):
-        """
-        Send a message back to the client if new query arrived while WatchLock is engaged.
-        Was supposed to use with watch... methods, abandoned for now until and if watch... methods
-        are re-implemented again.
-        :param conn: connection
-        :return: nothing
-        """
-        if self.watch_lock:
-            response = {"id": self.query_id,
-                        "response": "ERROR",
-                        "message": "Watch task is planned, no queries accepted until cancelled!",
-                       }
-            response_json = json.dumps(response)
-            conn.send(bytes(response_json + '\n' + '\0', 'utf-8'))
-
     @staticmethod
     def split_query(query):
         """
@@ -593,38 +485,96 @@ class Application:
             query_type, query_id, query_body = result.group(1), result.group(2), result.group(3)
         return query_type, query_id, query_body
 
-    def process_get_info(self, query, addr, conn, set_watch_lock=False):
+    @staticmethod
+    def split_query_id(query_id, addr):
+        """
+        Get optional query parameters from the ID part of the query:
+        getXXXInfo?id=ID&priority=1&deadline=10&tenant=name?...
+        :param query_id: ID part of the query
+        :param addr: address of the client
+        :return: ID, {"priority", "deadline", "tenant"}
+        """
+        query_id, _, params = query_id.partition('&')
+        params = dict(parse_qsl(params))
+        options = {}
+        try:
+            options['priority'] = int(params.get('priority', 0))
+        except ValueError:
+            options['priority'] = 0
+        # Optional deadline, in seconds from now. Query is dropped if not executed before it.
+        try:
+            options['deadline'] = time.time() + float(params['deadline'])
+        except (KeyError, ValueError):
+            options['deadline'] = None
+        # Queries are scheduled fairly between tenants, a connection is a tenant unless a client says otherwise
+        if 'tenant' in params:
+            options['tenant'] = ('tenant', params['tenant'])
+        else:
+            options['tenant'] = ('addr', addr)
+        return query_id, options
+
+    def process_get_info(self, query, addr, conn):
         """
         Process the getXXXInfo?id=?YYYY?... requests
         :param query:
         :param addr:
         :param conn:
-        :param set_watch_lock:
         :return:
         """
-        if self.watch_lock:
-            self.handle_watch_lock(conn)
-        else:
-            if set_watch_lock:
-                self.watch_lock = True
-
-            query_type, query_id, query_body = self.split_query(query)
-
-            self.queue_lock.acquire()
-            self.query_queue.append({'type': query_type,
-                                     'id': query_id,
-                                     'body': query_body,
-                                     'addr': addr,
-                                     'conn': conn}
-                                   )
-            queue_position = len(self.query_queue) - 1
-            self.queue_lock.release()
+        query_type, query_id, query_body = self.split_query(query)
+        query_id, options = self.split_query_id(query_id, addr)
 
+        # Cached response is sent back right away, without going to the Query Queue
+        cached_payload = self.cache.get(query_type, query_body)
+        if cached_payload is not None:
+            self.log.debug("Cache hit : " + query_type + " , ID=" + str(query_id))
             response = {'id': query_id,
                         'response': 'OK',
-                        'queue_position': queue_position}
-            response_json = json.dumps(response)
-            conn.send(bytes(response_json + '\n' + '\0', 'utf-8'))
+                        'queue_position': 0,
+                        'cached': True}
+            self.send_message(response, addr, conn)
+            self.send_payload(cached_payload, [{'id': query_id, 'addr': addr, 'conn': conn}])
+            return
+
+        subscriber = {'id': query_id, 'addr': addr, 'conn': conn, 'deadline': options['deadline']}
+        key = None
+        if query_type in self.COALESCED_QUERIES:
+            key = (query_type, ResponseCache.canonical_url(query_body))
+
+        self.queue_lock.acquire()
+        pending_query = self.pending_queries.get(key)
+        if pending_query is not None:
+            # Identical query is already waiting or executing, subscribing to its results
+            pending_query['subscribers'].append(subscriber)
+            queue_position = self.query_queue.position(pending_query)
+            if queue_position is None:
+                queue_position = 0
+        else:
+            new_query = {'type': query_type,
+                         'id': query_id,
+                         'body': query_body,
+                         'addr': addr,
+                         'conn': conn,
+                         'key': key,
+                         'tenant': options['tenant'],
+                         'priority': options['priority'],
+                         'subscribers': [subscriber]}
+            self.query_queue.append(new_query)
+            if key is not None:
+                self.pending_queries[key] = new_query
+            queue_position = self.query_queue.position(new_query)
+            # Waking up an idle worker
+            self.queue_condition.notify()
+        self.queue_lock.release()
+
+        response = {'id': query_id,
+                    'response': 'OK',
+                    'queue_position': queue_position}
+        if pending_query is not None:
+            self.log.debug("Coalesced : " + query_type + " , ID=" + str(query_id) +
+                           " with ID=" + str(pending_query['id']))
+            response['coalesced'] = True
+        self.send_message(response, addr, conn)
 
     def process_get_stop_info(self, query, addr, conn):
         """Process get_stop_info query """
@@ -656,24 +606,184 @@ class Application:
 
     def process_echo(self, query, addr, conn):
         """Process getEcho query"""
-        # If blocked by Watch Lock
-        if self.watch_lock:
-            self.handle_watch_lock(conn)
-        else:
-            self.process_get_info(query, addr, conn)
+        self.process_get_info(query, addr, conn)
 
     def process_get_current_queue(self, conn):
         """Process get_current_queue"""
         current_queue = self.get_current_queue()
-        queue_json = json.loads(current_queue)
-        response_json = json.dumps(queue_json)
-        conn.send(bytes(response_json + '\n' + '\0', 'utf-8'))
+        self.send_message(json.loads(current_queue), conn.addr, conn)
+
+    def get_status(self):
+        """
+        Get readiness of the server and startup timings.
+        :return: dictionary
+                 ready         - true if at least one executor worker is ready to execute queries,
+                                 queries received before that are held in the Query Queue
+                 uptime        - secs since the server was started
+                 listen_time   - secs it took to start listening for connections
+                 ready_time    - secs it took for the first executor worker to become ready, null if none is ready
+                 queue_size    - number of queries in the Query Queue
+                 workers       - executor workers,
+                                 [{"worker", "ready", "startup_time", "ready_time", "first_query_time"}],
+                                 startup_time is secs it took to start the browser of the worker,
+                                 ready_time is secs since the server was started until the worker became ready,
+                                 both are null if the browser is still starting,
+                                 first_query_time is secs the first query to Yandex took, null if none yet
+                 watch_workers - watch workers, [{"worker", "ready", "startup_time", "ready_time"}]
+        """
+        workers = [{'worker': thread.worker_id, 'ready': thread.ready,
+                    'startup_time': thread.startup_time, 'ready_time': thread.ready_time,
+                    'first_query_time': thread.first_query_time}
+                   for thread in self.executor_threads]
+        watch_workers = [{'worker': thread.worker_id, 'ready': thread.ready,
+                          'startup_time': thread.startup_time, 'ready_time': thread.ready_time}
+                         for thread in self.watch_threads]
+        ready_times = [worker['ready_time'] for worker in workers if worker['ready']]
+
+        self.queue_lock.acquire()
+        queue_size = len(self.query_queue)
+        self.queue_lock.release()
+
+        return {'ready': bool(ready_times),
+                'uptime': time.time() - self.start_time,
+                'listen_time': self.listen_time,
+                'ready_time': min(ready_times) if ready_times else None,
+                'queue_size': queue_size,
+                'workers': workers,
+                'watch_workers': watch_workers}
+
+    def process_get_status(self, conn):
+        """Process getStatus"""
+        self.send_message(self.get_status(), conn.addr, conn)
+
+    def process_get_cache_stats(self, conn):
+        """Process getCacheStats"""
+        self.send_message(self.cache.get_stats(), conn.addr, conn)
 
     def process_unknown_query(self, conn):
         """Process unknown query"""
         response = {"response": "ERROR", "message": "Unknown query"}
-        response_json = json.dumps(response)
-        conn.send(bytes(response_json + '\n' + '\0', 'utf-8'))
+        self.send_message(response, conn.addr, conn)
+
+    def process_cancel_query(self, query, conn):
+        """
+        Process cancelQuery?id=... query, cancels queries with this ID made from this connection.
+        """
+        query_id = query.partition('?id=')[2]
+        removed = self.cancel_queries(lambda query, subscriber: subscriber['conn'] is conn and
+                                      subscriber['id'] == query_id)
+        if removed:
+            response = {'id': query_id, 'response': 'OK', 'message': 'Query cancelled'}
+        else:
+            response = {'id': query_id, 'response': 'ERROR', 'message': 'Query not found'}
+        self.send_message(response, conn.addr, conn)
+
+    def process_watch_vehicles_info(self, query, addr, conn):
+        """
+        Process watchVehiclesInfo?id=...?URL query, assigns the watch to an idle watch worker.
+        """
+        query_type, query_id, query_body = self.split_query(query)
+        watch = {'type': query_type,
+                 'id': query_id,
+                 'body': query_body,
+                 'addr': addr,
+                 'conn': conn}
+
+        watch_thread = None
+        self.queue_lock.acquire()
+        for thread in self.watch_threads:
+            if thread.watch is None and not thread.failed:
+                watch_thread = thread
+                watch_thread.set_watch(watch)
+                break
+        self.queue_lock.release()
+
+        if watch_thread is not None:
+            self.log.debug("Watch : " + query_type + " , ID=" + str(query_id) +
+                           " , worker " + str(watch_thread.worker_id))
+            response = {'id': query_id, 'response': 'OK', 'message': 'Watch started'}
+        else:
+            response = {'id': query_id, 'response': 'ERROR', 'message': 'No idle watch workers'}
+        self.send_message(response, addr, conn)
+
+    def process_cancel_watch(self, query, conn):
+        """
+        Process cancelWatch or cancelWatch?id=... query, cancels watches (with this ID) of this connection.
+        """
+        query_id = query.partition('?id=')[2]
+        removed = self.cancel_watches(lambda watch: watch['conn'] is conn and
+                                      (not query_id or watch['id'] == query_id))
+        if removed:
+            response = {'id': query_id, 'response': 'OK', 'message': 'Watch cancelled'}
+        else:
+            response = {'id': query_id, 'response': 'ERROR', 'message': 'Watch not found'}
+        self.send_message(response, conn.addr, conn)
+
+    def add_browser_arguments(self, parser):
+        """
+        Add CLI arguments of browsers and the way they get Yandex API responses
+        :param parser: argparse.ArgumentParser
+        :return: nothing
+        """
+        parser.add_argument("--wait-timeout", default=self.wait_timeout,
+                            help="maximum time to wait for Yandex API responses after the page is loaded,\n"
+                            "in seconds, default is " + str(self.wait_timeout) + " secs. "
+                            "Query returns as soon as all responses arrive.")
+        parser.add_argument("--capture-mode", default=self.capture_mode,
+                            choices=[YandexTransportCore.CAPTURE_MODE_PERFORMANCE,
+                                     YandexTransportCore.CAPTURE_MODE_DEVTOOLS],
+                            help="how to capture Yandex API responses, default is " + str(self.capture_mode) + "\n"
+                            "   performance : find API URLs in the page, then get responses again (see --fetch-mode)\n"
+                            "   devtools    : take responses the page received from DevTools, no extra requests")
+        parser.add_argument("--fetch-mode", default=self.fetch_mode,
+                            choices=[YandexTransportCore.FETCH_MODE_FETCH, YandexTransportCore.FETCH_MODE_NAVIGATE,
+                                     YandexTransportCore.FETCH_MODE_DIRECT],
+                            help="how to get bodies of Yandex API responses, default is " + str(self.fetch_mode) + "\n"
+                            "   fetch    : fetch all of them in parallel from inside the page\n"
+                            "   navigate : open each one in the browser (slow, used as a fallback)\n"
+                            "   direct   : load the page once, then repeat its queries over HTTP with cookies and\n"
+                            "              CSRF token of the browser, the browser is used again if they fail")
+        parser.add_argument("--session-ttl", default=self.session_ttl,
+                            help="direct fetch mode: how long the browser session is used for HTTP queries before\n"
+                            "the page is loaded in the browser again, in seconds, default is " +
+                            str(self.session_ttl) + " secs")
+        parser.add_argument("--parse-json", action="store_true", default=not self.json_passthrough,
+                            help="parse Yandex responses and serialize them again, instead of passing them\n"
+                            "to clients as they are (slower, uses " + RawJSON.BACKEND + " to parse)")
+        parser.add_argument("--block-urls", default=','.join(self.blocked_urls),
+                            help="comma-separated URL patterns of resources the browser will not load, \"*\" is\n"
+                            "a wildcard. Everything is loaded by default. \"default\" blocks map tiles,\n"
+                            "analytics and fonts, which are not needed for API queries:\n" +
+                            ','.join(YandexTransportCore.DEFAULT_BLOCKED_URLS))
+        parser.add_argument("--block-images", action="store_true", default=self.block_images,
+                            help="do not load images in the browser, they are loaded by default")
+        parser.add_argument("--profile-dir", default=self.profile_dir,
+                            help="browser profile template directory, its disk cache keeps scripts of Yandex Maps,\n"
+                            "so pages load faster. It is seeded once, every browser starts with a copy of it.\n"
+                            "Browsers start in incognito mode with empty cache if not set.")
+        parser.add_argument("--profile-seed-url", default=self.profile_seed_url,
+                            help="page to load to seed the profile, default is " + self.profile_seed_url)
+
+    def apply_browser_arguments(self, args):
+        """
+        Apply parsed CLI arguments of browsers
+        :param args: parsed arguments
+        :return: nothing
+        """
+        self.wait_timeout = float(args.wait_timeout)
+        self.capture_mode = args.capture_mode
+        self.fetch_mode = args.fetch_mode
+        self.session_ttl = float(args.session_ttl)
+        self.json_passthrough = not args.parse_json
+        if args.block_urls == 'default':
+            self.blocked_urls = YandexTransportCore.DEFAULT_BLOCKED_URLS
+        elif args.block_urls == 'none':
+            self.blocked_urls = ()
+        else:
+            self.blocked_urls = tuple(pattern.strip() for pattern in args.block_urls.split(',') if pattern.strip())
+        self.block_images = args.block_images
+        self.profile_dir = args.profile_dir
+        self.profile_seed_url = args.profile_seed_url
 
     def parse_arguments(self):
         """
@@ -691,10 +801,7 @@ class Application:
 
         parser.add_argument("-v", "--version", action="store_true", default=False,
                             help="show version info")
-        parser.add_argument("--host", default=self.host,
-                            help="host to listen on, default is " + str(self.host))
-        parser.add_argument("--port", default=self.port,
-                            help="port to listen on, default is " + str(self.port))
+        self.add_network_arguments(parser)
         parser.add_argument("--verbose", default=self.log.verbose,
                             help=
                             "log verbose level, possible values:\r" +
@@ -705,21 +812,63 @@ class Application:
                             "   4 : full debug\n" +
                             "default is " + str(self.log.verbose))
         parser.add_argument("--delay", default=self.query_delay,
-                            help="delay between execution of queries, in seconds, default is " +
+                            help="delay between execution of queries, in seconds, may be fractional, default is " +
                             str(self.query_delay) + " secs.\n"
                             "Use this to lower the load on Yandex Maps " +
                             "and avoid possible ban for\n"
-                            "too many queries in short amount of time.")
+                            "too many queries in short amount of time. 0 disables the limit.\n"
+                            "Only queries going to Yandex are delayed.")
+        parser.add_argument("--burst", default=self.query_burst,
+                            help="number of queries to Yandex which can be executed without delay\n"
+                            "after a quiet period, default is " + str(self.query_burst) + ".")
+        parser.add_argument("--navigation-delay", default=self.navigation_delay,
+                            help="delay between page loads in the browser, in seconds, may be fractional,\n"
+                            "default is the same as --delay. Queries made directly over HTTP (--fetch-mode direct)\n"
+                            "are limited by --delay only, so it can be lower than this.")
+        parser.add_argument("--workers", default=self.workers,
+                            help="number of executor workers, each one runs its own Chromium instance,\n"
+                            "default is " + str(self.workers) + ". Delay between queries applies to each worker.")
+        parser.add_argument("--recycle-queries", default=self.recycle_queries,
+                            help="restart browser of a worker after this many queries to Yandex, 0 - never,\n"
+                            "default is " + str(self.recycle_queries) + ". New browser is started in background "
+                            "and replaces the old one between queries.")
+        parser.add_argument("--recycle-memory", default=self.recycle_memory // (1024 * 1024),
+                            help="restart browser of a worker when it uses more memory than this, in megabytes,\n"
+                            "0 - never, default is " + str(self.recycle_memory // (1024 * 1024)) + ".")
+        parser.add_argument("--recycle-age", default=self.recycle_age,
+                            help="restart browser of a worker after it runs this many secs, 0 - never,\n"
+                            "default is " + str(self.recycle_age) + ".")
+        parser.add_argument("--watch-workers", default=self.watch_workers,
+                            help="number of watch workers, each one runs its own Chromium instance and serves\n"
+                            "one watchVehiclesInfo at a time, 0 disables watching, default is " +
+                            str(self.watch_workers) + ".")
+        parser.add_argument("--cache-entries", default=self.cache.max_entries,
+                            help="maximum number of responses kept in the response cache, 0 disables the cache,\n"
+                            "default is " + str(self.cache.max_entries))
+        parser.add_argument("--cache-size", default=self.cache.max_bytes // (1024 * 1024),
+                            help="maximum total size of responses kept in the response cache, in megabytes,\n"
+                            "default is " + str(self.cache.max_bytes // (1024 * 1024)) + " MB")
+        self.add_browser_arguments(parser)
 
         args = parser.parse_args()
         if args.version:
             print(__version__)
             sys.exit(0)
 
-        self.host = str(args.host)
-        self.port = int(args.port)
+        self.apply_network_arguments(args)
         self.log.verbose = int(args.verbose)
-        self.query_delay = int(args.delay)
+        self.query_delay = max(0.0, float(args.delay))
+        self.query_burst = max(1, int(args.burst))
+        if args.navigation_delay is not None:
+            self.navigation_delay = max(0.0, float(args.navigation_delay))
+        self.workers = max(1, int(args.workers))
+        self.watch_workers = max(0, int(args.watch_workers))
+        self.recycle_queries = max(0, int(args.recycle_queries))
+        self.recycle_memory = max(0, int(args.recycle_memory)) * 1024 * 1024
+        self.recycle_age = max(0, float(args.recycle_age))
+        self.apply_browser_arguments(args)
+        self.cache.max_entries = int(args.cache_entries)
+        self.cache.max_bytes = int(args.cache_size) * 1024 * 1024
 
     def run(self):
         """
@@ -735,38 +884,71 @@ class Application:
         self.log.info("Listen host : " + str(self.host))
         self.log.info("Listen port : " + str(self.port))
         self.log.info("Delay       : " + str(self.query_delay))
+        self.log.info("Burst       : " + str(self.query_burst))
+        self.log.info("Nav. delay  : " + str(self.navigation_delay if self.navigation_delay is not None
+                                             else self.query_delay))
+        self.log.info("Workers     : " + str(self.workers))
+        self.log.info("Watchers    : " + str(self.watch_workers))
+        self.log.info("Recycle     : " + str(self.recycle_queries) + " queries, " +
+                      str(self.recycle_memory // (1024 * 1024)) + " MB, " + str(self.recycle_age) + " secs")
+        self.log.info("Wait timeout: " + str(self.wait_timeout))
+        self.log.info("Capture mode: " + str(self.capture_mode))
+        self.log.info("Fetch mode  : " + str(self.fetch_mode) +
+                      (", session TTL " + str(self.session_ttl) + " secs"
+                       if self.fetch_mode == YandexTransportCore.FETCH_MODE_DIRECT else ""))
+        self.log.info("JSON        : " + ("passthrough" if self.json_passthrough else "parsed") +
+                      ", " + RawJSON.BACKEND + " backend")
+        self.log.info("Blocked URLs: " + str(len(self.blocked_urls)) + " patterns" +
+                      (", images" if self.block_images else ""))
+        self.log.info("Profile     : " + str(self.profile_dir))
+        self.log.info("Cache       : " + str(self.cache.max_entries) + " entries, " +
+                      str(self.cache.max_bytes // (1024 * 1024)) + " MB")
         self.log.info("Verbosity   : " + str(self.log.verbose))
 
+        # Rate limiter, "delay" applies to each worker, so all of them together make "workers" queries per "delay" secs
+        rate = self.workers / self.query_delay if self.query_delay > 0 else None
+        self.rate_limiter = RateLimiter(rate=rate, burst=self.query_burst)
+        navigation_delay = self.navigation_delay if self.navigation_delay is not None else self.query_delay
+        rate = self.workers / navigation_delay if navigation_delay > 0 else None
+        self.navigation_limiter = RateLimiter(rate=rate, burst=self.query_burst)
+
         # Signal handler
         signal.signal(signal.SIGINT, self.sigint_handler)
         signal.signal(signal.SIGTERM, self.sigterm_handler)
 
-        # Starting query executor thread
-        self.executor_thread = ExecutorThread(self)
-        self.executor_thread.start()
+        # Starting network log writer
+        self.start_network_log()
+
+        # Calling Yandex Transport API Core, one per worker. Watch workers have their own cores,
+        # watched pages stay open in them.
+        for worker_id in range(0, self.workers):
+            self.executor_threads.append(ExecutorThread(self, worker_id, self.create_core()))
+        for worker_id in range(0, self.watch_workers):
+            self.watch_threads.append(WatchThread(self, worker_id, self.create_core()))
 
-        # Calling Yandex Transport API Core
-        self.core = YandexTransportCore()
-        self.log.info("Starting ChromeDriver...")
-        self.core.start_webdriver()
-        self.log.info("ChromeDriver started successfully!")
+        # Starting query executor threads, they start their browsers in parallel, while the server is already
+        # listening and accepting queries.
+        for executor_thread in self.executor_threads:
+            executor_thread.start()
+        for watch_thread in self.watch_threads:
+            watch_thread.start()
 
         # Start the process of listening and accepting incoming connections.
         result = self.listen()
         if result == self.RESULT_SOCKET_BIND_FAILED:
             self.log.error("Failed to bind socket.")
 
+        # Stopping the server executor threads.
+        self.stop()
 
-        self.core.stop_webdriver()
-
-        # Stopping the server executor and listener threads.
-        self.is_running = False
-
-        for _, listener in self.listeners.items():
-            listener.join()
+        for executor_thread in self.executor_threads:
+            executor_thread.join()
+            executor_thread.core.stop_webdriver()
+        for watch_thread in self.watch_threads:
+            watch_thread.join()
+            watch_thread.core.stop_webdriver()
 
-        if self.executor_thread is not None:
-            self.executor_thread.join()
+        self.stop_network_log()
         self.log.info("YTPS - Yandex Transport Proxy Server - terminated!")
 
 # -------------------------------------------------------------------------------------------------------------------- #
@@ -1,2 +1,12 @@
 from yandex_transport_core.yandex_transport_core import YandexTransportCore
 from yandex_transport_core.logger import Logger
+from yandex_transport_core.raw_json import RawJSON
+from yandex_transport_core.response_cache import ResponseCache
+from yandex_transport_core.query_scheduler import QueryScheduler
+from yandex_transport_core.rate_limiter import RateLimiter
+from yandex_transport_core.network_log_writer import NetworkLogWriter
+from yandex_transport_core.client_connection import ClientConnection
+from yandex_transport_core.network_server import NetworkServer
+from yandex_transport_core.worker_thread import WorkerThread
+from yandex_transport_core.executor_thread import ExecutorThread
+from yandex_transport_core.watch_thread import WatchThread
@@ -0,0 +1,317 @@
+"""
+This is a client connection module of Yandex Transport Proxy.
+
+Keeps the state of a single client: inbound and outbound buffers, protocol version, encoding and compression.
+"""
+
+import re
+import socket
+import struct
+import threading
+import zlib
+from collections import deque
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from yandex_transport_core.raw_json import RawJSON
+
+
+class ClientConnection:
+    """
+    Connection of a single client. Reading and writing is done by the network loop of the Application.
+    Messages can be sent from any thread (executor threads send query results directly), they are put to the
+    outbound buffer of the connection, and the network loop sends them to the client when the socket is ready.
+    If the outbound buffer is full (the client is slow or stalled), overflow policy decides what to do.
+
+    Two protocol versions are supported:
+      1 - text protocol, queries are separated by '\\n', responses are JSON separated by '\\n\\0'.
+      2 - binary protocol, both queries and responses are frames prefixed with 4-byte big-endian length.
+          Queries are UTF-8 strings, responses are msgpack (or JSON, if requested or msgpack is not installed).
+          Responses may be zlib compressed, if the client asked for it, the highest bit of the length is set then.
+    Connection always starts with protocol version 1, "setProtocol" query switches it to version 2.
+    """
+    PROTOCOL_TEXT = 1
+    PROTOCOL_BINARY = 2
+
+    ENCODING_JSON = 'json'
+    ENCODING_MSGPACK = 'msgpack'
+
+    # Frame header of protocol version 2, length of the frame payload
+    FRAME_HEADER = struct.Struct('>I')
+    # Set in the frame header if the payload is compressed, the rest is the length
+    FRAME_COMPRESSED = 0x80000000
+
+    COMPRESSION_NONE = 'none'
+    COMPRESSION_ZLIB = 'zlib'
+
+    # Responses smaller than this are not compressed, in bytes
+    DEFAULT_COMPRESSION_THRESHOLD = 1024
+    DEFAULT_COMPRESSION_LEVEL = 6
+
+    # Maximum size of a single query, connection is closed if a client tries to send something bigger
+    MAX_QUERY_SIZE = 64 * 1024
+
+    # What to do if outbound buffer is full
+    OVERFLOW_DROP = 'drop'              # drop the message
+    OVERFLOW_DISCONNECT = 'disconnect'  # close the connection
+    OVERFLOW_BLOCK = 'block'            # wait until there is enough space in the buffer
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+
+        # Outbound buffer, list of bytes waiting to be sent, and its total size
+        self.out_buffer = deque()
+        self.out_buffer_size = 0
+
+        # Maximum size of the outbound buffer, in bytes, and what to do if it's full
+        self.max_out_buffer_size = 8 * 1024 * 1024
+        self.overflow_policy = self.OVERFLOW_DISCONNECT
+
+        # Function to call when there is new data in the outbound buffer, or the connection should be closed.
+        # Set by the Application, will wake up the network loop.
+        self.on_output = None
+
+        # Set if the connection should be closed, because of the buffer overflow or send error
+        self.should_close = False
+
+        # Set once the connection is closed
+        self.closed = False
+
+        # Current protocol version and encoding of responses
+        self.protocol = self.PROTOCOL_TEXT
+        self.encoding = self.ENCODING_JSON
+
+        # Compression of responses, protocol version 2 only. Responses smaller than the threshold are sent as they are.
+        # In streaming mode all compressed responses are parts of one zlib stream, each one is flushed, so previous
+        # responses work as a dictionary for the next ones (responses of the same kind compress really well).
+        self.compression = self.COMPRESSION_NONE
+        self.compression_threshold = self.DEFAULT_COMPRESSION_THRESHOLD
+        self.compression_level = self.DEFAULT_COMPRESSION_LEVEL
+        # zlib compressor of the stream, None if not in streaming mode
+        self.compressor = None
+
+        # Received data which is not yet a complete query
+        self.in_buffer = b''
+
+        # Prevents messages sent from different threads from mixing up, protects the outbound buffer
+        self.send_lock = threading.Lock()
+
+        # Signalled when outbound buffer is drained or the connection is closed, for "block" overflow policy
+        self.send_condition = threading.Condition(self.send_lock)
+
+    def fileno(self):
+        """File descriptor of the connection socket, for selectors"""
+        return self.sock.fileno()
+
+    def feed(self, data):
+        """
+        Add received data to the input buffer.
+        :param data: received bytes
+        :return: False if the input buffer is too big (a client is misbehaving), True otherwise
+        """
+        self.in_buffer += data
+        return len(self.in_buffer) <= self.MAX_QUERY_SIZE + self.FRAME_HEADER.size
+
+    def next_query(self):
+        """
+        Extract next complete query from the input buffer.
+        Should be called until it returns None, queries may change the protocol of the connection.
+        :return: query string, None if there is no complete query in the buffer
+        """
+        if self.protocol == self.PROTOCOL_BINARY:
+            if len(self.in_buffer) < self.FRAME_HEADER.size:
+                return None
+            length, = self.FRAME_HEADER.unpack_from(self.in_buffer)
+            end = self.FRAME_HEADER.size + length
+            if len(self.in_buffer) < end:
+                return None
+            query = self.in_buffer[self.FRAME_HEADER.size:end]
+            self.in_buffer = self.in_buffer[end:]
+            return query.decode('utf-8', errors='replace')
+
+        # Text protocol, queries end with '\n' (or '\0', just in case)
+        match = re.search(b'[\n\0]', self.in_buffer)
+        if match is None:
+            return None
+        query = self.in_buffer[:match.start()]
+        self.in_buffer = self.in_buffer[match.end():]
+        return query.decode('utf-8', errors='replace').strip()
+
+    def encode(self, message):
+        """
+        Encode the message according to current protocol of the connection.
+        :param message: message, a dictionary or a list, Yandex data may be RawJSON
+        :return: bytes to send
+        """
+        if self.protocol == self.PROTOCOL_BINARY:
+            if self.encoding == self.ENCODING_MSGPACK:
+                payload = msgpack.packb(RawJSON.resolve(message), use_bin_type=True)
+            else:
+                payload = RawJSON.dumps(message)
+            if self.compression == self.COMPRESSION_ZLIB and len(payload) >= self.compression_threshold:
+                if self.compressor is not None:
+                    # Part of the stream, has to be sent even if it's not smaller
+                    compressed = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+                else:
+                    compressed = zlib.compress(payload, self.compression_level)
+                if self.compressor is not None or len(compressed) < len(payload):
+                    return self.FRAME_HEADER.pack(len(compressed) | self.FRAME_COMPRESSED) + compressed
+            return self.FRAME_HEADER.pack(len(payload)) + payload
+
+        return RawJSON.dumps(message) + b'\n\0'
+
+    def _enqueue(self, data, can_block):
+        """
+        Put data to the outbound buffer, sending lock should be acquired.
+        Tries to send it right away if the buffer is empty, never blocks on the socket itself.
+        :param data: bytes to send
+        :param can_block: if False, "block" overflow policy will not wait for buffer space
+        :return: True if data is queued, False if dropped
+        """
+        if self.closed or self.should_close:
+            raise socket.error("Connection is closed")
+
+        if self.out_buffer_size + len(data) > self.max_out_buffer_size and self.out_buffer:
+            if self.overflow_policy == self.OVERFLOW_DROP:
+                return False
+            if self.overflow_policy == self.OVERFLOW_DISCONNECT:
+                self.should_close = True
+                self._notify_output()
+                raise socket.error("Outbound buffer overflow")
+            if can_block:
+                while self.out_buffer and self.out_buffer_size + len(data) > self.max_out_buffer_size:
+                    self.send_condition.wait(1)
+                    if self.closed or self.should_close:
+                        raise socket.error("Connection is closed")
+
+        if not self.out_buffer:
+            try:
+                sent = self.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except socket.error:
+                self.should_close = True
+                self._notify_output()
+                raise
+            data = data[sent:]
+
+        if data:
+            self.out_buffer.append(data)
+            self.out_buffer_size += len(data)
+            self._notify_output()
+        return True
+
+    def _notify_output(self):
+        """
+        Notify the network loop there is something to do with this connection.
+        :return: nothing
+        """
+        if self.on_output is not None:
+            self.on_output(self)
+
+    def send(self, data, can_block=True):
+        """
+        Send data to the client. Raises socket.error if the connection is closed.
+        :param data: bytes to send
+        :param can_block: if False, "block" overflow policy will not wait for buffer space
+        :return: number of bytes sent (or queued), 0 if data is dropped
+        """
+        with self.send_lock:
+            if not self._enqueue(data, can_block):
+                return 0
+        return len(data)
+
+    def send_message(self, message, can_block=True):
+        """
+        Encode the message and send it to the client. Raises socket.error if the connection is closed.
+        :param message: message, a dictionary or a list
+        :param can_block: if False, "block" overflow policy will not wait for buffer space
+        :return: bytes sent (or queued), None if the message is dropped
+        """
+        with self.send_lock:
+            # Dropped response must not become a part of the compressed stream, the client will never see it
+            compressor = None
+            if self.compressor is not None and self.overflow_policy == self.OVERFLOW_DROP:
+                compressor = self.compressor.copy()
+            data = self.encode(message)
+            if not self._enqueue(data, can_block):
+                if compressor is not None:
+                    self.compressor = compressor
+                return None
+        return data
+
+    def set_protocol(self, protocol, encoding, response):
+        """
+        Switch protocol of the connection. The response is sent using current protocol, everything after it -
+        using the new one.
+        :param protocol: protocol version
+        :param encoding: encoding of responses
+        :param response: response to the protocol change query
+        :return: bytes sent
+        """
+        with self.send_lock:
+            data = self.encode(response)
+            self._enqueue(data, False)
+            self.protocol = protocol
+            self.encoding = encoding
+        return data
+
+    def set_compression(self, compression, threshold, level, stream):
+        """
+        Set compression of responses, protocol version 2 only.
+        :param compression: COMPRESSION_ZLIB or COMPRESSION_NONE
+        :param threshold: responses smaller than this are not compressed, in bytes
+        :param level: zlib compression level, 0-9
+        :param stream: if True, all compressed responses are parts of one zlib stream
+        :return: nothing
+        """
+        with self.send_lock:
+            self.compression = compression
+            self.compression_threshold = threshold
+            self.compression_level = level
+            self.compressor = None
+            if compression == self.COMPRESSION_ZLIB and stream:
+                self.compressor = zlib.compressobj(level)
+
+    def has_output(self):
+        """Check if there is data waiting to be sent"""
+        with self.send_lock:
+            return bool(self.out_buffer)
+
+    def flush(self):
+        """
+        Send as much data from the outbound buffer as the socket will accept without blocking.
+        :return: False if sending failed and the connection should be closed, True otherwise
+        """
+        with self.send_lock:
+            try:
+                while self.out_buffer:
+                    data = self.out_buffer[0]
+                    sent = self.sock.send(data)
+                    self.out_buffer_size -= sent
+                    if sent < len(data):
+                        self.out_buffer[0] = data[sent:]
+                        break
+                    self.out_buffer.popleft()
+            except (BlockingIOError, InterruptedError):
+                pass
+            except socket.error:
+                self.should_close = True
+            self.send_condition.notify_all()
+            return not self.should_close
+
+    def close(self):
+        """
+        Close the connection
+        :return: nothing
+        """
+        with self.send_lock:
+            self.closed = True
+            self.send_condition.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
@@ -0,0 +1,255 @@
+"""
+This is a direct session module of Yandex Transport Core.
+
+Direct fetch mode loads the page in the browser once, then makes the same API queries directly over HTTP,
+with cookies, CSRF token and user agent of the browser. Queries pages made are remembered, and turned into
+templates for pages of the same kind, so new pages of known kind don't need the browser either.
+"""
+
+import re
+import time
+import gzip
+import zlib
+import http.client
+import urllib.parse
+from collections import OrderedDict
+
+
+class DirectSession:
+    """
+    Browser session and API queries pages made, for direct fetch mode.
+    """
+    # Page URL values shorter than this are never taken for parameters of API queries made for the page,
+    # too likely to match by chance
+    TEMPLATE_MIN_VALUE = 3
+
+    def __init__(self):
+        # Browser session used for API queries over HTTP,
+        # {"cookies": Cookie header, "csrf_token", "user_agent", "time"}, None - the page should be loaded again.
+        self.session = None
+        # How long the browser session is used before the page is loaded again, in secs
+        self.ttl = 600
+        # API queries the page made, (url, api_method) -> array of {"url", "method"}, least recently used first
+        self.queries = OrderedDict()
+        self.queries_max = 1000
+        # API queries the page made, as templates filled with values of another page URL of the same shape,
+        # (api_method, page shape) -> {"url": page url, "queries": template, "verified"}, least recently used first.
+        # Template is used only after two different pages made the same queries with it.
+        self.templates = OrderedDict()
+        # Keep-alive HTTP connections for direct queries, (scheme, host) -> connection
+        self.http_connections = {}
+        self.http_timeout = 10
+
+    def is_active(self):
+        """
+        Check if there is a browser session to use, expired session is dropped.
+        :return: True if the session can be used
+        """
+        if self.session is None:
+            return False
+        if time.time() - self.session['time'] > self.ttl:
+            self.session = None
+            return False
+        return True
+
+    def drop(self, template_key=None):
+        """
+        Drop the session, so the page will be loaded in the browser again.
+        :param template_key: key of the template which failed, it has to be verified again, None - no template
+        :return: nothing
+        """
+        self.session = None
+        if template_key is not None:
+            self.templates.pop(template_key, None)
+
+    def save(self, url, api_method, last_query, cookies, user_agent):
+        """
+        Save the browser session and API queries the page made, so the same queries can be made directly later.
+        :param url: url of the page
+        :param api_method: tuple of API methods requested
+        :param last_query: array of {"url", "method", ...}, API queries found on the page
+        :param cookies: cookies of the browser, array of {"name", "value", ...}
+        :param user_agent: user agent of the browser
+        :return: nothing
+        """
+        csrf_token = None
+        for query in last_query:
+            values = urllib.parse.parse_qs(urllib.parse.urlsplit(query['url']).query).get('csrfToken')
+            if values:
+                csrf_token = values[0]
+                break
+
+        self.session = {"cookies": '; '.join(cookie['name'] + '=' + cookie['value'] for cookie in cookies),
+                        "csrf_token": csrf_token,
+                        "user_agent": user_agent,
+                        "time": time.time()}
+        self.queries[(url, api_method)] = [{"url": query['url'], "method": query['method']} for query in last_query]
+        self.queries.move_to_end((url, api_method))
+        while len(self.queries) > self.queries_max:
+            self.queries.popitem(last=False)
+
+        shape, page_values = self.get_page_values(url)
+        template = self.make_template(page_values, last_query)
+        key = (api_method, shape)
+        known = self.templates.get(key)
+        if known is not None and known['url'] != url and known['queries'] == template:
+            known['verified'] = True
+        elif known is None or known['queries'] != template:
+            self.templates[key] = {"url": url, "queries": template, "verified": False}
+        self.templates.move_to_end(key)
+        while len(self.templates) > self.queries_max:
+            self.templates.popitem(last=False)
+
+    @staticmethod
+    def get_page_values(url):
+        """
+        Split the page URL into its shape and values, pages of the same kind (like stop pages) have the same shape.
+        :param url: url of the page
+        :return: (scheme, host, number of path segments, names of parameters), {("path", index) or
+                 ("query", name): value}
+        """
+        parts = urllib.parse.urlsplit(url)
+        segments = parts.path.split('/')
+        params = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        page_values = {('path', index): segment for index, segment in enumerate(segments)}
+        page_values.update((('query', name), value) for name, value in params)
+        shape = (parts.scheme, parts.netloc, len(segments), tuple(sorted(name for name, _ in params)))
+        return shape, page_values
+
+    def make_template(self, page_values, last_query):
+        """
+        Make a template of API queries the page made: parameters equal to a value of the page URL refer to it,
+        the CSRF token is taken from the session, all others are kept as they are.
+        :param page_values: values of the page URL, from get_page_values
+        :param last_query: array of {"url", "method", ...}, API queries the page made
+        :return: tuple of (method, url without parameters, tuple of (name, "page"/"session"/"value", value))
+        """
+        value_keys = {}
+        for page_key, value in sorted(page_values.items()):
+            if len(value) >= self.TEMPLATE_MIN_VALUE:
+                value_keys.setdefault(value, page_key)
+        template = []
+        for query in last_query:
+            parts = urllib.parse.urlsplit(query['url'])
+            params = []
+            for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True):
+                if name == 'csrfToken':
+                    params.append((name, 'session', None))
+                elif value in value_keys:
+                    params.append((name, 'page', value_keys[value]))
+                else:
+                    params.append((name, 'value', value))
+            template.append((query['method'], urllib.parse.urlunsplit(parts[:3] + ('', '')), tuple(params)))
+        return tuple(template)
+
+    def fill_template(self, template, page_values):
+        """
+        Make API queries for the page from a template.
+        :param template: template of API queries, from make_template
+        :param page_values: values of the page URL, from get_page_values
+        :return: array of {"url", "method"}
+        """
+        queries = []
+        for method, base_url, params in template:
+            values = []
+            for name, kind, value in params:
+                if kind == 'session':
+                    value = self.session['csrf_token'] or ''
+                elif kind == 'page':
+                    value = page_values[value]
+                values.append((name, value))
+            queries.append({"url": base_url + '?' + urllib.parse.urlencode(values), "method": method})
+        return queries
+
+    def find_queries(self, url, api_method):
+        """
+        Find API queries to make directly for the page: the ones the page made before, or ones made from
+        the verified template of pages of the same kind if the page was never loaded.
+        :param url: url of the page
+        :param api_method: tuple of API methods requested
+        :return: (array of {"url", "method"}, key of the template used or None), (None, None) if not found
+        """
+        last_query = self.queries.get((url, api_method))
+        if last_query is not None:
+            return last_query, None
+        shape, page_values = self.get_page_values(url)
+        template = self.templates.get((api_method, shape))
+        if template is None or not template['verified']:
+            return None, None
+        return self.fill_template(template['queries'], page_values), (api_method, shape)
+
+    def mark_used(self, url, api_method, template_key):
+        """
+        Mark queries of the page (or the template they were made from) as recently used.
+        :param url: url of the page
+        :param api_method: tuple of API methods requested
+        :param template_key: key of the template used, from find_queries, None - queries of the page itself
+        :return: nothing
+        """
+        if template_key is None:
+            self.queries.move_to_end((url, api_method))
+        else:
+            self.templates.move_to_end(template_key)
+
+    def get_query_url(self, query_url):
+        """
+        Put CSRF token of the session into the API query URL, queries saved with an older session have an old one.
+        :param query_url: URL of the API query
+        :return: URL of the API query
+        """
+        if self.session['csrf_token'] is None:
+            return query_url
+        return re.sub('([?&]csrfToken=)[^&]*',
+                      lambda res: res.group(1) + urllib.parse.quote(self.session['csrf_token']),
+                      query_url)
+
+    def close_http_connections(self):
+        """
+        Close keep-alive HTTP connections of direct queries
+        :return: nothing
+        """
+        for connection in self.http_connections.values():
+            connection.close()
+        self.http_connections = {}
+
+    def http_get(self, url, referer):
+        """
+        Make HTTP GET request with the browser session, over a keep-alive connection.
+        Raises OSError, http.client.HTTPException, zlib.error or EOFError (broken gzip body) if failed.
+        :param url: URL to get
+        :param referer: url of the page which makes the request
+        :return: status, body string
+        """
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        headers = {'Cookie': self.session['cookies'],
+                   'User-Agent': self.session['user_agent'],
+                   'Referer': referer,
+                   'Accept': 'application/json',
+                   'Accept-Encoding': 'gzip'}
+        # Server may have closed the idle keep-alive connection, trying again with a new one once
+        for attempt in range(2):
+            connection = self.http_connections.get(key)
+            if connection is None:
+                if parts.scheme == 'https':
+                    connection = http.client.HTTPSConnection(parts.netloc, timeout=self.http_timeout)
+                else:
+                    connection = http.client.HTTPConnection(parts.netloc, timeout=self.http_timeout)
+                self.http_connections[key] = connection
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                if response.getheader('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                break
+            except (OSError, http.client.HTTPException, zlib.error, EOFError):
+                connection.close()
+                del self.http_connections[key]
+                if attempt == 1:
+                    raise
+        if response.will_close:
+            connection.close()
+            del self.http_connections[key]
+        return response.status, body.decode('utf-8', errors='replace')
@@ -0,0 +1,362 @@
+"""
+This is an executor worker module of Yandex Transport Proxy.
+
+Executor workers take queries from the Query Queue and execute them in their own browsers.
+"""
+
+import time
+import threading
+from selenium.common.exceptions import WebDriverException
+from yandex_transport_core.yandex_transport_core import YandexTransportCore
+from yandex_transport_core.worker_thread import WorkerThread
+
+
+class ExecutorThread(WorkerThread):
+    """
+    Executor thread, picks and executes queries from Query Queue.
+    There can be several of them (workers), each one owns its own YandexTransportCore (and Chromium) instance.
+    """
+    def __init__(self, app, worker_id, core):
+        super().__init__(app, worker_id, core)
+
+        # Query currently being executed by this worker, None if idle. Protected by app.queue_lock.
+        self.current_query = None
+
+        # Flag to check if exeturoe thread is running.
+        # In case it fails - program should terminate / Executor Thread should restart.
+        # Let's stick with "terminate" scenario for now
+
+        # How long the first query to Yandex took, in secs, None if there were none yet
+        self.first_query_time = None
+
+        # URL of the last page loaded from Yandex, used to warm up the standby browser
+        self.last_url = None
+
+        # Standby core, started in background when the browser of this worker should be recycled,
+        # swapped with the current one between queries when ready.
+        self.standby_core = None
+        self.standby_thread = None
+        # Don't try to start the standby browser before this time (time.time()), if it failed to start
+        self.standby_retry_time = 0
+        # Threads stopping replaced browsers, joined when the worker stops
+        self.stopping_threads = []
+
+    def execute_get_info(self, query):
+        """
+        Execute general get... query.
+        :param query: internal 'query' dictionary
+        :return: True if Yandex data was received, False otherwise
+        """
+        if query['type'] not in YandexTransportCore.QUERY_API_METHODS:
+            return False
+
+        # Results are sent as soon as they are extracted, the end of results is marked by the final message
+        # with "expect_more_data": False. Clients which cancelled the query will not get the rest,
+        # clients subscribing to the query while it's executing get everything sent before (see send_query_results).
+        payload = []
+        error = YandexTransportCore.RESULT_OK
+        try:
+            for entry, error in self.core.iter_info(query['type'], query['body']):
+                if entry is None:
+                    break
+                payload.append(self.make_result(query['id'], entry))
+                self.app.send_query_results(query, payload)
+        except WebDriverException as e:
+            # Browser failed in the middle of the query, subscribers get the error instead of waiting forever
+            self.app.log.error("Worker " + str(self.worker_id) + " : exception (execute_get_info): " + str(e))
+            error = YandexTransportCore.RESULT_GET_ERROR
+
+        # Only responses with actual Yandex data are worth caching
+        cacheable = error != YandexTransportCore.RESULT_GET_ERROR and \
+            any(entry['error'] == self.app.RESULT_OK for entry in payload)
+
+        if error == YandexTransportCore.RESULT_GET_ERROR:
+            result = {'id': query['id'],
+                      'method': query['type'],
+                      'error': self.app.RESULT_GET_ERROR,
+                      'message': 'Error getting requested URL',
+                      'expect_more_data': False}
+            payload.append(result)
+        elif not payload:                             # Same as "if len(payload) == 0:"
+            result = {'id': query['id'],
+                      'method': query['type'],
+                      'error': self.app.RESULT_NO_YANDEX_DATA,
+                      'message': 'No Yandex Masstransit API data received for method ' + query['type'] +
+                                 ' from URL "' + query['body'] + '"',
+                      'expect_more_data': False}
+            payload.append(result)
+        else:
+            result = {'id': query['id'],
+                      'method': query['type'],
+                      'error': self.app.RESULT_OK,
+                      'message': 'End of data',
+                      'expect_more_data': False}
+            payload.append(result)
+
+        # Same result goes to every client which asked for the same thing while the query was waiting or executing
+        self.app.send_query_results(query, payload, final=True, cacheable=cacheable)
+
+        return cacheable
+
+    def execute_get_echo(self, query):
+        """
+        Execute "getEcho" command.
+        :param query: internal query structure
+        :return: None
+        """
+        result = {'id': query['id'],
+                  'method': query['type'],
+                  'error': self.app.RESULT_OK,
+                  'message': 'OK',
+                  'expect_more_data': False,
+                  'data': query['body']}
+        self.app.send_payload([result], self.app.detach_query(query))
+
+    def execute_get_stop_info(self, query):
+        """
+        Execute get_stop_info query
+        :param query: internal query structure
+        :return: True if Yandex data was received, False otherwise
+        """
+        self.app.log.debug("Executing " + "getStopInfo" + " query:"
+                           " ID=" + str(query['id']) +
+                           " Body=" + str(query['body']))
+        return self.execute_get_info(query)
+
+    def execute_get_route_info(self, query):
+        """
+        Execute get_route_info query
+        :param query: internal query structure
+        :return: True if Yandex data was received, False otherwise
+        """
+        self.app.log.debug("Executing " + "getRouteInfo" + " query:"
+                           " ID=" + str(query['id']) +
+                           " URL=" + str(query['body']))
+        return self.execute_get_info(query)
+
+    def execute_get_line(self, query):
+        """
+        Execute get_line query
+        :param query: internal query structure
+        :return: True if Yandex data was received, False otherwise
+        """
+        self.app.log.debug("Executing " + "getLine" + " query:"
+                           " ID=" + str(query['id']) +
+                           " URL=" + str(query['body']))
+        return self.execute_get_info(query)
+
+    def execute_get_vehicles_info(self, query):
+        """
+        Execute get_vehicles_info query
+        :param query: internal query structure
+        :return: True if Yandex data was received, False otherwise
+        """
+        self.app.log.debug("Executing " + "getVehiclesInfo" + " query:"
+                           " ID=" + str(query['id']) +
+                           " URL=" + str(query['body']))
+        return self.execute_get_info(query)
+
+    def execute_get_vehicles_info_with_region(self, query):
+        """
+        Execute get_vehicles_info_with_region query
+        :param query: internal query structure
+        :return: True if Yandex data was received, False otherwise
+        """
+        self.app.log.debug("Executing " + "getVehiclesInfoWithRegion" + " query:"
+                           " ID=" + str(query['id']) +
+                           " URL=" + str(query['body']))
+        return self.execute_get_info(query)
+
+    def execute_get_layer_regions(self, query):
+        """
+        Execute get_layer_regions query
+        :param query: internal query structure
+        :return: True if Yandex data was received, False otherwise
+        """
+        self.app.log.debug("Executing " + "getLayersRegion" + " query:"
+                           " ID=" + str(query['id']) +
+                           " URL=" + str(query['body']))
+        return self.execute_get_info(query)
+
+    def execute_get_all_info(self, query):
+        """
+        Execute get_all_info query
+        :param query: internal query structure
+        :return: True if Yandex data was received, False otherwise
+        """
+        self.app.log.debug("Executing " + "getAllInfo" + " query:" +
+                           " ID=" + str(query['id']) +
+                           " URL=" + str(query['body']))
+        return self.execute_get_info(query)
+
+    def execute_query(self, query):
+        """
+        Execute query from the Query Queue
+        :param query: query inner structure {'id', 'type', 'body'}
+        :return: True if Yandex data was received, False otherwise, None for queries not going to Yandex
+        """
+        if query['type'] == 'getEcho':
+            self.execute_get_echo(query)
+            return None
+        executors = {'getStopInfo': self.execute_get_stop_info,
+                     'getRouteInfo': self.execute_get_route_info,
+                     'getLine': self.execute_get_line,
+                     'getVehiclesInfo': self.execute_get_vehicles_info,
+                     'getVehiclesInfoWithRegion': self.execute_get_vehicles_info_with_region,
+                     'getLayerRegions': self.execute_get_layer_regions,
+                     'getAllInfo': self.execute_get_all_info}
+        if query['type'] not in executors:
+            return None
+        return executors[query['type']](query)
+
+    def perform_query_extraction_and_execution(self):
+        """
+        Extract and execute query from Query Queue
+        :return: time in secs to wait before the next query can be executed,
+                 0 if it can be executed right away, None if the Query Queue is empty
+        """
+        # Default "discard" query
+        query = None
+        wait_time = None
+
+        # Get the query from Query Queue, it is removed from the queue right away so other workers
+        # will not pick it up, and is remembered as "current query" of this worker until executed.
+        # Queries nobody is waiting for anymore (all deadlines expired) are skipped.
+        # Queries going to Yandex stay in the queue until the rate limiter lets them go,
+        # ones loading the page in the browser wait for the navigation limiter too.
+        expired = []
+        self.app.queue_lock.acquire()
+        while self.app.query_queue:
+            query = self.app.query_queue.peek()
+            expired += self.app.remove_subscribers(query, self.app.is_subscriber_expired)
+            if not query['subscribers']:
+                query = None
+                continue
+            if query['type'] in self.app.UPSTREAM_QUERIES:
+                wait_time = self.app.rate_limiter.try_acquire()
+                # Loading the page takes a token of its own
+                if wait_time == 0 and self.core.needs_browser(query['type'], query['body']):
+                    wait_time = self.app.navigation_limiter.try_acquire()
+                    if wait_time > 0:
+                        self.app.rate_limiter.release()
+                if wait_time > 0:
+                    query = None
+                    break
+            self.app.query_queue.popleft()
+            self.current_query = query
+            wait_time = 0
+            break
+        self.app.queue_lock.release()
+        self.app.send_deadline_expired(expired)
+
+        # Executing the query
+        if query is not None:
+            if query['type'] in self.app.UPSTREAM_QUERIES:
+                self.last_url = query['body']
+            start_time = time.time()
+            try:
+                success = self.execute_query(query)
+            finally:
+                # Identical queries arriving from now on start fresh, even if this one failed unexpectedly
+                self.app.detach_query(query)
+                # Marking this worker as idle
+                self.app.queue_lock.acquire()
+                self.current_query = None
+                self.app.queue_lock.release()
+            if success is not None and self.first_query_time is None:
+                self.first_query_time = time.time() - start_time
+            if success is not None:
+                backoff = self.app.rate_limiter.report(success)
+                if backoff > 0:
+                    self.app.log.error("No data from Yandex " + str(self.app.rate_limiter.failures) +
+                                       " times in a row, backing off for " + str(backoff) + " secs.")
+
+        return wait_time
+
+    def run(self):
+        self.app.log.debug("Executor thread " + str(self.worker_id) + " started.")
+        # Queries received meanwhile wait in the Query Queue
+        # None if the server was stopped before the browser started, then the loop below is skipped
+        self.startup_time = self.keep_starting_core("worker " + str(self.worker_id))
+        if self.startup_time is not None:
+            self.ready_time = time.time() - self.app.start_time
+            self.ready = True
+
+        while self.app.is_running:
+            # Replacing the browser if it's old, between queries
+            self.check_recycling()
+
+            # Queries added after this point will wake the worker up, even if they arrive before it starts waiting
+            sequence = self.app.query_queue.sequence
+
+            # Extracting and executing extraction and execution of query from Query Queue
+            wait_time = self.perform_query_extraction_and_execution()
+            if wait_time == 0:
+                continue
+
+            # Waiting for new queries (wait_time is None), or for the rate limiter
+            self.app.queue_lock.acquire()
+            if self.app.is_running and self.app.query_queue.sequence == sequence:
+                self.app.queue_condition.wait(wait_time)
+            self.app.queue_lock.release()
+
+        # Standby browser is not needed anymore
+        if self.standby_thread is not None:
+            self.standby_thread.join()
+        if self.standby_core is not None:
+            self.standby_core.stop_webdriver()
+            self.standby_core = None
+        # Replaced browsers should be gone too
+        for thread in self.stopping_threads:
+            thread.join()
+        self.stopping_threads = []
+        self.app.log.debug("Executor thread " + str(self.worker_id) + " stopped.")
+
+    def check_recycling(self):
+        """
+        Start standby browser in background if the current one should be recycled,
+        and swap it in once it's ready. Current browser keeps executing queries meanwhile.
+        :return: nothing
+        """
+        if self.standby_thread is not None:
+            if self.standby_thread.is_alive():
+                return
+            self.standby_thread = None
+            if self.standby_core is not None:
+                old_core = self.core
+                self.core = self.standby_core
+                self.standby_core = None
+                self.app.log.info("Worker " + str(self.worker_id) + " : switched to standby browser.")
+                # Browser may take a while to quit, not waiting for it
+                self.stopping_threads = [thread for thread in self.stopping_threads if thread.is_alive()]
+                stopping_thread = threading.Thread(target=old_core.stop_webdriver, daemon=True)
+                stopping_thread.start()
+                self.stopping_threads.append(stopping_thread)
+            return
+
+        if time.time() < self.standby_retry_time:
+            return
+        reason = self.core.get_recycle_reason()
+        if reason is None:
+            return
+        self.app.log.info("Worker " + str(self.worker_id) + " : browser should be recycled (" + reason + "), "
+                          "starting standby browser...")
+        self.standby_thread = threading.Thread(target=self.start_standby, daemon=True)
+        self.standby_thread.start()
+
+    def start_standby(self):
+        """
+        Start and warm up standby browser, runs in background.
+        :return: nothing
+        """
+        core = self.app.create_core()
+        try:
+            core.start_webdriver()
+        except WebDriverException as e:
+            self.app.log.error("Worker " + str(self.worker_id) + " : failed to start standby browser, " + str(e))
+            self.standby_retry_time = time.time() + self.app.recycle_retry_interval
+            return
+        # Warming up loads the page, skipped if the navigation limiter says so
+        if self.app.navigation_limiter.try_acquire() == 0:
+            core.warm_up(self.last_url)
+        self.standby_core = core
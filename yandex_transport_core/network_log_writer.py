@@ -0,0 +1,157 @@
+"""
+This is a network log module of Yandex Transport Proxy.
+
+Everything the server sends to clients can be logged to a file for debugging, writing is done in background,
+so slow disk never delays the responses.
+"""
+
+import os
+import time
+import gzip
+import shutil
+import queue
+import threading
+from yandex_transport_core.logger import Logger
+
+
+class NetworkLogWriter(threading.Thread):
+    """
+    Network log writer, writes everything the server sends via network to a file, in background.
+    Senders only put data to the bounded in-memory queue (data is dropped if the queue is full),
+    the writer appends it to the log file in batches. Log file is rotated when it's too big or too old,
+    rotated files are compressed with gzip unless compress is False.
+    """
+    # Maximum number of records written in one batch
+    BATCH_SIZE = 100
+
+    def __init__(self, file_name, max_size=64*1024*1024, max_age=24*60*60, compress=True, queue_size=1000):
+        super().__init__()
+        self.daemon = True
+
+        # Log file name, rotated files get timestamp appended to it
+        self.file_name = file_name
+        # Rotate the log file if it's bigger than this, in bytes
+        self.max_size = max_size
+        # Rotate the log file if it's older than this, in secs
+        self.max_age = max_age
+        # Compress rotated log files
+        self.compress = compress
+
+        # Records waiting to be written
+        self.queue = queue.Queue(maxsize=queue_size)
+        # Number of records dropped because the queue was full
+        self.dropped = 0
+
+        # Logger for disk errors, the writer keeps running if the log can't be written
+        self.log = Logger(Logger.INFO)
+
+        self.is_running = True
+        self.file = None
+        self.file_opened_time = 0
+
+    def write(self, data):
+        """
+        Put data to the log, never blocks.
+        :param data: bytes sent via network
+        :return: True if data is queued, False if dropped
+        """
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def stop(self):
+        """
+        Stop the writer, everything already queued will be written.
+        :return: nothing
+        """
+        self.is_running = False
+        try:
+            # Waking the writer up
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self.join()
+
+    def run(self):
+        while self.is_running or not self.queue.empty():
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                self.rotate_if_needed()
+                continue
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [data for data in batch if data is not None]
+            if batch:
+                self.write_batch(batch)
+            self.rotate_if_needed()
+
+        self.close_file()
+
+    def write_batch(self, batch):
+        """
+        Append records to the log file.
+        :param batch: list of bytes
+        :return: nothing
+        """
+        try:
+            if self.file is None:
+                self.file = open(self.file_name, 'ab')
+                self.file_opened_time = time.time()
+            for data in batch:
+                self.file.write(bytes(str(len(data)) + '\n', 'utf-8'))
+                self.file.write(data)
+                self.file.write(bytes('\n\n', 'utf-8'))
+            self.file.flush()
+        except OSError as e:
+            # Disk full or the file is gone, the batch is lost, next one tries to open the file again
+            self.log.error("Failed to write network log " + self.file_name + " : " + str(e))
+            self.dropped += len(batch)
+            self.close_file()
+
+    def rotate_if_needed(self):
+        """
+        Rotate the log file if it's too big or too old.
+        :return: nothing
+        """
+        if self.file is None:
+            return
+        if self.file.tell() < self.max_size and time.time() - self.file_opened_time < self.max_age:
+            return
+
+        self.close_file()
+        base_file_name = self.file_name + '.' + time.strftime('%Y%m%d-%H%M%S')
+        rotated_file_name = base_file_name
+        suffix = 0
+        # Compressed file of an earlier rotation within the same second counts as taken too
+        while os.path.exists(rotated_file_name) or os.path.exists(rotated_file_name + '.gz'):
+            suffix += 1
+            rotated_file_name = base_file_name + '.' + str(suffix)
+        try:
+            os.rename(self.file_name, rotated_file_name)
+            if self.compress:
+                with open(rotated_file_name, 'rb') as source, \
+                        gzip.open(rotated_file_name + '.gz', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(rotated_file_name)
+        except OSError as e:
+            self.log.error("Failed to rotate network log " + self.file_name + " : " + str(e))
+
+    def close_file(self):
+        """
+        Close the log file, if it's open.
+        :return: nothing
+        """
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        except OSError as e:
+            self.log.error("Failed to close network log " + self.file_name + " : " + str(e))
+        self.file = None
@@ -0,0 +1,531 @@
+"""
+This is a network server module of Yandex Transport Proxy.
+
+All client connections are served by a single network loop, which reads queries and sends responses
+when sockets are ready. Messages can be sent from any thread, the loop is woken up to send them.
+"""
+
+import json
+import time
+import socket
+import selectors
+import threading
+from urllib.parse import parse_qsl
+from yandex_transport_core.logger import Logger
+from yandex_transport_core.client_connection import ClientConnection, msgpack
+from yandex_transport_core.network_log_writer import NetworkLogWriter
+
+
+class NetworkServer:
+    """
+    Network server, base of the application. Accepts client connections, reads queries from them
+    and passes them to process_query(), sends messages to clients.
+    """
+    # Error codes
+    RESULT_OK = 0
+    RESULT_SOCKET_BIND_FAILED = 1
+
+    # Size of the buffer to read incoming data
+    RECV_BUFFER_SIZE = 4096
+
+    def __init__(self):
+        self.is_running = True  # If set to false, the server will begin to terminate itself
+
+        # When the server was started (time.time()), and how long it took to start listening, in secs
+        self.start_time = time.time()
+        self.listen_time = None
+
+        # Listen address
+        self.host = '0.0.0.0'
+        # Listen port
+        self.port = 25555
+
+        # Maximum number of pending incoming connections
+        self.backlog = 128
+
+        # Clients currently connected to the server, address -> ClientConnection
+        self.connections = {}
+
+        # Selector of the network loop, watches listening socket and all client connections
+        self.selector = None
+
+        # Thread running the network loop
+        self.network_thread = None
+
+        # Socket pair to wake up the network loop from other threads
+        self.wakeup_receiver = None
+        self.wakeup_sender = None
+
+        # Connections which have new data to send or should be closed, processed by the network loop
+        self.pending_output = set()
+        self.pending_output_lock = threading.Lock()
+
+        # Size of outbound buffer of each connection, and what to do if it overflows
+        self.send_buffer_size = 8 * 1024 * 1024
+        self.send_overflow_policy = ClientConnection.OVERFLOW_DISCONNECT
+
+        # Logger
+        self.log = Logger(Logger.INFO)
+
+        # Debug: Write EVERYTHING this thing sends via network to a file.
+        self.network_log_enabled = False
+        self.network_log_file = 'ytproxy-network.log'
+        # Rotate the network log when it's bigger than this, in bytes
+        self.network_log_size = 64 * 1024 * 1024
+        # Rotate the network log when it's older than this, in secs
+        self.network_log_age = 24 * 60 * 60
+        # Compress rotated network logs with gzip
+        self.network_log_compress = True
+        # Network log writer, writes in background
+        self.network_log = None
+
+    def sigterm_handler(self, _signal, _time):
+        """
+        SIGTERM handler, will simply pass to SIGINT handler.
+        :param _signal:
+        :param _time:
+        :return:
+        """
+        self.log.info("SIGTERM received! Terminating the program...")
+        self.sigint_handler(_signal, _time)
+
+    def sigint_handler(self, _signal, _time):
+        """
+        SIGINT signal handler
+        :param _signal: signal
+        :param _time: time
+        :return: nothing
+        """
+        self.log.info("SIGINT received! Terminating the program...")
+        # Signal may come while the main thread holds a lock, so only the network loop is woken up here,
+        # it exits and the application stops the rest.
+        self.is_running = False
+        self.wakeup()
+        self.log.info("Waiting for threads to terminate...")
+
+    def process_query(self, query, conn):
+        """
+        Process single query received from the client, implemented by the application.
+        :param query: query string
+        :param conn: ClientConnection
+        :return: nothing
+        """
+        raise NotImplementedError
+
+    def process_loop_iteration(self):
+        """
+        Called by the network loop on each iteration, at least once a second.
+        :return: False if the server should stop
+        """
+        return True
+
+    def connection_closed(self, conn):
+        """
+        Called when the client connection is closed.
+        :param conn: ClientConnection
+        :return: nothing
+        """
+
+    def add_network_arguments(self, parser):
+        """
+        Add CLI arguments of the network server
+        :param parser: argparse.ArgumentParser
+        :return: nothing
+        """
+        parser.add_argument("--host", default=self.host,
+                            help="host to listen on, default is " + str(self.host))
+        parser.add_argument("--port", default=self.port,
+                            help="port to listen on, default is " + str(self.port))
+        parser.add_argument("--backlog", default=self.backlog,
+                            help="maximum number of pending incoming connections, default is " + str(self.backlog))
+        parser.add_argument("--send-buffer", default=self.send_buffer_size // 1024,
+                            help="size of outbound buffer of each connection, in kilobytes, default is " +
+                            str(self.send_buffer_size // 1024) + " KB")
+        parser.add_argument("--send-overflow", default=self.send_overflow_policy,
+                            choices=[ClientConnection.OVERFLOW_DROP, ClientConnection.OVERFLOW_DISCONNECT,
+                                     ClientConnection.OVERFLOW_BLOCK],
+                            help="what to do if a client is too slow and its outbound buffer is full,\n"
+                            "default is " + str(self.send_overflow_policy) + "\n"
+                            "   drop       : drop the message\n"
+                            "   disconnect : close the connection\n"
+                            "   block      : wait until the client receives enough data")
+        parser.add_argument("--network-log", action="store_true", default=self.network_log_enabled,
+                            help="write everything the server sends via network to " + self.network_log_file)
+        parser.add_argument("--network-log-size", default=self.network_log_size // (1024 * 1024),
+                            help="rotate the network log when it's bigger than this, in megabytes, default is " +
+                            str(self.network_log_size // (1024 * 1024)) + " MB.")
+        parser.add_argument("--network-log-age", default=self.network_log_age // 3600,
+                            help="rotate the network log when it's older than this, in hours, default is " +
+                            str(self.network_log_age // 3600) + " hours.")
+        parser.add_argument("--network-log-compress", dest="network_log_compress", action="store_true",
+                            default=self.network_log_compress,
+                            help="compress rotated network logs with gzip, default is " +
+                            str(self.network_log_compress) + ".")
+        parser.add_argument("--no-network-log-compress", dest="network_log_compress", action="store_false",
+                            help="keep rotated network logs uncompressed.")
+
+    def apply_network_arguments(self, args):
+        """
+        Apply parsed CLI arguments of the network server
+        :param args: parsed arguments
+        :return: nothing
+        """
+        self.host = str(args.host)
+        self.port = int(args.port)
+        self.backlog = int(args.backlog)
+        self.send_buffer_size = int(args.send_buffer) * 1024
+        self.send_overflow_policy = args.send_overflow
+        self.network_log_enabled = args.network_log
+        self.network_log_size = int(args.network_log_size) * 1024 * 1024
+        self.network_log_age = float(args.network_log_age) * 3600
+        self.network_log_compress = args.network_log_compress
+
+    def start_network_log(self):
+        """
+        Start network log writer, if the network log is enabled
+        :return: nothing
+        """
+        if self.network_log_enabled:
+            self.log.info("Network log : " + self.network_log_file)
+            self.log.info("Network log rotation : " + str(self.network_log_size // (1024 * 1024)) + " MB, " +
+                          str(self.network_log_age / 3600) + " hours, compress = " + str(self.network_log_compress))
+            self.network_log = NetworkLogWriter(self.network_log_file, max_size=self.network_log_size,
+                                                max_age=self.network_log_age, compress=self.network_log_compress)
+            self.network_log.log = self.log
+            self.network_log.start()
+
+    def stop_network_log(self):
+        """
+        Stop network log writer
+        :return: nothing
+        """
+        if self.network_log is not None:
+            self.network_log.stop()
+            if self.network_log.dropped:
+                self.log.warning("Network log : " + str(self.network_log.dropped) + " records dropped")
+
+    def send_message(self, message, addr, conn, log_tag=None):
+        """
+        Send a message to the client
+        :param message: message to send, a dictionary or a list, will be encoded according to protocol of connection
+        :param addr: address (from socket bind/accept)
+        :param conn: connection
+        :param log_tag: tag which will append to log message
+        :return: size of the encoded message, in bytes
+        """
+        if log_tag is not None:
+            log_tag_text = " (" + log_tag + ")"
+        else:
+            log_tag_text = ""
+        send_msg = b''
+        try:
+            # Network loop should never wait for itself to drain the buffer
+            can_block = threading.current_thread() is not self.network_thread
+            send_msg = conn.send_message(message, can_block=can_block)
+            if send_msg is None:
+                self.log.warning("Outbound buffer is full, dropped response to " + str(addr) + log_tag_text)
+                return 0
+
+            self.log.debug("Sent response " +
+                           "(" + str(len(send_msg)) + " bytes) "
+                           "to " + str(addr) + log_tag_text)
+
+        except socket.error as e:
+            self.log.error("Failed to send data to " + str(addr))
+            self.log.error("Exception (send_message):" + str(e))
+
+        if self.network_log is not None and send_msg:
+            self.network_log.write(send_msg)
+
+        return len(send_msg)
+
+    def listen(self):
+        """
+        Start listening to incoming connections. All connections are served by a single network loop,
+        queries are passed to process_query().
+        :return: RESULT_OK, or RESULT_SOCKET_BIND_FAILED if failed to bind the socket
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.log.debug("Binding socket...")
+        try:
+            sock.bind((self.host, self.port))
+        except socket.error as e:
+            self.log.error("Exception (listen): " + str(e))
+            return self.RESULT_SOCKET_BIND_FAILED
+
+        self.log.info("Listening for incoming connections.")
+        self.log.info("Host: " + str(self.host) + " , Port: " + str(self.port))
+        sock.listen(self.backlog)
+        self.listen_time = time.time() - self.start_time
+        sock.setblocking(False)
+
+        self.open_selector()
+        self.selector.register(sock, selectors.EVENT_READ, data=None)
+
+        while self.is_running:
+            if not self.process_loop_iteration():
+                self.is_running = False
+                break
+
+            try:
+                events = self.selector.select(timeout=1)
+            except InterruptedError:
+                continue
+
+            for key, mask in events:
+                if key.fileobj is self.wakeup_receiver:
+                    self.read_wakeup()
+                elif key.data is None:
+                    self.accept_connection(key.fileobj)
+                else:
+                    if mask & selectors.EVENT_WRITE:
+                        self.write_connection(key.data)
+                    if mask & selectors.EVENT_READ:
+                        self.read_connection(key.data)
+
+            self.process_pending_output()
+
+        for conn in list(self.connections.values()):
+            self.close_connection(conn)
+        self.selector.unregister(sock)
+        sock.close()
+        self.close_selector()
+
+        return self.RESULT_OK
+
+    def open_selector(self):
+        """
+        Create selector for the network loop, and a socket pair to wake it up from other threads.
+        Network loop should run in the thread calling this function.
+        :return: nothing
+        """
+        self.network_thread = threading.current_thread()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ, data=None)
+
+    def close_selector(self):
+        """
+        Close selector of the network loop.
+        :return: nothing
+        """
+        self.selector.unregister(self.wakeup_receiver)
+        self.selector.close()
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
+
+    def wakeup(self):
+        """
+        Wake up the network loop, can be called from any thread.
+        :return: nothing
+        """
+        try:
+            self.wakeup_sender.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # Buffer is full, the loop will wake up anyway
+            pass
+        except (AttributeError, socket.error):
+            # Network loop is not running
+            pass
+
+    def read_wakeup(self):
+        """
+        Consume wake up signals.
+        :return: nothing
+        """
+        try:
+            while self.wakeup_receiver.recv(self.RECV_BUFFER_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def request_output(self, conn):
+        """
+        Ask the network loop to send data from outbound buffer of the connection (or close it).
+        Called by ClientConnection from any thread.
+        :param conn: ClientConnection
+        :return: nothing
+        """
+        with self.pending_output_lock:
+            self.pending_output.add(conn)
+        if threading.current_thread() is not self.network_thread:
+            self.wakeup()
+
+    def process_pending_output(self):
+        """
+        Start watching connections with pending output for write readiness, close connections which should be closed.
+        :return: nothing
+        """
+        with self.pending_output_lock:
+            pending_output = self.pending_output
+            self.pending_output = set()
+
+        for conn in pending_output:
+            if self.connections.get(conn.addr) is not conn:
+                continue
+            if conn.should_close:
+                self.log.warning("Closing connection ( " + str(conn.addr) + " ) : send failed or buffer overflow")
+                self.close_connection(conn)
+            elif conn.has_output():
+                self.selector.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, data=conn)
+
+    def write_connection(self, conn):
+        """
+        Send data from outbound buffer of the connection.
+        :param conn: ClientConnection
+        :return: nothing
+        """
+        if self.connections.get(conn.addr) is not conn:
+            return
+        if not conn.flush():
+            self.log.error("Failed to send data to " + str(conn.addr))
+            self.close_connection(conn)
+        elif not conn.has_output():
+            self.selector.modify(conn, selectors.EVENT_READ, data=conn)
+
+    def accept_connection(self, sock):
+        """
+        Accept new incoming connection.
+        :param sock: listening socket
+        :return: nothing
+        """
+        try:
+            client_sock, addr = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        client_sock.setblocking(False)
+        conn = ClientConnection(client_sock, addr)
+        conn.max_out_buffer_size = self.send_buffer_size
+        conn.overflow_policy = self.send_overflow_policy
+        self.register_connection(conn)
+        self.log.info("Connection established : " + str(addr))
+
+    def register_connection(self, conn):
+        """
+        Add client connection to the network loop.
+        :param conn: ClientConnection
+        :return: nothing
+        """
+        conn.on_output = self.request_output
+        self.connections[conn.addr] = conn
+        self.selector.register(conn, selectors.EVENT_READ, data=conn)
+
+    def close_connection(self, conn):
+        """
+        Remove client connection from the network loop and close it.
+        :param conn: ClientConnection
+        :return: nothing
+        """
+        if self.connections.get(conn.addr) is not conn:
+            return
+        self.selector.unregister(conn)
+        conn.close()
+        del self.connections[conn.addr]
+        self.log.debug("Connection ( " + str(conn.addr) + " ) closed")
+
+        self.connection_closed(conn)
+
+    def read_connection(self, conn):
+        """
+        Read incoming data from client connection and process queries from it.
+        :param conn: ClientConnection
+        :return: nothing
+        """
+        if self.connections.get(conn.addr) is not conn:
+            return
+        try:
+            data = conn.sock.recv(self.RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as e:
+            self.log.error("Exception (read_connection): " + str(e))
+            data = b''
+
+        if not data:
+            self.log.info("Connection terminated : " + str(conn.addr))
+            self.close_connection(conn)
+            return
+
+        if not conn.feed(data):
+            self.log.error("Query is too big, closing connection : " + str(conn.addr))
+            self.close_connection(conn)
+            return
+
+        query = conn.next_query()
+        while query is not None:
+            if query:
+                self.process_query(query, conn)
+            query = conn.next_query()
+
+    def get_current_connections(self):
+        """
+        Get current connections
+        :return: JSON containing list of current connections
+                 {"ip_address": "string", "port": "integer"}
+                   ip_address - IP address of the client
+                   port       - port of the client
+        """
+        data = []
+        # pylint: disable = W0612
+        for key, value in self.connections.items():
+            entry = {"ip_address" : key[0], "port" : key[1]}
+            data.append(entry)
+        # pylint: enable = W0612
+        json_data = json.dumps(data)
+
+        return json_data
+
+    def process_set_protocol(self, query, conn):
+        """
+        Process setProtocol?version=...&encoding=...&compression=... query,
+        switches the connection to the requested protocol.
+        If msgpack encoding is requested but not available, JSON is used.
+        Compression (zlib only) is optional, "threshold", "level" and "stream" can be set with it.
+        """
+        params = dict(parse_qsl(query.partition('?')[2]))
+        try:
+            protocol = int(params.get('version', ClientConnection.PROTOCOL_TEXT))
+        except ValueError:
+            protocol = None
+        if protocol not in (ClientConnection.PROTOCOL_TEXT, ClientConnection.PROTOCOL_BINARY):
+            response = {"response": "ERROR", "message": "Unsupported protocol version"}
+            self.send_message(response, conn.addr, conn)
+            return
+
+        encoding = ClientConnection.ENCODING_JSON
+        if params.get('encoding') == ClientConnection.ENCODING_MSGPACK and msgpack is not None:
+            encoding = ClientConnection.ENCODING_MSGPACK
+
+        compression = params.get('compression', ClientConnection.COMPRESSION_NONE)
+        try:
+            threshold = int(params.get('threshold', ClientConnection.DEFAULT_COMPRESSION_THRESHOLD))
+            level = int(params.get('level', ClientConnection.DEFAULT_COMPRESSION_LEVEL))
+        except ValueError:
+            threshold = level = None
+        stream = params.get('stream', '0') in ('1', 'true')
+        if compression not in (ClientConnection.COMPRESSION_NONE, ClientConnection.COMPRESSION_ZLIB) or \
+                threshold is None or threshold < 0 or level is None or not 0 <= level <= 9:
+            response = {"response": "ERROR", "message": "Unsupported compression"}
+            self.send_message(response, conn.addr, conn)
+            return
+        # Text protocol separates responses with '\n\0', compressed data may contain it
+        if compression != ClientConnection.COMPRESSION_NONE and protocol != ClientConnection.PROTOCOL_BINARY:
+            response = {"response": "ERROR", "message": "Compression requires protocol version 2"}
+            self.send_message(response, conn.addr, conn)
+            return
+
+        response = {"response": "OK", "protocol": protocol, "encoding": encoding}
+        if compression != ClientConnection.COMPRESSION_NONE:
+            response.update({"compression": compression, "threshold": threshold, "level": level, "stream": stream})
+        try:
+            conn.set_protocol(protocol, encoding, response)
+            conn.set_compression(compression, threshold, level, stream)
+        except socket.error as e:
+            self.log.error("Exception (process_set_protocol):" + str(e))
+            return
+        self.log.debug("Connection ( " + str(conn.addr) + " ) switched to protocol " + str(protocol) +
+                       ", encoding " + encoding + ", compression " + compression +
+                       (" (stream)" if stream and compression != ClientConnection.COMPRESSION_NONE else ""))
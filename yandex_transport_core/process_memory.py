@@ -0,0 +1,44 @@
+"""
+This is a process memory module of Yandex Transport Core.
+
+Browser is not a single process: ChromeDriver starts Chromium, which starts a process for each tab, renderer,
+GPU and so on. Memory used by the browser is the sum of memory used by all of them. Linux only, uses /proc.
+"""
+
+import os
+
+
+def get_process_tree_rss(root_pid):
+    """
+    Get resident set size of the process and all its child processes.
+    :param root_pid: PID of the process
+    :return: size in bytes, None if not available
+    """
+    # Parent PID -> child PIDs, of all processes in the system
+    children = {}
+    try:
+        pids = [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open('/proc/' + str(pid) + '/stat', 'r', encoding='ascii') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        # Process name is in parentheses and may contain spaces, parent PID is the second field after it
+        parent_pid = int(stat[stat.rfind(')') + 2:].split()[1])
+        children.setdefault(parent_pid, []).append(pid)
+
+    rss = 0
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open('/proc/' + str(pid) + '/statm', 'r', encoding='ascii') as statm_file:
+                rss += int(statm_file.read().split()[1]) * page_size
+        except OSError:
+            continue
+        pending += children.get(pid, [])
+    return rss
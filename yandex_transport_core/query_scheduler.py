@@ -0,0 +1,118 @@
+"""
+This is a query scheduler module of Yandex Transport Proxy.
+
+Queries of different clients are served in turns, so one busy client can't make everyone else wait.
+"""
+
+from collections import OrderedDict
+
+
+class QueryScheduler:
+    """
+    Query Queue with fair scheduling. Each client (connection, or a tenant key supplied by the client)
+    has its own sub-queue, sub-queues are served round-robin, one query at a time, so a client with
+    a lot of queries will not starve everyone else.
+    Inside a sub-queue queries are ordered by priority (higher first), then by arrival.
+    Not thread-safe, protected by Application.queue_lock.
+    """
+    def __init__(self):
+        # Sub-queues, tenant -> list of queries, in the order they will be served.
+        # Order of tenants is the round-robin order, the first one is served next.
+        self.queues = OrderedDict()
+
+        # Total number of queries
+        self.size = 0
+
+        # Arrival counter, to keep order of queries with the same priority
+        self.sequence = 0
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+    def __iter__(self):
+        """
+        Iterate queries in the order they are expected to be executed.
+        """
+        queues = [list(sub_queue) for sub_queue in self.queues.values()]
+        index = 0
+        while queues:
+            yield queues[index].pop(0)
+            if queues[index]:
+                index += 1
+            else:
+                del queues[index]
+            if index >= len(queues):
+                index = 0
+
+    def append(self, query):
+        """
+        Add query to the sub-queue of its tenant.
+        :param query: internal query structure, 'tenant' and 'priority' keys are used
+        :return: nothing
+        """
+        query['sequence'] = self.sequence
+        self.sequence += 1
+
+        sub_queue = self.queues.setdefault(query['tenant'], [])
+        position = len(sub_queue)
+        while position > 0 and sub_queue[position - 1]['priority'] < query['priority']:
+            position -= 1
+        sub_queue.insert(position, query)
+        self.size += 1
+
+    def peek(self):
+        """
+        Get next query to execute without removing it from the queue.
+        :return: internal query structure, None if the queue is empty
+        """
+        if not self.queues:
+            return None
+        return next(iter(self.queues.values()))[0]
+
+    def popleft(self):
+        """
+        Get next query to execute and remove it from the queue.
+        :return: internal query structure, raises IndexError if the queue is empty
+        """
+        if not self.queues:
+            raise IndexError("pop from an empty queue")
+        tenant, sub_queue = next(iter(self.queues.items()))
+        query = sub_queue.pop(0)
+        if sub_queue:
+            self.queues.move_to_end(tenant)
+        else:
+            del self.queues[tenant]
+        self.size -= 1
+        return query
+
+    def remove(self, query):
+        """
+        Remove query from the queue.
+        :param query: internal query structure
+        :return: True if the query was in the queue, False otherwise
+        """
+        sub_queue = self.queues.get(query['tenant'])
+        if sub_queue is None:
+            return False
+        for index, entry in enumerate(sub_queue):
+            if entry is query:
+                del sub_queue[index]
+                if not sub_queue:
+                    del self.queues[query['tenant']]
+                self.size -= 1
+                return True
+        return False
+
+    def position(self, query):
+        """
+        Get expected position of the query in execution order.
+        :param query: internal query structure
+        :return: position, starting from 0, None if the query is not in the queue
+        """
+        for position, entry in enumerate(self):
+            if entry is query:
+                return position
+        return None
@@ -0,0 +1,94 @@
+"""
+This is a rate limiter module of Yandex Transport Proxy.
+
+Limits how often queries go to Yandex, to lower the load on Yandex Maps and avoid being banned.
+"""
+
+import time
+import threading
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the rate of queries going to Yandex, shared by all executor workers.
+    Tokens are added at "rate" per second, up to "burst" tokens can be spent at once.
+    Several failed queries in a row (errors, no data) block the bucket for exponentially growing time.
+    Thread-safe.
+    """
+    # Backoff starts after this many failed queries in a row. Backoff time is doubled after each failure,
+    # starting with BACKOFF_BASE secs, up to BACKOFF_MAX secs.
+    BACKOFF_THRESHOLD = 3
+    BACKOFF_BASE = 5
+    BACKOFF_MAX = 300
+
+    def __init__(self, rate=None, burst=1):
+        # Tokens per second, may be fractional. None means no limit.
+        self.rate = rate
+
+        # Maximum number of tokens in the bucket, this many queries can go without waiting
+        self.burst = max(1, burst)
+
+        # Tokens currently in the bucket, and when the bucket was last refilled
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+        # Number of failed queries in a row
+        self.failures = 0
+
+        # No tokens are given until this time (time.monotonic()), because of backoff
+        self.blocked_until = 0
+
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        """
+        Add tokens for the time passed since the last refill. Lock should be acquired.
+        :param now: current time.monotonic()
+        :return: nothing
+        """
+        if self.rate is not None:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """
+        Take a token from the bucket if there is one.
+        :return: 0 if the token was taken, otherwise time in secs to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.rate is None:
+                return 0
+            self.refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def release(self):
+        """
+        Return unused token to the bucket.
+        :return: nothing
+        """
+        with self.lock:
+            self.tokens = min(float(self.burst), self.tokens + 1)
+
+    def report(self, success):
+        """
+        Report result of a query, to back off if Yandex keeps failing.
+        :param success: True if the query got data from Yandex
+        :return: backoff time in secs, 0 if no backoff
+        """
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.blocked_until = 0
+                return 0
+            self.failures += 1
+            if self.failures < self.BACKOFF_THRESHOLD:
+                return 0
+            backoff = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** (self.failures - self.BACKOFF_THRESHOLD))
+            self.blocked_until = time.monotonic() + backoff
+            return backoff
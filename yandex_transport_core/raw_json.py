@@ -0,0 +1,107 @@
+"""
+This is a raw JSON module, to pass bodies of Yandex API responses to clients as they are.
+
+Bodies are big (hundreds of KB for getLine or getLayerRegions), parsing them into Python objects only to serialize
+them again is a waste of time and memory. Instead, the body is checked cheaply and kept as bytes, and spliced into
+the response as is. When the body has to be parsed after all (like for msgpack responses), fast JSON backend
+(orjson) is used if it's installed.
+
+"""
+
+import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class RawJSON:
+    """
+    Already encoded JSON value, like a body of Yandex API response.
+    """
+    # JSON backend used to parse JSON
+    BACKEND = 'orjson' if orjson is not None else 'json'
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        # UTF-8 encoded JSON
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        return isinstance(other, RawJSON) and self.data == other.data
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def __repr__(self):
+        return 'RawJSON(' + repr(self.data[:64]) + ('...)' if len(self.data) > 64 else ')')
+
+    @classmethod
+    def validate(cls, text):
+        """
+        Check the text looks like a JSON object or array, without parsing it.
+        Catches what usually goes wrong with Yandex responses: HTML error pages, empty and truncated bodies.
+        Raises ValueError if the text is not JSON.
+        :param text: JSON text, string
+        :return: RawJSON
+        """
+        text = text.strip()
+        if not text or (text[0], text[-1]) not in (('{', '}'), ('[', ']')):
+            raise ValueError("Not a JSON object or array")
+        # Never appears in valid JSON, and would break the framing of text protocol
+        if '\0' in text:
+            raise ValueError("Zero character in JSON")
+        return cls(text.encode('utf-8'))
+
+    @staticmethod
+    def loads(text):
+        """
+        Parse JSON with the fastest backend available.
+        Raises ValueError if the text is not JSON.
+        :param text: JSON text, string or bytes
+        :return: parsed value
+        """
+        if orjson is not None:
+            return orjson.loads(text)
+        return json.loads(text)
+
+    def parse(self):
+        """
+        Parse the JSON value.
+        Raises ValueError if it's not JSON after all.
+        :return: parsed value
+        """
+        return self.loads(self.data)
+
+    @classmethod
+    def dumps(cls, message):
+        """
+        Encode the message to JSON, RawJSON values of the message are spliced as they are.
+        Same output as json.dumps for messages without RawJSON values.
+        :param message: message, a dictionary or a list
+        :return: UTF-8 encoded JSON, bytes
+        """
+        if not isinstance(message, dict) or not any(isinstance(value, RawJSON) for value in message.values()):
+            return json.dumps(message).encode('utf-8')
+        parts = []
+        for key, value in message.items():
+            if isinstance(value, RawJSON):
+                parts.append((json.dumps(key) + ': ').encode('utf-8') + value.data)
+            else:
+                parts.append((json.dumps(key) + ': ' + json.dumps(value)).encode('utf-8'))
+        return b'{' + b', '.join(parts) + b'}'
+
+    @classmethod
+    def resolve(cls, message):
+        """
+        Parse RawJSON values of the message, for encodings other than JSON.
+        :param message: message, a dictionary or a list
+        :return: message without RawJSON values
+        """
+        if not isinstance(message, dict) or not any(isinstance(value, RawJSON) for value in message.values()):
+            return message
+        return {key: value.parse() if isinstance(value, RawJSON) else value for key, value in message.items()}
@@ -0,0 +1,120 @@
+"""
+This is a response cache module of Yandex Transport Proxy.
+
+Responses to get...Info queries are kept for a short time, so the same query made by several clients
+goes to Yandex only once.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+class ResponseCache:
+    """
+    Response cache, stores responses to get...Info queries for some time, so the same queries made by
+    different clients within short amount of time will not go to Yandex each time.
+    Entries expire after TTL specific to query type, and least recently used entries are evicted
+    if there are too many of them or they take too much memory.
+    """
+    # Time to live of cached responses for each query type, in secs. Query types not listed here are not cached.
+    # Vehicles positions change fast, routes and lines almost never do.
+    DEFAULT_TTL = {'getVehiclesInfo': 10,
+                   'getVehiclesInfoWithRegion': 10,
+                   'getAllInfo': 10,
+                   'getStopInfo': 30,
+                   'getRouteInfo': 3600,
+                   'getLine': 3600,
+                   'getLayerRegions': 3600}
+
+    def __init__(self, max_entries=100, max_bytes=50*1024*1024):
+        # Maximum number of cached responses, 0 disables the cache
+        self.max_entries = max_entries
+        # Maximum total size of cached responses, in bytes
+        self.max_bytes = max_bytes
+        # TTL for each query type
+        self.ttl = dict(self.DEFAULT_TTL)
+
+        # Statistics: hits, misses and evictions
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+        # Current total size of cached responses, in bytes
+        self.size = 0
+
+        # (query type, canonical URL) -> {'payload', 'size', 'expires'}, in "least recently used first" order
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def canonical_url(url):
+        """
+        Get canonical form of URL, so the same URL with reordered parameters will hit the same cache entry.
+        :param url: URL
+        :return: canonical URL
+        """
+        parts = urlsplit(url.strip())
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+    def get(self, query_type, url):
+        """
+        Get cached response
+        :param query_type: type of query, like "getStopInfo"
+        :param url: URL from the query
+        :return: list of response dictionaries, or None if nothing is cached or the entry is expired
+        """
+        if self.max_entries <= 0 or query_type not in self.ttl:
+            return None
+        key = (query_type, self.canonical_url(url))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['expires'] <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry['payload']
+
+    def put(self, query_type, url, payload, size):
+        """
+        Store response in the cache
+        :param query_type: type of query, like "getStopInfo"
+        :param url: URL from the query
+        :param payload: list of response dictionaries
+        :param size: size of the response, in bytes
+        :return: nothing
+        """
+        if self.max_entries <= 0 or query_type not in self.ttl or size > self.max_bytes:
+            return
+        key = (query_type, self.canonical_url(url))
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = {'payload': payload,
+                                 'size': size,
+                                 'expires': time.time() + self.ttl[query_type]}
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        """
+        Remove entry from the cache, cache lock should be acquired.
+        :param key: entry key
+        :return: nothing
+        """
+        entry = self.entries.pop(key)
+        self.size -= entry['size']
+
+    def get_stats(self):
+        """
+        Get cache statistics
+        :return: dictionary with cache statistics
+        """
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), size=self.size)
@@ -0,0 +1,119 @@
+"""
+This is a watch worker module of Yandex Transport Proxy.
+
+Watch workers keep pages open and pass new API responses to watching clients as they arrive.
+"""
+
+import time
+import threading
+from yandex_transport_core.yandex_transport_core import YandexTransportCore
+from yandex_transport_core.worker_thread import WorkerThread
+
+
+class WatchThread(WorkerThread):
+    """
+    Watch worker, keeps the page open in its own YandexTransportCore (and Chromium) instance and passes new
+    API responses the page receives to the watching client, one message each. Watches don't use the Query Queue,
+    normal queries are executed by executor workers meanwhile.
+    """
+    def __init__(self, app, worker_id, core):
+        super().__init__(app, worker_id, core)
+
+        # Watch assigned to this worker, None if idle. Protected by app.queue_lock.
+        self.watch = None
+
+        # Notified when a watch is assigned or cancelled, or the server stops
+        self.condition = threading.Condition(self.app.queue_lock)
+
+        # How often to look for new API responses, in secs
+        self.poll_interval = self.app.watch_poll_interval
+
+    def set_watch(self, watch):
+        """
+        Assign the watch to this worker, or cancel the current one, and wake the worker up.
+        Queue lock should be acquired.
+        :param watch: internal watch structure, None to cancel the current watch
+        :return: nothing
+        """
+        self.watch = watch
+        self.condition.notify()
+
+    def is_watching(self, watch):
+        """
+        Check if the watch is still assigned to this worker.
+        :param watch: internal watch structure
+        :return: True if the watch should go on
+        """
+        self.app.queue_lock.acquire()
+        result = self.app.is_running and self.watch is watch
+        self.app.queue_lock.release()
+        return result
+
+    def execute_watch(self, watch):
+        """
+        Open the page and send new API responses to the client until the watch is cancelled.
+        :param watch: internal watch structure {'type', 'id', 'body', 'addr', 'conn'}
+        :return: nothing
+        """
+        error = self.core.watch_vehicles_info(watch['body'])
+        while error == YandexTransportCore.RESULT_OK:
+            data, error = self.core.get_watch_updates()
+            if error != YandexTransportCore.RESULT_OK:
+                break
+            for entry in data:
+                self.app.send_message(self.make_result(watch['id'], entry), watch['addr'], watch['conn'],
+                                      log_tag=watch['type'])
+
+            # Waiting for the next poll, cancelling the watch wakes the worker up
+            self.app.queue_lock.acquire()
+            if self.app.is_running and self.watch is watch:
+                self.condition.wait(self.poll_interval)
+            self.app.queue_lock.release()
+            if not self.is_watching(watch):
+                break
+
+        if error == YandexTransportCore.RESULT_OK:
+            result = {'id': watch['id'],
+                      'method': watch['type'],
+                      'error': self.app.RESULT_OK,
+                      'message': 'Watch cancelled',
+                      'expect_more_data': False}
+        else:
+            result = {'id': watch['id'],
+                      'method': watch['type'],
+                      'error': self.app.RESULT_GET_ERROR,
+                      'message': 'Error getting requested URL',
+                      'expect_more_data': False}
+        self.app.send_message(result, watch['addr'], watch['conn'], log_tag=watch['type'])
+
+    def run(self):
+        self.app.log.debug("Watch thread " + str(self.worker_id) + " started.")
+        # Watches assigned meanwhile start when the browser is ready
+        self.startup_time = self.keep_starting_core("watch worker " + str(self.worker_id))
+        if self.startup_time is None:
+            return
+        self.ready_time = time.time() - self.app.start_time
+        self.ready = True
+
+        while True:
+            # Waiting for a watch to be assigned
+            self.app.queue_lock.acquire()
+            while self.app.is_running and self.watch is None:
+                self.condition.wait()
+            watch = self.watch
+            self.app.queue_lock.release()
+            if not self.app.is_running:
+                break
+
+            self.app.log.debug("Executing " + watch['type'] + " watch:"
+                               " ID=" + str(watch['id']) +
+                               " URL=" + str(watch['body']))
+            self.execute_watch(watch)
+            self.core.stop_watch()
+
+            # Marking this worker as idle, unless the watch was already cancelled
+            self.app.queue_lock.acquire()
+            if self.watch is watch:
+                self.watch = None
+            self.app.queue_lock.release()
+        self.app.log.debug("Watch thread " + str(self.worker_id) + " stopped.")
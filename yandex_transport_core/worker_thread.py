@@ -0,0 +1,111 @@
+"""
+This is a worker module of Yandex Transport Proxy.
+
+Executor and watch workers each own a YandexTransportCore (and Chromium) instance, and start their browsers
+in parallel, while the server is already accepting queries.
+"""
+
+import time
+import threading
+from selenium.common.exceptions import WebDriverException
+from yandex_transport_core.yandex_transport_core import YandexTransportCore
+
+
+class WorkerThread(threading.Thread):
+    """
+    Worker thread owning its own YandexTransportCore (and Chromium) instance, base of executor and watch workers.
+    """
+    def __init__(self, app, worker_id, core):
+        super().__init__()
+        self.app = app
+
+        # ID of this worker, used in logs and in getStatus output
+        self.worker_id = worker_id
+
+        # Yandex Transport API Core, owned exclusively by this worker
+        self.core = core
+
+        # Worker is ready when its browser is started. How long it took to start the browser,
+        # and when the worker became ready (since the server was started), in secs.
+        self.ready = False
+        # Browser failed to start (the worker keeps trying), or the thread died
+        self.failed = False
+        self.startup_time = None
+        self.ready_time = None
+
+    def make_result(self, query_id, entry):
+        """
+        Make the message with one API response for the client, more messages are expected after it.
+        :param query_id: ID of the query or watch, as given by the client
+        :param entry: API response from YandexTransportCore, {"method", "data"}, no "data" if there was none
+        :return: message dictionary
+        """
+        if 'data' in entry:
+            return {'id': query_id,
+                    'method': entry['method'],
+                    'error': self.app.RESULT_OK,
+                    'message': 'OK',
+                    'expect_more_data': True,
+                    'data': entry['data']}
+        return {'id': query_id,
+                'method': entry['method'],
+                'error': self.app.RESULT_NO_DATA,
+                'message': 'No data',
+                'expect_more_data': True}
+
+    def start_core(self, name):
+        """
+        Start the browser of the worker, all workers start their browsers in parallel.
+        :param name: name of the worker, for logs
+        :return: time it took to start the browser in secs, None if failed to start
+        """
+        start_time = time.time()
+        if self.core.profile_template_dir is not None:
+            with self.app.profile_lock:
+                if not self.core.is_profile_seeded():
+                    self.app.log.info("Seeding browser profile " + self.core.profile_template_dir + " ...")
+                    try:
+                        error = self.core.seed_profile(self.app.profile_seed_url)
+                    except WebDriverException as e:
+                        self.app.log.error("Exception (seed_profile): " + str(e))
+                        error = YandexTransportCore.RESULT_GET_ERROR
+                    if error != YandexTransportCore.RESULT_OK:
+                        self.app.log.warning("Failed to seed browser profile, browsers will start with empty cache")
+                    else:
+                        self.app.log.info("Browser profile seeded in " + str(round(time.time() - start_time, 2)) +
+                                          " secs")
+
+        self.app.log.info("Starting ChromeDriver for " + name + "...")
+        start_time = time.time()
+        try:
+            self.core.start_webdriver()
+        except WebDriverException as e:
+            self.app.log.error("Failed to start ChromeDriver for " + name + " : " + str(e))
+            # Whatever was started before it failed
+            self.core.stop_webdriver()
+            return None
+        startup_time = time.time() - start_time
+        self.app.log.info("ChromeDriver for " + name + " started successfully in " +
+                          str(round(startup_time, 2)) + " secs!")
+        return startup_time
+
+    def keep_starting_core(self, name):
+        """
+        Start the browser of the worker. If it fails to start, the worker is marked as failed and tries again
+        every recycle_retry_interval secs, until the browser starts or the server stops.
+        :param name: name of the worker, for logs
+        :return: time it took to start the browser in secs, None if the server was stopped before that
+        """
+        while self.app.is_running:
+            startup_time = self.start_core(name)
+            if startup_time is not None:
+                self.failed = False
+                return startup_time
+            self.failed = True
+            self.app.log.error("Browser of " + name + " failed to start, trying again in " +
+                               str(self.app.recycle_retry_interval) + " secs.")
+            self.app.queue_lock.acquire()
+            if self.app.is_running:
+                self.app.start_retry_condition.wait(self.app.recycle_retry_interval)
+            self.app.queue_lock.release()
+        return None
@@ -12,14 +12,23 @@ It uses Selenium with ChromeDriver and gets Yandex Transport API JSON responses.
 #       camelCase, like Robot Operating System.
 #       I also personally find camelCase more prettier than the snake_case.
 
-import ast
 import re
+import os
 import time
+import shutil
+import tempfile
+import base64
 import io
 import json
+import zlib
+import http.client
+from collections import OrderedDict
 import selenium
 from selenium import webdriver
 from bs4 import BeautifulSoup
+from yandex_transport_core.raw_json import RawJSON
+from yandex_transport_core.direct_session import DirectSession
+from yandex_transport_core.process_memory import get_process_tree_rss
 
 class YandexTransportCore:
     """
@@ -33,37 +42,235 @@ class YandexTransportCore:
     RESULT_JSON_PARSE_ERROR = 4
     RESULT_GET_ERROR = 5
 
+    # Ways to find API responses
+    CAPTURE_MODE_PERFORMANCE = 'performance'    # Performance API of the page, gives URLs only
+    CAPTURE_MODE_DEVTOOLS = 'devtools'          # DevTools network events, gives URLs and response bodies
+
+    # Resources Yandex Maps page does not need to make masstransit API queries: map tiles, analytics, fonts.
+    # Browser does not load them, "*" is a wildcard.
+    DEFAULT_BLOCKED_URLS = ('*://core-renderer-tiles.maps.yandex.net/*',
+                            '*://core-sat.maps.yandex.net/*',
+                            '*://core-stv-renderer.maps.yandex.net/*',
+                            '*://core-jams-rdr-cache.maps.yandex.net/*',
+                            '*://mc.yandex.ru/*',
+                            '*://an.yandex.ru/*',
+                            '*://yandex.ru/clck/*',
+                            '*://favicon.yandex.net/*',
+                            '*.woff',
+                            '*.woff2',
+                            '*.ttf')
+
+    # File in the profile template marking it as seeded
+    PROFILE_SEEDED_FILE = 'ytps-seeded'
+
+    # Compiled regular expressions to find API methods in URLs, tuple of API methods -> pattern
+    API_METHOD_PATTERNS = {}
+
+    # API methods to find for each kind of query, local API name -> tuple of Yandex API methods
+    QUERY_API_METHODS = {'getStopInfo': ("maps/api/masstransit/getStopInfo",),
+                         'getVehiclesInfo': ("maps/api/masstransit/getVehiclesInfo",),
+                         'getVehiclesInfoWithRegion': ("maps/api/masstransit/getVehiclesInfoWithRegion",),
+                         'getRouteInfo': ("maps/api/masstransit/getRouteInfo",),
+                         'getLine': ("maps/api/masstransit/getLine",),
+                         'getLayerRegions': ("maps/api/masstransit/getLayerRegions",),
+                         'getAllInfo': ("maps/api/masstransit/getRouteInfo",
+                                        "maps/api/masstransit/getLine",
+                                        "maps/api/masstransit/getStopInfo",
+                                        "maps/api/masstransit/getVehiclesInfo",
+                                        "maps/api/masstransit/getVehiclesInfoWithRegion",
+                                        "maps/api/masstransit/getLayerRegions")}
+
+    # Ways to get bodies of API responses (fetch and navigate - Performance API capture mode only)
+    FETCH_MODE_FETCH = 'fetch'          # fetch() from inside the page, all responses in parallel
+    FETCH_MODE_NAVIGATE = 'navigate'    # navigate the browser to each API query URL, parse the page
+    FETCH_MODE_DIRECT = 'direct'        # query API over HTTP with the browser session, the page is loaded only
+                                        # for new URLs, or when the session expires, responses as with fetch()
+
     def __init__(self):
         self.driver = None
 
         # Count of network queries executed so far, the idea is to restart the browser if it's too big.
         self.network_queries_count = 0
 
+        # When the browser was started, time.time()
+        self.started_time = None
+
+        # Browser profile template, with the disk cache seeded by seed_profile. Every browser starts with its own copy
+        # of it, the template itself is never changed. None - start in incognito mode, with empty cache.
+        # Should be set before start_webdriver is called.
+        self.profile_template_dir = None
+        # Copy of the template used by the running browser, removed when the browser is stopped
+        self.profile_dir = None
+
+        # URL patterns of resources the browser should not load, and if it should not load images at all.
+        # Nothing is blocked by default, DEFAULT_BLOCKED_URLS are known to be safe to block.
+        # Should be set before start_webdriver is called.
+        self.blocked_urls = ()
+        self.block_images = False
+
+        # Browser should be restarted (recycled) after this many network queries, when it uses more than
+        # this many bytes of memory (ChromeDriver and all Chromium processes), or after this many secs. 0 - never.
+        self.recycle_queries = 0
+        self.recycle_rss = 0
+        self.recycle_age = 0
+        # Memory of the browser is checked at most once in this many secs, it means reading /proc for every process.
+        # Last result is kept meanwhile: bytes, and when it was checked (time.time()).
+        self.rss_check_interval = 10
+        self.rss = None
+        self.rss_checked_time = 0
+
         # ChromeDriver location. They changed it a lot, by the way.
         self.chrome_driver_location = "/usr/bin/chromedriver"
 
+        # Maximum time to wait for requested API methods to appear after the page is loaded, in secs.
+        # Yandex might call some methods (like getStopInfo) quite some time after the page is loaded.
+        self.wait_timeout = 30
+
+        # How often to check if requested API methods appeared, in secs.
+        self.wait_poll_interval = 0.5
+
+        # If several API methods are requested (like getAllInfo does), not all of them will necessarily appear.
+        # Stop waiting if no new methods appeared during this time after the last one did, in secs.
+        self.wait_settle_time = 5
+
+        # How to find API responses. Should be set before start_webdriver is called.
+        self.capture_mode = self.CAPTURE_MODE_PERFORMANCE
+
+        # How to get bodies of API responses. If fetching from inside the page fails, navigation is used.
+        self.fetch_mode = self.FETCH_MODE_FETCH
+
+        # Maximum time to fetch API responses from inside the page, in secs.
+        self.fetch_timeout = 10
+
+        # Keep bodies of API responses as RawJSON (checked, but not parsed) instead of parsing them,
+        # for those who pass them on as JSON anyway.
+        self.json_passthrough = False
+
+        # Size of resource timing buffer of the page, consumed entries are cleared, so it only has to hold
+        # entries appearing between two checks. Browser default is 250, Yandex Maps can easily make more.
+        self.resource_timing_buffer_size = 2000
+
+        # Direct fetch mode: browser session and API queries pages made, to make them directly over HTTP
+        self.direct = DirectSession()
+
+        # Watch state: API methods being watched, DevTools capture state,
+        # URLs fetched by the watch itself (they appear in networking data too) -> count. Set by start_watch.
+        self.watch_api_method = ()
+        self.watch_capture = None
+        self.watch_own_requests = {}
+
     def start_webdriver(self):
         """
         Start Chromium webdriver
         :return: nothing
         """
+        if self.profile_template_dir is not None:
+            self.profile_dir = self._copy_profile()
+        self._start_chrome(self.profile_dir)
+        self._configure_page_loading()
+        self.started_time = time.time()
+        self.network_queries_count = 0
+
+    def _start_chrome(self, user_data_dir):
+        """
+        Start Chromium and ChromeDriver.
+        :param user_data_dir: browser profile directory, None - incognito mode
+        :return: nothing
+        """
         chrome_options = webdriver.ChromeOptions()
         chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--incognito")
+        if user_data_dir is None:
+            chrome_options.add_argument("--incognito")
+        else:
+            # Disk cache of the profile keeps scripts of Yandex Maps, and their compiled code
+            chrome_options.add_argument("--user-data-dir=" + user_data_dir)
         # These two are basically needed for Chromium to run inside docker container.
         chrome_options.add_argument('--no-sandbox')
         # Next line causes selenium error WebDriverException: Message: chrome not reachable" inside Docker container.
         # Transport Proxy seems to work without it, --no-sandbox only is enough.
         # Left here as s reminder
         # chrome_options.add_argument('--disable-dev-shm-usage')
-        self.driver = webdriver.Chrome(self.chrome_driver_location, options=chrome_options)
+        if self.block_images:
+            chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+        if self.capture_mode == self.CAPTURE_MODE_DEVTOOLS:
+            # DevTools network events will be available in "performance" log
+            chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+        service = webdriver.ChromeService(executable_path=self.chrome_driver_location)
+        self.driver = webdriver.Chrome(service=service, options=chrome_options)
+
+    def _copy_profile(self):
+        """
+        Copy profile template for the browser to use, several browsers can't use the same profile at once.
+        :return: directory of the copy
+        """
+        profile_dir = os.path.join(tempfile.mkdtemp(prefix='ytps-profile-'), 'profile')
+        # Lock files belong to the browser which created the template
+        shutil.copytree(self.profile_template_dir, profile_dir, symlinks=True,
+                        ignore=shutil.ignore_patterns('Singleton*', self.PROFILE_SEEDED_FILE))
+        return profile_dir
+
+    def is_profile_seeded(self):
+        """
+        Check if the profile template is seeded already.
+        :return: True if seeded
+        """
+        return os.path.exists(os.path.join(self.profile_template_dir, self.PROFILE_SEEDED_FILE))
+
+    def seed_profile(self, url):
+        """
+        Seed the profile template: start the browser with it, load the page, so its scripts and styles are in the
+        disk cache, and stop the browser. Should be done once, before browsers are started.
+        :param url: url of the page, any Yandex Maps page
+        :return: error code
+        """
+        os.makedirs(self.profile_template_dir, exist_ok=True)
+        self._start_chrome(self.profile_template_dir)
+        try:
+            self._configure_page_loading()
+            self.driver.get(url)
+            # Some scripts are loaded after the page itself
+            time.sleep(self.wait_settle_time)
+        except selenium.common.exceptions.WebDriverException as e:
+            print("Selenium exception (seed_profile):", e)
+            return self.RESULT_GET_ERROR
+        finally:
+            self.driver.quit()
+            self.driver = None
+        seeded_file_name = os.path.join(self.profile_template_dir, self.PROFILE_SEEDED_FILE)
+        with open(seeded_file_name, 'w', encoding='utf-8') as seeded_file:
+            seeded_file.write(url + '\n')
+        return self.RESULT_OK
+
+    def _configure_page_loading(self):
+        """
+        Configure how the browser loads pages, using DevTools commands. Settings stay for the whole browser session.
+        :return: nothing
+        """
+        try:
+            # Raising resource timing buffer size before scripts of every page run, otherwise it is only raised
+            # by get_chromium_networking_data after the page is loaded, when some entries might be lost already.
+            self.driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument',
+                                        {'source': 'performance.setResourceTimingBufferSize(' +
+                                                   str(self.resource_timing_buffer_size) + ');'})
+            # Requests to blocked resources fail right away, without going to the network
+            if self.blocked_urls:
+                self.driver.execute_cdp_cmd('Network.enable', {})
+                self.driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': list(self.blocked_urls)})
+        except selenium.common.exceptions.WebDriverException as e:
+            print("Selenium exception (_configure_page_loading):", e)
 
     def stop_webdriver(self):
         """
         Stop Chromium Webdriver
         :return: nothing
         """
-        self.driver.quit()
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
+        self.direct.close_http_connections()
+        if self.profile_dir is not None:
+            shutil.rmtree(os.path.dirname(self.profile_dir), ignore_errors=True)
+            self.profile_dir = None
 
     def restart_webdriver(self):
         """
@@ -73,6 +280,52 @@ class YandexTransportCore:
         self.stop_webdriver()
         self.start_webdriver()
 
+    def warm_up(self, url):
+        """
+        Load the page once, so scripts and styles of Yandex Maps are in the browser cache before real queries.
+        :param url: url of the page, nothing is loaded if None
+        :return: nothing
+        """
+        if url is None:
+            return
+        try:
+            self.driver.get(url)
+            self.driver.get('about:blank')
+        except selenium.common.exceptions.WebDriverException as e:
+            print("Selenium exception (warm_up):", e)
+        self.network_queries_count += 1
+
+    def get_browser_rss(self):
+        """
+        Get memory used by the browser: resident set size of ChromeDriver and all its child processes.
+        Linux only, uses /proc.
+        :return: size in bytes, None if not available
+        """
+        try:
+            root_pid = self.driver.service.process.pid
+        except AttributeError:
+            return None
+
+        return get_process_tree_rss(root_pid)
+
+    def get_recycle_reason(self):
+        """
+        Check if the browser should be restarted (recycled), see recycle_queries, recycle_rss, recycle_age.
+        :return: reason as a string, None if the browser is fine
+        """
+        if self.recycle_queries and self.network_queries_count >= self.recycle_queries:
+            return str(self.network_queries_count) + " network queries"
+        if self.recycle_age and self.started_time is not None and \
+                time.time() - self.started_time >= self.recycle_age:
+            return str(int(time.time() - self.started_time)) + " secs old"
+        if self.recycle_rss:
+            if time.time() - self.rss_checked_time >= self.rss_check_interval:
+                self.rss = self.get_browser_rss()
+                self.rss_checked_time = time.time()
+            if self.rss is not None and self.rss >= self.recycle_rss:
+                return str(self.rss // (1024 * 1024)) + " MB of memory"
+        return None
+
     @staticmethod
     def yandex_api_to_local_api(method):
         """
@@ -80,39 +333,418 @@ class YandexTransportCore:
         :param method: method, like "maps/api/masstransit/getVehciclesInfo"
         :return: local API, like to "getVehiclesInfo"
         """
-        if method == "maps/api/masstransit/getStopInfo":
-            return 'getStopInfo'
-        if method == "maps/api/masstransit/getRouteInfo":
-            return 'getRouteInfo'
-        if method == "maps/api/masstransit/getLine":
-            return 'getLine'
-        if method == "maps/api/masstransit/getVehiclesInfo":
-            return 'getVehiclesInfo'
-        if method == "maps/api/masstransit/getVehiclesInfoWithRegion":
-            return 'getVehiclesInfoWithRegion'
-        if method == "maps/api/masstransit/getLayerRegions":
-            return 'getLayerRegions'
-
+        # Each local API name but getAllInfo stands for a single API method
+        local_method = method.rpartition('/')[2]
+        if YandexTransportCore.QUERY_API_METHODS.get(local_method) == (method,):
+            return local_method
         return method
 
-    def get_chromium_networking_data(self):
+    def get_chromium_networking_data(self, api_method=()):
         """
-        Gets "Network" data from Developer tools of Chromium Browser
-        :return: JSON containing data from "Network" tab
+        Gets "Network" data from Developer tools of Chromium Browser.
+        Only entries which appeared since the last call on the current page are returned (page navigation entry
+        on the first call only). Returned resource timing entries are cleared in the page, so the browser buffer
+        never fills up and the page does not keep growing list of entries.
+        Filtering is done inside the browser, only page navigation entries and resource entries
+        containing one of requested API methods are returned, with "name" and "entryType" fields only.
+        :param api_method: tuple of API methods to look for, if empty - all entries are returned
+        :return: list of {"name": url, "entryType": type of entry} dictionaries
         """
         # Script to get Network data from Developer tools, huge thanks to this link:
         # https://stackoverflow.com/questions/20401264/how-to-access-network-panel-on-google-chrome-developer-tools-with-selenium
+        # Matching entries are moved from the browser buffer to window.__ytpsNetworking, also when the buffer is full.
         script = "var performance = window.performance || window.mozPerformance || window.msPerformance || " \
-                 "window.webkitPerformance || {}; var network = performance.getEntries() || {}; return network;"
-        data = self.driver.execute_script(script)
+                 "window.webkitPerformance || {}; " \
+                 "var result = []; " \
+                 "var state = window.__ytpsNetworking; " \
+                 "if (!state) { " \
+                 "  state = window.__ytpsNetworking = {'methods': arguments[0], 'pending': []}; " \
+                 "  state.collect = function() { " \
+                 "    var entries = (performance.getEntriesByType && performance.getEntriesByType('resource')) " \
+                 "                  || []; " \
+                 "    for (var i = 0; i < entries.length; i++) { " \
+                 "      var matched = state.methods.length == 0; " \
+                 "      for (var j = 0; !matched && j < state.methods.length; j++) { " \
+                 "        matched = entries[i].name.indexOf(state.methods[j]) != -1; " \
+                 "      } " \
+                 "      if (matched) { state.pending.push({'name': entries[i].name, " \
+                 "                                         'entryType': entries[i].entryType}); } " \
+                 "    } " \
+                 "    if (performance.clearResourceTimings) { performance.clearResourceTimings(); } " \
+                 "  }; " \
+                 "  if (performance.setResourceTimingBufferSize) { " \
+                 "    performance.setResourceTimingBufferSize(arguments[1]); " \
+                 "  } " \
+                 "  if (performance.addEventListener) { " \
+                 "    performance.addEventListener('resourcetimingbufferfull', state.collect); " \
+                 "  } " \
+                 "  var navigation = (performance.getEntriesByType && performance.getEntriesByType('navigation')) " \
+                 "                   || []; " \
+                 "  for (var k = 0; k < navigation.length; k++) { " \
+                 "    result.push({'name': navigation[k].name, 'entryType': navigation[k].entryType}); " \
+                 "  } " \
+                 "} " \
+                 "state.methods = arguments[0]; " \
+                 "state.collect(); " \
+                 "result = result.concat(state.pending); " \
+                 "state.pending = []; " \
+                 "return result;"
+
+        # Selenium returns native lists and dictionaries here, no parsing required.
+        data = self.driver.execute_script(script, list(api_method), self.resource_timing_buffer_size)
+        if data is None:
+            data = []
+
+        return data
+
+    @classmethod
+    def _get_api_method_pattern(cls, api_method):
+        """
+        Get compiled regular expression finding any of API methods in URL, compiled once per set of methods.
+        If URL contains several methods (like getVehiclesInfo and getVehiclesInfoWithRegion), the longest one matches.
+        :param api_method: tuple of API methods
+        :return: compiled regular expression, match.group(0) is the API method
+        """
+        pattern = cls.API_METHOD_PATTERNS.get(api_method)
+        if pattern is None:
+            methods = sorted(api_method, key=len, reverse=True)
+            pattern = re.compile('|'.join(re.escape(method) for method in methods))
+            cls.API_METHOD_PATTERNS[api_method] = pattern
+        return pattern
+
+    @classmethod
+    def _find_api_queries(cls, network_data, url, api_method, capture):
+        """
+        Find Yandex API queries made after the page was loaded in networking data.
+        Networking data is incremental (see get_chromium_networking_data), found queries are accumulated in capture.
+        :param network_data: new networking data, from get_chromium_networking_data
+        :param url: url of the page
+        :param api_method: tuple of API methods to find
+        :param capture: capture state, {"url_reached": bool, "queries": list}, is updated by this function,
+                        optional "own_requests": {url: count} are queries fetched by us, they are skipped
+        :return: array of {"url": query url, "method": API method}, all found so far
+        """
+        pattern = cls._get_api_method_pattern(api_method)
+        own_requests = capture.get('own_requests', {})
+
+        for entry in network_data:
+            if not capture['url_reached']:
+                if entry['name'] == url:
+                    capture['url_reached'] = True
+                continue
+            res = pattern.search(str(entry['name']))
+            if res is not None:
+                if own_requests.get(entry['name'], 0) > 0:
+                    own_requests[entry['name']] -= 1
+                    continue
+                capture['queries'].append({"url": entry['name'], "method": res.group(0)})
 
-        # They output network data in "kinda-JSON" with single quites instead of double ones.
-        # We used this thing before, which was unreliable in the end
-        # result_json = str(data).replace("'", '"')
-        # Now we're just using this thing, which is probably VERY dangerous, but we don't care =)
-        parsed_data = eval(str(data))
+        return capture['queries']
 
-        return parsed_data
+    def _wait_for_api_queries(self, find_api_queries, api_method):
+        """
+        Wait until all requested API methods appear in networking data.
+        Returns as soon as all methods are found, or if wait_settle_time passed since last new method was found
+        (only if several methods are requested), or if wait_timeout expired.
+        :param find_api_queries: function returning API queries found so far, like _find_api_queries
+        :param api_method: tuple of API methods to find
+        :return: array of {"url": query url, "method": API method}
+        """
+        last_query = []
+        for new_query in self._iter_api_queries(find_api_queries, api_method):
+            last_query += new_query
+        return last_query
+
+    def _iter_api_queries(self, find_api_queries, api_method):
+        """
+        Wait for requested API methods to appear in networking data, the same way _wait_for_api_queries does,
+        but give away queries as soon as they are found.
+        :param find_api_queries: function returning API queries found so far, like _find_api_queries
+        :param api_method: tuple of API methods to find
+        :return: generator of arrays of {"url": query url, "method": API method}, queries found since the last one
+        """
+        start_time = time.time()
+        last_found_time = start_time
+        found_methods = set()
+        # Found queries are kept in capture state, each one is the same dictionary every time it's found
+        found_queries = set()
+
+        while True:
+            last_query = find_api_queries()
+            new_query = [query for query in last_query if id(query) not in found_queries]
+            if new_query:
+                found_queries.update(id(query) for query in new_query)
+                yield new_query
+
+            current_time = time.time()
+            methods = set(query['method'] for query in last_query)
+            if methods - found_methods:
+                found_methods = methods
+                last_found_time = current_time
+
+            if len(found_methods) == len(set(api_method)):
+                break
+            if found_methods and len(api_method) > 1 and current_time - last_found_time >= self.wait_settle_time:
+                break
+            if current_time - start_time >= self.wait_timeout:
+                break
+
+            time.sleep(self.wait_poll_interval)
+
+    def _find_devtools_api_queries(self, api_method, capture):
+        """
+        Find finished Yandex API queries in DevTools network events received since the last call.
+        :param api_method: tuple of API methods to find
+        :param capture: capture state, {"responses": OrderedDict, "finished": set}, is updated by this function
+        :return: array of {"url": query url, "method": API method, "request_id": DevTools request ID}
+        """
+        pattern = self._get_api_method_pattern(api_method)
+        for entry in self.driver.get_log('performance'):
+            try:
+                message = json.loads(entry['message'])['message']
+            except (ValueError, KeyError):
+                continue
+            params = message.get('params', {})
+            if message.get('method') == 'Network.responseReceived':
+                response_url = params['response']['url']
+                res = pattern.search(response_url)
+                if res is not None:
+                    capture['responses'][params['requestId']] = {"url": response_url,
+                                                                 "method": res.group(0),
+                                                                 "request_id": params['requestId']}
+            elif message.get('method') == 'Network.loadingFinished':
+                capture['finished'].add(params['requestId'])
+
+        return [query for request_id, query in capture['responses'].items() if request_id in capture['finished']]
+
+    def _get_devtools_api_responses(self, last_query):
+        """
+        Get bodies of API responses the page actually received, from DevTools.
+        :param last_query: array of {"url", "method", "request_id"}, from _find_devtools_api_queries
+        :return: dictionary {url: body string}, responses which are not available anymore are not included
+        """
+        bodies = {}
+        for query in last_query:
+            try:
+                response = self.driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': query['request_id']})
+            except selenium.common.exceptions.WebDriverException as e:
+                print("Selenium exception (_get_devtools_api_responses):", e)
+                continue
+            body = response['body']
+            if response.get('base64Encoded', False):
+                body = base64.b64decode(body).decode('utf-8', errors='replace')
+            bodies[query['url']] = body
+        return bodies
+
+    def _fetch_api_responses(self, urls):
+        """
+        Get bodies of API responses by fetching them from inside the page, in parallel, with one script call.
+        :param urls: list of API query URLs
+        :return: dictionary {url: body string}, URLs which failed to be fetched are not included
+        """
+        script = "var urls = arguments[0]; " \
+                 "var callback = arguments[arguments.length - 1]; " \
+                 "Promise.all(urls.map(function(url) { " \
+                 "  return fetch(url, {'credentials': 'include'}).then(function(response) { " \
+                 "    return response.text().then(function(text) { " \
+                 "      return {'url': url, 'status': response.status, 'body': text}; " \
+                 "    }); " \
+                 "  }).catch(function(error) { " \
+                 "    return {'url': url, 'status': 0, 'body': null}; " \
+                 "  }); " \
+                 "})).then(callback);"
+
+        unique_urls = list(OrderedDict.fromkeys(urls))
+        try:
+            self.driver.set_script_timeout(self.fetch_timeout)
+            responses = self.driver.execute_async_script(script, unique_urls)
+        except selenium.common.exceptions.WebDriverException as e:
+            print("Selenium exception (_fetch_api_responses):", e)
+            return {}
+
+        bodies = {}
+        for response in responses or []:
+            if response['status'] == 200 and response['body'] is not None:
+                bodies[response['url']] = response['body']
+        return bodies
+
+    def _get_api_response_by_navigation(self, url):
+        """
+        Get body of API response by navigating the browser to its URL. Slow, but always works.
+        Raises selenium.common.exceptions.WebDriverException if navigation failed.
+        :param url: API query URL
+        :return: body string, None if failed to find the body
+        """
+        self.driver.get(url)
+
+        # Writing API query results to memory
+        output_stream = io.StringIO()
+        output_stream.write(self.driver.page_source)
+        output_stream.seek(0)
+
+        # Getting API query results from the page
+        soup = BeautifulSoup(output_stream, 'lxml', from_encoding='utf-8')
+        body = soup.find('body')
+        if body is None or body.string is None:
+            return None
+        return body.string
+
+    def _harvest_session(self, url, api_method, last_query):
+        """
+        Save the browser session (cookies, CSRF token, user agent) and API queries the page made,
+        so the same queries can be made directly over HTTP later.
+        :param url: url of the page
+        :param api_method: tuple of API methods requested
+        :param last_query: array of {"url", "method", ...}, API queries found on the page
+        :return: nothing
+        """
+        try:
+            cookies = self.driver.get_cookies()
+            user_agent = self.driver.execute_script("return navigator.userAgent;")
+        except selenium.common.exceptions.WebDriverException as e:
+            print("Selenium exception (_harvest_session):", e)
+            return
+        self.direct.save(url, api_method, last_query, cookies, user_agent)
+
+    def _get_yandex_json_direct(self, url, api_method):
+        """
+        Make API queries the page made before directly over HTTP, with the browser session. Pages never loaded
+        get queries from the template of pages of the same kind, if there is a verified one.
+        If the session expired or any query failed, the session is dropped, so the page will be loaded again.
+        :param url: url of the page
+        :param api_method: tuple of API methods requested
+        :return: array of {"url", "method", "error", "data"}, None if the page should be loaded in the browser
+        """
+        if self.fetch_mode != self.FETCH_MODE_DIRECT or not self.direct.is_active():
+            return None
+        last_query, template_key = self.direct.find_queries(url, api_method)
+        if last_query is None:
+            return None
+        self.direct.mark_used(url, api_method, template_key)
+
+        result_list = []
+        for query in last_query:
+            query_url = self.direct.get_query_url(query['url'])
+            self.network_queries_count += 1
+            try:
+                status, body_string = self.direct.http_get(query_url, url)
+            except (OSError, http.client.HTTPException, zlib.error, EOFError) as e:
+                print("HTTP exception (_get_yandex_json_direct):", e)
+                self.direct.drop()
+                return None
+            result = self._make_api_result(query, body_string if status == 200 else None)
+            data = result.get('data')
+            if isinstance(data, RawJSON):
+                # The answer is tiny if the session has expired, big ones are not worth parsing
+                data = data.parse() if len(data) < 1024 else None
+            # Yandex answers with a new CSRF token instead of data if the session has expired.
+            # The template may be wrong as well, it has to be verified again.
+            if result['error'] != "OK" or \
+                    (isinstance(data, dict) and 'csrfToken' in data and 'data' not in data):
+                print("Direct query failed, session expired:", query_url)
+                self.direct.drop(template_key)
+                return None
+            result_list.append(result)
+
+        return result_list
+
+    def _make_api_result(self, query, body_string):
+        """
+        Make API result entry from API response body
+        :param query: {"url": query url, "method": API method}
+        :param body_string: body of the response, None if failed to get it
+        :return: {"url", "method", "error", "data"} dictionary, no "data" if failed to parse the body,
+                 "data" is RawJSON in JSON passthrough mode
+        """
+        method = self.yandex_api_to_local_api(query['method'])
+        if body_string is None:
+            return {"url": query['url'],
+                    "method": method,
+                    "error": "Failed to parse body of the response"}
+        try:
+            if self.json_passthrough:
+                returned_json = RawJSON.validate(body_string)
+            else:
+                returned_json = RawJSON.loads(body_string)
+        except ValueError:
+            return {"url": query['url'],
+                    "method": method,
+                    "error": "Failed to parse JSON"}
+        return {"url": query['url'],
+                "method": method,
+                "error": "OK",
+                "data": returned_json}
+
+    def _load_page(self, url):
+        """
+        Load the page in the browser
+        :param url: url of the page
+        :return: error code
+        """
+        if self.driver is None:
+            return self.RESULT_WEBDRIVER_NOT_RUNNING
+        try:
+            if self.capture_mode == self.CAPTURE_MODE_DEVTOOLS:
+                # Discarding network events left from previous queries
+                self.driver.get_log('performance')
+            self.driver.get(url)
+        except selenium.common.exceptions.WebDriverException as e:
+            print("Selenium exception (_get_yandex_json):", e)
+            return self.RESULT_GET_ERROR
+        return self.RESULT_OK
+
+    def _get_api_responses(self, new_query, capture):
+        """
+        Get bodies of API responses the page received, the way capture and fetch modes say.
+        :param new_query: array of {"url", "method", ...}, API queries found on the page
+        :param capture: capture state of the page
+        :return: dictionary, url -> body string, queries without bodies should be made by navigation
+        """
+        if self.capture_mode == self.CAPTURE_MODE_DEVTOOLS:
+            # Getting API query results exactly as the page received them, no extra queries
+            return self._get_devtools_api_responses(new_query)
+        if self.fetch_mode not in (self.FETCH_MODE_FETCH, self.FETCH_MODE_DIRECT):
+            return {}
+        # Getting API query results by executing them again from inside the page, all at once
+        bodies = self._fetch_api_responses([query['url'] for query in new_query])
+        # They will appear in networking data of the page too
+        for query_url in OrderedDict.fromkeys(query['url'] for query in new_query):
+            capture['own_requests'][query_url] = capture['own_requests'].get(query_url, 0) + 1
+        return bodies
+
+    def _iter_page_api_queries(self, url, api_method):
+        """
+        Find API queries the page makes, the way capture mode says.
+        Yandex is not supplying us with getStopInfo right after the page is loaded, waiting for it to appear.
+        :param url: url of the page, already loaded
+        :param api_method: tuple of API methods requested
+        :return: capture state of the page, generator of arrays of new API queries, see _iter_api_queries
+        """
+        if self.capture_mode == self.CAPTURE_MODE_DEVTOOLS:
+            capture = {"responses": OrderedDict(), "finished": set()}
+            return capture, self._iter_api_queries(lambda: self._find_devtools_api_queries(api_method, capture),
+                                                   api_method)
+        capture = {"url_reached": False, "queries": [], "own_requests": {}}
+        return capture, self._iter_api_queries(
+            lambda: self._find_api_queries(self.get_chromium_networking_data(api_method), url, api_method, capture),
+            api_method)
+
+    def _iter_navigated_api_results(self, navigate_query):
+        """
+        Get API query results by executing them again in the browser, one by one.
+        :param navigate_query: array of {"url", "method", ...}, API queries to navigate to
+        :return: generator of ({"url", "method", "error", "data"}, error code), ends with (None, error code)
+                 if failed
+        """
+        for query in navigate_query:
+            try:
+                body_string = self._get_api_response_by_navigation(query['url'])
+            except selenium.common.exceptions.WebDriverException as e:
+                print("Your favourite error message: THIS SHOULD NOT HAPPEN!")
+                print("Selenium exception (_get_yandex_json):", e)
+                yield None, self.RESULT_GET_ERROR
+                return
+            yield self._make_api_result(query, body_string), self.RESULT_OK
 
     # ----                               MASTER FUNCTION TO GET YANDEX API DATA                                   ---- #
 
@@ -124,93 +756,164 @@ class YandexTransportCore:
                like ("maps/api/masstransit/get_route_info","maps/api/masstransit/get_vehicles_info")
         :return: array of huge json data, error code
         """
+        result_list = []
+        for result, error in self._iter_yandex_json(url, api_method):
+            if result is None:
+                return (None if error == self.RESULT_GET_ERROR else result_list), error
+            result_list.append(result)
+        return result_list, self.RESULT_OK
+
+    def _iter_yandex_json(self, url, api_method):
+        """
+        Universal method to get Yandex JSON results, one by one. Each result is given away as soon as it's ready,
+        while the page may still be making other API queries.
+        :param url: initial url, get it by clicking on the route or stop
+        :param api_method: tuple of strings to find,
+               like ("maps/api/masstransit/get_route_info","maps/api/masstransit/get_vehicles_info")
+        :return: generator of ({"url", "method", "error", "data"}, error code), ends with (None, error code)
+                 if failed
+        """
+        if isinstance(api_method, str):
+            api_method = (api_method,)
+        api_method = tuple(api_method)
 
         print("API Method:", api_method)
         print("URL", url)
 
-        result_list = []
+        result_list = self._get_yandex_json_direct(url, api_method)
+        if result_list is not None:
+            for result in result_list:
+                yield result, self.RESULT_OK
+            return
+
+        error = self._load_page(url)
+        if error != self.RESULT_OK:
+            yield None, error
+            return
+
+        capture, found_queries = self._iter_page_api_queries(url, api_method)
+        last_query = []
+        # Queries to get by navigation, it has to wait until the page makes all queries, navigation leaves the page
+        navigate_query = []
+        for new_query in found_queries:
+            last_query += new_query
+            bodies = self._get_api_responses(new_query, capture)
+            for query in new_query:
+                body_string = bodies.get(query['url'])
+                if body_string is None:
+                    navigate_query.append(query)
+                else:
+                    yield self._make_api_result(query, body_string), self.RESULT_OK
+
+        # The page itself, and each API query which was executed again
+        self.network_queries_count += 1 + len(last_query)
+
+        if not last_query:                # Same meaning as in "if len(last_query) == 0:"
+            yield None, self.RESULT_NO_LAST_QUERY
+            return
+
+        for result, error in self._iter_navigated_api_results(navigate_query):
+            yield result, error
+            if result is None:
+                return
+
+        if self.fetch_mode == self.FETCH_MODE_DIRECT:
+            self._harvest_session(url, api_method, last_query)
+
+    # ----                        WATCH: KEEP THE PAGE OPEN, GET NEW API RESPONSES                              ---- #
+
+    def start_watch(self, url, api_method):
+        """
+        Open the page and keep it open, API responses the page receives from now on are returned by get_watch_updates.
+        :param url: url of the page, like the url of the stop
+        :param api_method: tuple of API methods to watch, if a response matches several, the first one is used
+        :return: error code
+        """
+        if isinstance(api_method, str):
+            api_method = (api_method,)
+        api_method = tuple(api_method)
+
+        self.watch_api_method = api_method
+        self.watch_capture = {"responses": OrderedDict(), "finished": set()}
+        self.watch_own_requests = {}
 
         if self.driver is None:
-            return result_list, self.RESULT_WEBDRIVER_NOT_RUNNING
+            return self.RESULT_WEBDRIVER_NOT_RUNNING
         try:
+            if self.capture_mode == self.CAPTURE_MODE_DEVTOOLS:
+                # Discarding network events left from previous queries
+                self.driver.get_log('performance')
             self.driver.get(url)
         except selenium.common.exceptions.WebDriverException as e:
-            print("Selenium exception (_get_yandex_json):", e)
-            return None, self.RESULT_GET_ERROR
-
-        # OK, now Yandex is not supplying us with getStopInfo here, how about we wait for a bit (dirty hack)
-        print("Sleeping 30 seconds, dirty hack to get getStopInfo appear")
-        time.sleep(30)        
+            print("Selenium exception (start_watch):", e)
+            return self.RESULT_GET_ERROR
 
-        network_data = self.get_chromium_networking_data()
-        print(network_data)
+        self.network_queries_count += 1
+        return self.RESULT_OK
 
-        # Loading Network Data to JSON
-        #try:
-        #    network_data = json.loads(network_json, encoding='utf-8')
-        #except ValueError as e:
-        #    print("JSON Exception (_get_yandex_json):", e)
-        #    return result_list, self.RESULT_NETWORK_PARSE_ERROR
-
-        url_reached = False
-        last_query = []
-
-        self.network_queries_count = 0
-        for entry in network_data:
-            self.network_queries_count += 1
-            if not url_reached:
-                if entry['name'] == url:
-                    url_reached = True
-                    continue
+    def get_watch_updates(self):
+        """
+        Get API responses the watched page received since the last call. The page is never reloaded,
+        only new entries of its networking data are looked at.
+        :return: array of {"url", "method", "error", "data"}, error code
+        """
+        result_list = []
+        try:
+            if self.capture_mode == self.CAPTURE_MODE_DEVTOOLS:
+                new_query = self._find_devtools_api_queries(self.watch_api_method, self.watch_capture)
+                # Returned responses are forgotten, so they will not be returned again
+                for query in new_query:
+                    del self.watch_capture['responses'][query['request_id']]
+                    self.watch_capture['finished'].discard(query['request_id'])
+                bodies = self._get_devtools_api_responses(new_query)
             else:
-                for method in api_method:
-                    res = re.match(".*" + method + ".*", str(entry['name']))
-                    if res is not None:
-                        last_query.append({"url": entry['name'], "method": method})
-
-        # Getting last API query results from cache by executing it again in the browser
-        if last_query:                    # Same meaning as in "if len(last_query) > 0:"
-            for query in last_query:
-                # Getting the webpage based on URL
-                try:
-                    self.driver.get(query['url'])
-                except selenium.common.exceptions.WebDriverException as e:
-                    print("Your favourite error message: THIS SHOULD NOT HAPPEN!")
-                    print("Selenium exception (_get_yandex_json):", e)
-                    return None, self.RESULT_GET_ERROR
-
-                # Writing get_stop_info results to memory
-                output_stream = io.StringIO()
-                output_stream.write(self.driver.page_source)
-                output_stream.seek(0)
-
-                # Getting get_stop_info results to JSON
-                soup = BeautifulSoup(output_stream, 'lxml', from_encoding='utf-8')
-                body = soup.find('body')
-                if body is not None:
-                    body_string = body.string.encode('utf-8')
-                    try:
-                        returned_json = json.loads(body_string, encoding='utf-8')
-                        data = {"url": query['url'],
-                                "method": self.yandex_api_to_local_api(query['method']),
-                                "error": "OK",
-                                "data": returned_json}
-                    except ValueError as e:
-                        data = {"url": query['url'],
-                                "method": self.yandex_api_to_local_api(query['method']),
-                                "error": "Failed to parse JSON"}
-                else:
-                    data = {"url": query['url'],
-                            "method": self.yandex_api_to_local_api(query['method']),
-                            "error": "Failed to parse body of the response"}
-
-                result_list.append(data)
+                pattern = self._get_api_method_pattern(self.watch_api_method)
+                new_query = []
+                for entry in self.get_chromium_networking_data(self.watch_api_method):
+                    res = pattern.search(entry['name'])
+                    if entry['entryType'] == 'navigation' or res is None:
+                        continue
+                    if self.watch_own_requests.get(entry['name'], 0) > 0:
+                        self.watch_own_requests[entry['name']] -= 1
+                        continue
+                    new_query.append({"url": entry['name'], "method": res.group(0)})
+                # Navigating to responses would leave the page, so they are always fetched from inside it
+                bodies = {}
+                if new_query:
+                    bodies = self._fetch_api_responses([query['url'] for query in new_query])
+                    for query_url in OrderedDict.fromkeys(query['url'] for query in new_query):
+                        self.watch_own_requests[query_url] = self.watch_own_requests.get(query_url, 0) + 1
+                self.network_queries_count += len(new_query)
+        except selenium.common.exceptions.WebDriverException as e:
+            print("Selenium exception (get_watch_updates):", e)
+            return None, self.RESULT_GET_ERROR
 
-        else:
-            return result_list, self.RESULT_NO_LAST_QUERY
+        for query in new_query:
+            result_list.append(self._make_api_result(query, bodies.get(query['url'])))
 
         return result_list, self.RESULT_OK
 
+    def stop_watch(self):
+        """
+        Stop watching, leave the page so it stops making API queries.
+        :return: nothing
+        """
+        self.watch_api_method = ()
+        self.watch_capture = None
+        try:
+            self.driver.get('about:blank')
+        except selenium.common.exceptions.WebDriverException as e:
+            print("Selenium exception (stop_watch):", e)
+
+    def watch_vehicles_info(self, url):
+        """
+        Start watching Yandex masstransit getVehiclesInfo... responses of the page
+        :param url: url of the stop or route (the URL you get when you click on it in the browser)
+        :return: error code
+        """
+        return self.start_watch(url, api_method=("maps/api/masstransit/getVehiclesInfoWithRegion",
+                                                 "maps/api/masstransit/getVehiclesInfo"))
+
     # ----                                   SHORTCUTS TO USED APIs                                               ---- #
 
     def get_stop_info(self, url):
@@ -219,7 +922,7 @@ class YandexTransportCore:
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getStopInfo",))
+        return self._get_yandex_json(url, api_method=self.QUERY_API_METHODS['getStopInfo'])
 
     def get_vehicles_info(self, url):
         """
@@ -227,7 +930,7 @@ class YandexTransportCore:
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getVehiclesInfo",))
+        return self._get_yandex_json(url, api_method=self.QUERY_API_METHODS['getVehiclesInfo'])
 
     def get_vehicles_info_with_region(self, url):
         """
@@ -235,7 +938,7 @@ class YandexTransportCore:
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getVehiclesInfoWithRegion",))
+        return self._get_yandex_json(url, api_method=self.QUERY_API_METHODS['getVehiclesInfoWithRegion'])
 
     def get_route_info(self, url):
         """
@@ -243,7 +946,7 @@ class YandexTransportCore:
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getRouteInfo",))
+        return self._get_yandex_json(url, api_method=self.QUERY_API_METHODS['getRouteInfo'])
 
     def get_line(self, url):
         """
@@ -251,7 +954,7 @@ class YandexTransportCore:
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getLine",))
+        return self._get_yandex_json(url, api_method=self.QUERY_API_METHODS['getLine'])
 
     def get_layer_regions(self, url):
         """
@@ -259,7 +962,7 @@ class YandexTransportCore:
         :param url: url of the stop (the URL you get when you click on the stop in the browser)
         :return: array of huge json data, error code
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getLayerRegions",))
+        return self._get_yandex_json(url, api_method=self.QUERY_API_METHODS['getLayerRegions'])
 
     def get_all_info(self, url):
         """
@@ -267,13 +970,29 @@ class YandexTransportCore:
         :param url:
         :return:
         """
-        return self._get_yandex_json(url, api_method=("maps/api/masstransit/getRouteInfo",
-                                                      "maps/api/masstransit/getLine",
-                                                      "maps/api/masstransit/getStopInfo",
-                                                      "maps/api/masstransit/getVehiclesInfo",
-                                                      "maps/api/masstransit/getVehiclesInfoWithRegion",
-                                                      "maps/api/masstransit/getLayerRegions")
-                                     )
+        return self._get_yandex_json(url, api_method=self.QUERY_API_METHODS['getAllInfo'])
+
+    def iter_info(self, query_type, url):
+        """
+        Getting Yandex Masstransit API JSON results for the kind of query one by one, as soon as each one is ready
+        :param query_type: local API name, like "getStopInfo" or "getAllInfo", see QUERY_API_METHODS
+        :param url: url of the stop or route (the URL you get when you click on it in the browser)
+        :return: generator of (json data, error code), ends with (None, error code) if failed
+        """
+        return self._iter_yandex_json(url, api_method=self.QUERY_API_METHODS[query_type])
+
+    def needs_browser(self, query_type, url):
+        """
+        Check if the query will load the page in the browser, or will be made directly over HTTP (direct fetch mode).
+        It's a guess, the page is loaded anyway if direct queries fail.
+        :param query_type: local API name, like "getStopInfo" or "getAllInfo", see QUERY_API_METHODS
+        :param url: url of the stop or route
+        :return: True if the page will be loaded in the browser
+        """
+        if self.fetch_mode != self.FETCH_MODE_DIRECT or not self.direct.is_active():
+            return True
+        last_query, _ = self.direct.find_queries(url, self.QUERY_API_METHODS[query_type])
+        return last_query is None
 
 
 if __name__ == '__main__':